@@ -0,0 +1,512 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Micro-benchmarks for the hot paths of the server extension: diffing
+notebooks, committing actions to the database, and building the viewer's
+data. Each stage is timed on synthetic notebooks and action traces of
+several sizes, and the results are written as JSON so they can be compared
+between releases. Run with:
+
+    python benchmarks/nbcomet_benchmark.py [--cells 10,100,1000,5000]
+        [--output results.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nbformat
+
+from nbcomet.nbcomet_diff import diff_against, indices_to_check, CellIndex
+from nbcomet.nbcomet_sqlite import DbManager, DbWriter
+from nbcomet.nbcomet_store import save_version
+from nbcomet.nbcomet_dir import VERSION_TIME_FORMAT, hash_path
+from nbcomet.nbcomet_viewer import (get_viewer_summary, get_version_page,
+    summary_path)
+
+# relative frequency of each action in generated traces, roughly following
+# recorded sessions, where most actions run or edit a single cell
+DEFAULT_MIX = {'run-cell': 5,
+                'unselect-cell': 3,
+                'insert-cell-below': 1,
+                'delete-cell': 1,
+                'move-cell-down': 1,
+                'clear-cell-output': 1}
+
+# GENERATORS
+
+def make_cell(rng, cell_id=None, output_bytes=200, source_lines=5):
+    """
+    generate a code cell with some source and one stream output
+
+    rng: (Random) random number generator
+    cell_id: (str) comet_cell_id to give the cell, or None for no id
+    output_bytes: (int) size of the cell's output text
+    source_lines: (int) number of lines of source
+    """
+    source = "\n".join("x_%d = %d * %d" % (i, rng.randint(0, 999), i)
+                        for i in range(source_lines))
+    metadata = {}
+    if cell_id is not None:
+        metadata['comet_cell_id'] = cell_id
+    return {'cell_type': 'code',
+            'execution_count': rng.randint(1, 100),
+            'metadata': metadata,
+            'outputs': [make_output(rng, output_bytes)],
+            'source': source}
+
+def make_output(rng, output_bytes):
+    # generate a stream output of about output_bytes characters
+    line = "%08x " % rng.getrandbits(32)
+    text = (line * (output_bytes // len(line) + 1))[0:output_bytes]
+    return {'name': 'stdout', 'output_type': 'stream', 'text': text}
+
+def make_notebook(num_cells, output_bytes=200, with_ids=True, seed=0):
+    """
+    generate a notebook model as the nbextension would send it
+
+    num_cells: (int) number of cells
+    output_bytes: (int) size of each cell's output text
+    with_ids: (bool) give cells comet_cell_ids, or leave them out so diffs
+        fall back to comparing cells by position
+    seed: (int) seed for the random number generator
+    """
+    rng = random.Random(seed)
+    cells = [make_cell(rng, new_id(rng) if with_ids else None, output_bytes)
+            for i in range(num_cells)]
+    return {'cells': cells,
+            'metadata': {'kernelspec': {'name': 'python3',
+                                        'display_name': 'Python 3',
+                                        'language': 'python'}},
+            'nbformat': 4,
+            'nbformat_minor': 2}
+
+def new_id(rng):
+    return "%013x" % rng.getrandbits(52)
+
+def make_trace(model, num_actions, mix=None, output_bytes=200, seed=0,
+                start_time=None):
+    """
+    generate a trace of actions applied to a notebook, each carrying the full
+    notebook as it is after the action, like the nbextension posts them
+    returns a list of action data dicts
+
+    model: (dict) notebook to start from, as made by make_notebook
+    num_actions: (int) number of actions
+    mix: (dict) relative frequency of each action name
+    output_bytes: (int) size of outputs of cells that are run
+    seed: (int) seed for the random number generator
+    start_time: (int) time of the first action, in ms since epoch
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    names = sorted(mix)
+    weights = [mix[n] for n in names]
+    with_ids = bool(model['cells']) and \
+        'comet_cell_id' in model['cells'][0]['metadata']
+    t = start_time if start_time is not None else int(time.time() * 1000)
+
+    cells = list(model['cells'])
+    trace = []
+    for a in range(num_actions):
+        name = rng.choices(names, weights)[0]
+        i = rng.randrange(len(cells))
+
+        # replace changed cells by copies, so earlier models are unchanged
+        if name == 'run-cell':
+            c = dict(cells[i])
+            c['source'] = c['source'] + "\ny = %d" % a
+            c['outputs'] = [make_output(rng, output_bytes)]
+            c['execution_count'] = (c['execution_count'] or 0) + 1
+            cells[i] = c
+        elif name == 'unselect-cell':
+            c = dict(cells[i])
+            c['source'] = c['source'] + "\n# edit %d" % a
+            cells[i] = c
+        elif name == 'clear-cell-output':
+            c = dict(cells[i])
+            c['outputs'] = []
+            cells[i] = c
+        elif name == 'insert-cell-below':
+            cell_id = new_id(rng) if with_ids else None
+            cells.insert(i + 1, make_cell(rng, cell_id, 0, 1))
+        elif name == 'delete-cell' and len(cells) > 1:
+            del cells[i]
+        elif name == 'move-cell-down' and i < len(cells) - 1:
+            cells[i], cells[i+1] = cells[i+1], cells[i]
+
+        t += rng.randint(500, 30000)
+        trace.append({'time': t,
+                    'name': name,
+                    'index': i,
+                    'indices': [i],
+                    'model': dict(model, cells=list(cells))})
+    return trace
+
+def parse_mix(text):
+    # parse an action mix like "run-cell=5,delete-cell=1"
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+# MEASUREMENT
+
+def percentile(values, p):
+    # nearest-rank percentile of a list of numbers
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+def summarize(latencies, items):
+    """
+    summarize the latencies of one stage
+
+    latencies: (list) seconds taken by each iteration
+    items: (int) number of items (e.g. actions) processed in total
+    """
+    total = sum(latencies)
+    return {'iterations': len(latencies),
+            'total_s': total,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies) * 1000,
+            'throughput_per_s': items / total if total > 0 else None}
+
+def peak_memory(fn):
+    # peak memory allocated while running fn once, in bytes
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# STAGES
+
+def bench_diff(trace, model):
+    """
+    diff each action of a trace against the notebook before it, as
+    save_batch does for each tracked action
+
+    trace: (list) action data, as made by make_trace
+    model: (dict) notebook the trace starts from
+    """
+    def run(latencies=None):
+        prior = (model, CellIndex(model['cells']))
+        for action_data in trace:
+            start = time.perf_counter()
+            index = CellIndex(action_data['model']['cells'])
+            diff, cell_order = diff_against(prior, action_data, True, index)
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+            prior = (action_data['model'], index)
+
+    latencies = []
+    run(latencies)
+    result = summarize(latencies, len(trace))
+    result['peak_memory_bytes'] = peak_memory(run)
+    return result
+
+def bench_indices_to_check(trace, model):
+    """
+    find the cells each action of a trace may have changed, as done when
+    cells have no ids
+
+    trace: (list) action data, as made by make_trace
+    model: (dict) notebook the trace starts from
+    """
+    def run(latencies=None):
+        nb_a = model['cells']
+        for ad in trace:
+            nb_b = ad['model']['cells']
+            start = time.perf_counter()
+            indices_to_check(ad['name'], ad['index'], ad['indices'], nb_a,
+                            nb_b)
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+            nb_a = nb_b
+
+    latencies = []
+    run(latencies)
+    result = summarize(latencies, len(trace))
+    result['peak_memory_bytes'] = peak_memory(run)
+    return result
+
+def bench_db_commit(trace, model, work_dir, batch_size=50):
+    """
+    queue the actions of a trace and commit them to a fresh database, one
+    batch (and one transaction) at a time
+
+    trace: (list) action data, as made by make_trace
+    model: (dict) notebook the trace starts from
+    work_dir: (str) directory to create the database in
+    batch_size: (int) number of actions committed per transaction
+    """
+    # diff up front so only queueing and committing are timed
+    records = []
+    prior = (model, CellIndex(model['cells']))
+    for action_data in trace:
+        index = CellIndex(action_data['model']['cells'])
+        diff, cell_order = diff_against(prior, action_data, True, index)
+        records.append((action_data, diff, cell_order))
+        prior = (action_data['model'], index)
+
+    def run(latencies=None):
+        db_path = os.path.join(work_dir, "bench-%d.db" % len(os.listdir(
+                                                                work_dir)))
+        writer = DbWriter(flush_interval=3600, batch_size=len(records) + 1)
+        manager = DbManager('bench', db_path, writer)
+        try:
+            for b in range(0, len(records), batch_size):
+                start = time.perf_counter()
+                manager.record_actions_to_db(records[b:b+batch_size])
+                manager.commit_queue()
+                if latencies is not None:
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            manager.close()
+            writer.stop()
+
+    latencies = []
+    run(latencies)
+    result = summarize(latencies, len(records))
+    result['peak_memory_bytes'] = peak_memory(run)
+    return result
+
+def build_history(data_dir, trace, num_versions, storage='files'):
+    """
+    save the actions and periodic versions of a trace the way the server
+    extension does, so the viewer has something to read
+    returns the hashed path and file name of the notebook
+
+    data_dir: (str) NBComet data directory to save to
+    trace: (list) action data, as made by make_trace
+    num_versions: (int) number of versions to save, spread over the trace
+    storage: (str) version storage, 'files' or 'dedup'
+    """
+    hashed_path = hash_path(os.path.join(data_dir, 'notebooks'))
+    fname = 'bench'
+    dest_dir = os.path.join(data_dir, hashed_path, fname)
+    version_dir = os.path.join(dest_dir, 'versions')
+    os.makedirs(version_dir)
+
+    records = []
+    prior = None
+    step = max(1, len(trace) // max(1, num_versions))
+    for n, action_data in enumerate(trace):
+        index = CellIndex(action_data['model']['cells'])
+        diff, cell_order = diff_against(prior, action_data, True, index)
+        records.append((action_data, diff, cell_order))
+        prior = (action_data['model'], index)
+
+        if n % step == 0 and n // step < num_versions:
+            nb = nbformat.from_dict(action_data['model'])
+            date = datetime.datetime.fromtimestamp(action_data['time'] / 1000.0)
+            ver_fname = fname + date.strftime("-" + VERSION_TIME_FORMAT)
+            save_version(nb, version_dir, ver_fname, storage)
+
+    writer = DbWriter(flush_interval=3600)
+    manager = DbManager('bench', os.path.join(dest_dir, fname + '.db'),
+                        writer)
+    try:
+        manager.record_actions_to_db(records)
+    finally:
+        manager.close()
+        writer.stop()
+
+    nb = nbformat.from_dict(trace[-1]['model'])
+    nbformat.write(nb, os.path.join(dest_dir, fname + '.ipynb'),
+                    nbformat.NO_CONVERT)
+    return hashed_path, fname
+
+def bench_viewer(trace, work_dir, num_versions, repeat=3, processes=0):
+    """
+    load the viewer from a saved history, as the viewer page does: the
+    overview and then every page of versions, both from scratch (cold) and
+    from an up-to-date summary (warm)
+
+    trace: (list) action data, as made by make_trace
+    work_dir: (str) directory to save the history in
+    num_versions: (int) number of versions in the history
+    repeat: (int) number of times to time each case
+    processes: (int) worker processes used to read versions
+    """
+    data_dir = os.path.join(work_dir, 'viewer')
+    hashed_path, fname = build_history(data_dir, trace, num_versions)
+    summary = summary_path(data_dir, hashed_path, fname)
+
+    def warm():
+        data, entries = get_viewer_summary(data_dir, hashed_path, fname)
+        page = {'offset': 0, 'versions': [], 'total': len(entries)}
+        while page['offset'] + len(page['versions']) < page['total']:
+            page = get_version_page(data_dir, hashed_path, fname,
+                                    page['offset'] + len(page['versions']),
+                                    processes=processes)
+        return data
+
+    def cold():
+        if os.path.isfile(summary):
+            os.remove(summary)
+        return warm()
+
+    results = {}
+    for name, fn in [('viewer_cold', cold), ('viewer_warm', warm)]:
+        fn()
+        latencies = []
+        for r in range(repeat):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+        result = summarize(latencies, repeat)
+        result['peak_memory_bytes'] = peak_memory(fn)
+        result['versions'] = num_versions
+        results[name] = result
+    return results
+
+def run_benchmarks(sizes, num_actions=200, output_bytes=200, num_versions=20,
+                    mix=None, seed=0, stages=None):
+    """
+    run every stage for each notebook size
+    returns the results, keyed by number of cells and then by stage
+
+    sizes: (list of ints) numbers of cells to benchmark
+    num_actions: (int) number of actions in each trace
+    output_bytes: (int) size of each cell output
+    num_versions: (int) number of versions read by the viewer stages
+    mix: (dict) relative frequency of each action name
+    seed: (int) seed for the random number generator
+    stages: (list) names of the stages to run, or None for all of them
+    """
+    def wanted(name):
+        return stages is None or name in stages
+
+    start_time = int(time.time() * 1000) - num_actions * 30000 - 60000
+    results = {}
+    for num_cells in sizes:
+        work_dir = tempfile.mkdtemp(prefix='nbcomet-bench-')
+        try:
+            model = make_notebook(num_cells, output_bytes, True, seed)
+            trace = make_trace(model, num_actions, mix, output_bytes, seed,
+                                start_time)
+            size_results = {}
+            if wanted('diff'):
+                size_results['diff'] = bench_diff(trace, model)
+            if wanted('diff_no_ids') or wanted('indices_to_check'):
+                plain = make_notebook(num_cells, output_bytes, False, seed)
+                plain_trace = make_trace(plain, num_actions, mix,
+                                        output_bytes, seed, start_time)
+                if wanted('diff_no_ids'):
+                    size_results['diff_no_ids'] = bench_diff(plain_trace,
+                                                            plain)
+                if wanted('indices_to_check'):
+                    size_results['indices_to_check'] = \
+                        bench_indices_to_check(plain_trace, plain)
+            if wanted('db_commit'):
+                size_results['db_commit'] = bench_db_commit(trace, model,
+                                                            work_dir)
+            if wanted('viewer_cold') or wanted('viewer_warm'):
+                viewer = bench_viewer(trace, work_dir, num_versions)
+                for name in viewer:
+                    if wanted(name):
+                        size_results[name] = viewer[name]
+            results[str(num_cells)] = size_results
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def compare_results(old, new, threshold=0.1):
+    """
+    compare the median latency of two benchmark runs
+    returns lines describing each stage, marking changes beyond threshold
+
+    old: (dict) baseline results, as written by main
+    new: (dict) current results
+    threshold: (float) relative change in median latency worth flagging
+    """
+    lines = []
+    for size in sorted(new['results'], key=int):
+        for stage, result in sorted(new['results'][size].items()):
+            base = old['results'].get(size, {}).get(stage)
+            if not base or not base['p50_ms']:
+                continue
+            change = result['p50_ms'] / base['p50_ms'] - 1
+            flag = ''
+            if change > threshold:
+                flag = ' SLOWER'
+            elif change < -threshold:
+                flag = ' faster'
+            lines.append("%6s cells %-16s p50 %10.3f ms -> %10.3f ms %+6.1f%%%s"
+                        % (size, stage, base['p50_ms'], result['p50_ms'],
+                        change * 100, flag))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the NBComet diff, database, and viewer paths")
+    parser.add_argument('--cells', default='10,100,1000,5000',
+        help="comma separated notebook sizes, in cells")
+    parser.add_argument('--actions', type=int, default=200,
+        help="number of actions in each trace")
+    parser.add_argument('--output-bytes', type=int, default=200,
+        help="size of each cell output")
+    parser.add_argument('--versions', type=int, default=20,
+        help="number of versions read by the viewer stages")
+    parser.add_argument('--mix', default=None,
+        help="action mix, e.g. run-cell=5,unselect-cell=3,delete-cell=1")
+    parser.add_argument('--stages', default=None,
+        help="comma separated stages to run (default: all)")
+    parser.add_argument('--seed', type=int, default=0,
+        help="seed for the synthetic notebooks and traces")
+    parser.add_argument('--output', default=None,
+        help="file to write the JSON results to (default: stdout)")
+    parser.add_argument('--compare', default=None,
+        help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.cells.split(',')]
+    mix = parse_mix(args.mix) if args.mix else None
+    stages = args.stages.split(',') if args.stages else None
+    results = run_benchmarks(sizes, args.actions, args.output_bytes,
+                            args.versions, mix, args.seed, stages)
+
+    report = {'created': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {'cells': sizes,
+                            'actions': args.actions,
+                            'output_bytes': args.output_bytes,
+                            'versions': args.versions,
+                            'mix': mix or DEFAULT_MIX,
+                            'seed': args.seed},
+            'results': results}
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in compare_results(old, report):
+            sys.stderr.write(line + "\n")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,25 +4,43 @@ NBComet: Jupyter Notebook extension to track full notebook history
 
 import os
 import json
+import time
 import datetime
+import sqlite3
+import threading
 
-import nbformat
-from notebook.utils import url_path_join
+from tornado import gen, web
+from tornado.ioloop import IOLoop, PeriodicCallback
+from notebook.utils import url_path_join, url_escape
 from notebook.base.handlers import IPythonHandler, path_regex
 
-from .nbcomet_diff import get_nb_diff
-from .nbcomet_sqlite import DbManager
-from .nbcomet_dir import find_storage_dir, create_dir, was_saved_recently, hash_path
-from .nbcomet_viewer import get_viewer_html
+from .nbcomet_diff import diff_against, CellIndex
+from .nbcomet_delta import rebuild_batch
+from .nbcomet_sqlite import db_writer
+from .nbcomet_cache import snapshot_cache
+from .nbcomet_ingest import ingest_pipeline
+from .nbcomet_context import context_registry
+from .nbcomet_store import serialize_notebook, validate_notebook
+from .nbcomet_outputs import apply_output_policy
+from .nbcomet_metrics import metrics
+from .nbcomet_retention import RetentionJob, RetentionPolicy, HOUR
+from .nbcomet_replay import notebook_at
+from .nbcomet_catalog import get_catalog, names_from_metadata
+from .nbcomet_backend import get_backend
+from .nbcomet_journal import action_journal
+from .nbcomet_dir import find_storage_dir, hash_path, get_comet_config
+from .nbcomet_viewer import (get_viewer_summary, get_version_page,
+    update_summary)
 
 # TODO remove any id of files by file path, and use unique id instead
 
 class NBCometHandler(IPythonHandler):
 
-    # manage connections to various sqlite databases
-    db_manager_directory = {}
+    # seconds to wait for room in a full ingest queue before giving up
+    ingest_timeout = 10
 
     # check if extension loaded by visiting http://localhost:8888/api/nbcomet
+    @gen.coroutine
     def get(self, path=''):
         """
         Render a website visualizing the notebook's edit history
@@ -36,101 +54,432 @@ class NBCometHandler(IPythonHandler):
         hashed_path = hash_path(os_dir)
         data_dir = find_storage_dir()
 
-        # display visualization of nbcomet data
-        data = get_viewer_html(data_dir, hashed_path, fname)
-        if len(data['versions']) > 0:
-            self.render("comet_template.html", data = data)
+        # display visualization of nbcomet data, the page loads the versions
+        # themselves from the versions route as they scroll into view
+        data, entries = yield run_off_loop(get_viewer_summary, data_dir,
+                                            hashed_path, fname)
+        if data['numVersions'] > 0:
+            versions_url = url_path_join(self.base_url, 'api/nbcomet-versions',
+                                        url_escape(path))
+            self.render("comet_template.html", data = json.dumps(data),
+                        versions_url = json.dumps(versions_url))
         else:
             self.render("comet_template_nodata.html", filename = fname)
 
+    @gen.coroutine
     def post(self, path=''):
         """
         Save data about notebook actions
         path: (str) relative path to notebook requesting POST
         """
-        # get file, directory, and database names
-        # we hash the path for a private, short, and unique identifier
+        # get the notebook's tracking context, with its storage paths, open
+        # database, and delta state
+        start = time.perf_counter()
         os_path = self.contents_manager._get_os_path(path)
-        os_dir, fname = os.path.split(os_path)
-        fname, file_ext = os.path.splitext(fname)
-        hashed_path = hash_path(os_dir)
-        dest_dir = os.path.join(find_storage_dir(), hashed_path, fname)
-        version_dir = os.path.join(dest_dir, "versions")
-        db_path = os.path.join(dest_dir, fname + ".db")
-        db_key = os.path.join(hashed_path, fname)
+        context = context_registry.get(os_path)
+        metrics.inc('requests')
+        metrics.inc('bytes_received', len(self.request.body))
 
-        # if needed, create storage directories
-        if not os.path.isdir(dest_dir):
-            create_dir(dest_dir)
-            create_dir(version_dir)
+        # a closing notebook sends the actions it had not sent yet as a full
+        # upload, which may overtake requests still in flight, so it neither
+        # needs nor moves the delta revision
+        closing = self.get_query_argument('closing', None) is not None
 
-        # set up connection with database
-        if db_key not in self.db_manager_directory:
-            self.db_manager_directory[db_key] = DbManager(db_key, db_path)
+        # clients may post only the cells that changed since the revision we
+        # last acknowledged, ask them for the full notebook if we don't have it
+        revision = None
+        if not closing:
+            revision = context.delta_state.next_revision(
+                self.get_query_argument('base_revision', None))
+            if revision is None:
+                metrics.inc('resyncs')
+                self.set_status(409)
+                self.finish(json.dumps({'resync': True}))
+                return
 
-        db_manager = self.db_manager_directory[db_key]
+        # hand the request body to the ingest pipeline so parsing, diffing, and
+        # writing happen off the IOLoop, in order for each notebook, and wait
+        # without blocking other requests if this notebook's queue is full
+        body = self.request.body
+        deadline = time.time() + self.ingest_timeout
+        while not ingest_pipeline.submit(context.key, ingest_action, context,
+                                        body, closing):
+            if time.time() > deadline:
+                context.delta_state.invalidate()
+                metrics.inc('ingest_rejected')
+                raise web.HTTPError(503, "NBComet ingest queue is full")
+            metrics.inc('ingest_retries')
+            yield gen.sleep(0.05)
 
-        # save data
-        post_data = self.get_json_body()
-        save_changes(os_path, post_data, db_manager)
-        hashed_full_path = os.path.join(hashed_path, fname + file_ext)
-        self.finish(json.dumps({'hashed_nb_path': hashed_full_path}))
+        self.finish(json.dumps({'hashed_nb_path': context.hashed_full_path,
+                                'revision': revision}))
+        metrics.observe('request', time.perf_counter() - start)
 
     def get_template_path(self):
         return None
 
-def save_changes(os_path, action_data, db_manager, track_versions=True,
+class NBCometStatsHandler(IPythonHandler):
+
+    @web.authenticated
+    def get(self):
+        """
+        Report the state of the ingest pipeline, e.g. queue depths
+        """
+        stats = ingest_pipeline.stats()
+        stats['open_notebooks'] = len(context_registry)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(stats))
+
+class NBCometReplayHandler(IPythonHandler):
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, path=''):
+        """
+        Rebuild the notebook as it was at the time given by the t argument
+        (in ms since epoch, default now), from the last version saved
+        before then and the actions recorded since
+        path: (str) relative path to the notebook
+        """
+        os_path = self.contents_manager._get_os_path(path)
+        os_dir, fname = os.path.split(os_path)
+        fname, file_ext = os.path.splitext(fname)
+        key = hash_path(os_dir) + '/' + fname
+        try:
+            t = int(self.get_query_argument('t', time.time() * 1000))
+        except ValueError:
+            raise web.HTTPError(400, "t must be a time in ms since epoch")
+
+        context = context_registry.find(os_path)
+        nb, info = yield run_off_loop(replay_notebook, context, key, t)
+        if nb is None:
+            raise web.HTTPError(404, "No NBComet history before %d" % t)
+        info['notebook'] = nb
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(info))
+
+class NBCometSummaryHandler(IPythonHandler):
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, path=''):
+        """
+        Report the edit time, number of runs and deletions, number of
+        versions, and gaps in activity of the notebook's history
+        path: (str) relative path to the notebook
+        """
+        os_dir, fname = os.path.split(self.contents_manager._get_os_path(path))
+        fname, file_ext = os.path.splitext(fname)
+        try:
+            data, entries = yield run_off_loop(get_viewer_summary,
+                                find_storage_dir(), hash_path(os_dir), fname)
+        except (IOError, OSError):
+            raise web.HTTPError(404, "No NBComet history for %s" % path)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(data))
+
+class NBCometVersionsHandler(IPythonHandler):
+
+    # most versions to send in one page
+    max_limit = 500
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, path=''):
+        """
+        Report the cells of a page of the notebook's versions, given by the
+        offset and limit arguments, within the time window given by the start
+        and end arguments (in ms since epoch) if any
+        path: (str) relative path to the notebook
+        """
+        os_dir, fname = os.path.split(self.contents_manager._get_os_path(path))
+        fname, file_ext = os.path.splitext(fname)
+        try:
+            offset = max(0, int(self.get_query_argument('offset', 0)))
+            limit = min(self.max_limit,
+                        max(0, int(self.get_query_argument('limit', 50))))
+            start = self.get_query_argument('start', None)
+            start = int(start) / 1000.0 if start is not None else None
+            end = self.get_query_argument('end', None)
+            end = int(end) / 1000.0 if end is not None else None
+        except ValueError:
+            raise web.HTTPError(400, "offset, limit, start, and end must be "
+                                "integers")
+
+        processes = int(get_comet_config().get('viewer_processes', 0))
+        try:
+            page = yield run_off_loop(get_version_page, find_storage_dir(),
+                                    hash_path(os_dir), fname, offset, limit,
+                                    start, end, processes)
+        except (IOError, OSError):
+            raise web.HTTPError(404, "No NBComet history for %s" % path)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(page))
+
+class NBCometNotebooksHandler(IPythonHandler):
+
+    @web.authenticated
+    def get(self):
+        """
+        List the tracked notebooks in the catalog, most recently active
+        first, with their action and version counts
+        """
+        try:
+            limit = self.get_query_argument('limit', None)
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            raise web.HTTPError(400, "limit must be an integer")
+        notebooks = get_catalog(find_storage_dir()).notebooks(limit)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'notebooks': notebooks}))
+
+class NBCometMetricsHandler(IPythonHandler):
+
+    @web.authenticated
+    def get(self):
+        """
+        Report per-stage timings, counters, and queue depths in the
+        Prometheus text format
+        """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.render())
+
+def run_off_loop(func, *args):
+    """
+    run a function on the IOLoop's thread pool, so reading history for the
+    viewer (files, unpickling, and waiting for the summary lock) doesn't hold
+    up other requests
+    returns a future of the function's result
+
+    func: (function) function to run
+    """
+    return IOLoop.current().run_in_executor(None, func, *args)
+
+def replay_notebook(context, key, t):
+    """
+    rebuild a notebook as it was at a point in time, see notebook_at,
+    writing its actions that are still queued or journaled first
+
+    context: (TrackingContext) the notebook's tracking context, if open
+    key: (str) hashed directory and name of the notebook
+    t: (int) point in time, in ms since epoch
+    """
+    # make sure actions still waiting to be written are replayed too, without
+    # loading the other notebooks' journaled actions
+    if context is not None:
+        context.db_manager.commit_queue()
+    action_journal.load(key)
+    return notebook_at(get_backend(), key, t)
+
+def ingest_action(context, body, closing=False):
+    """
+    Parse tracked actions and save them, run by the ingest pipeline workers
+    context: (TrackingContext) paths and state of the tracked notebook
+    body: (bytes) JSON encoded action data sent by the nbextension, either a
+        single action or a batch of them in the form {'actions': [...]}
+    closing: (bool) the batch was sent as the notebook closed, starting from
+        a full notebook, see NBCometHandler.post
+    """
+    with metrics.timer('parse'):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        data = json.loads(body)
+        actions = data['actions'] if 'actions' in data else [data]
+
+        # deltas in a batch build on the action before them, so rebuild
+        # them in order
+        if closing:
+            actions = rebuild_batch(actions)
+        else:
+            actions = [context.delta_state.apply(a) for a in actions]
+    metrics.inc('actions_received', len(actions))
+    save_batch(context, actions)
+
+def save_changes(context, action_data, track_versions=True,
                     track_actions=True):
     """
     Track notebook changes with periodic snapshots, and action tracking
-    os_path: (str) path to notebook as saved on the operating system
+    context: (TrackingContext) paths and state of the tracked notebook
     action_data: (dict) action data in the form of
         t: (int) time action was performed
         name: (str) name of action
         index: (int) selected index
         indices: (list of ints) selected indices
-        model: (dict) notebook JSON
+        model: (dict) notebook JSON, rebuilt by DeltaState if sent as a delta
+    track_versions: (bool) periodically save full versions of the notebook
+    track_actions: (bool) track individual actions performed on the notebook
+    """
+    save_batch(context, [action_data], track_versions, track_actions)
+
+def save_batch(context, actions, track_versions=True, track_actions=True):
+    """
+    Track a batch of notebook changes, diffing each action against the one
+    before it in memory, then committing all actions to the database in one
+    transaction and writing the snapshot and version at most once
+    context: (TrackingContext) paths and state of the tracked notebook
+    actions: (list) action data, as for save_changes, in the order the
+        actions were performed
     track_versions: (bool) periodically save full versions of the notebook
     track_actions: (bool) track individual actions performed on the notebook
     """
+    if not actions:
+        return
+
+    # generate file names, using a hashed path to uniquely identify files
+    # with the same name (e.g., Untitled.ipynb)
+    date_string = datetime.datetime.now().strftime("-%Y-%m-%d-%H-%M-%S-%f")
+    ver_fname = context.fname + date_string
+    config = get_comet_config()
+    backend = context.backend
+    output_policy = config.get('output_policy', 'full')
+    max_output_bytes = int(config.get('max_output_bytes') or 0)
 
-    data_dir = find_storage_dir()
-    if not data_dir:
-        print("Could not find directory to save NBComet data")
+    # a batch older than actions already saved, e.g. one overtaken by the
+    # batch sent as the notebook closed, is diffed from an empty notebook and
+    # does not replace the newer snapshot
+    late = (context.last_action_time is not None
+            and actions[-1]['time'] < context.last_action_time)
+    context.last_action_time = max(actions[-1]['time'],
+                                    context.last_action_time or 0)
+
+    # diff against the last committed snapshot, which is usually held in
+    # memory, then against each changed notebook of the batch in turn
+    if late:
+        metrics.inc('late_batches')
+        prior = ({'cells': []}, CellIndex([]))
     else:
-        # generate file names, using a hashed path to uniquely identify files
-        # with the same name (e.g., Untitled.ipynb)
-        os_dir, fname = os.path.split(os_path)
-        hashed_path = hash_path(os_dir)
-        fname, file_ext = os.path.splitext(fname)
-        date_string = datetime.datetime.now().strftime("-%Y-%m-%d-%H-%M-%S-%f")
+        prior = backend.read_snapshot(context.key, CellIndex)
+    saved = prior is not None
+    latest = None
+    records = []
+    for action_data in actions:
+        # keep only as much of the outputs as the output policy allows,
+        # before they are diffed, saved, or stored in the database
+        with metrics.timer('output_policy'):
+            model = apply_output_policy(action_data['model'], output_policy,
+                                        max_output_bytes)
+        if model is not action_data['model']:
+            action_data = dict(action_data, model=model)
 
-        dest_dir = os.path.join(data_dir, hashed_path, fname)
-        version_dir = os.path.join(dest_dir, "versions")
-        dbname = os.path.join(dest_dir, fname + ".db")
-        dest_fname = os.path.join(dest_dir, fname + ".ipynb")
-        ver_fname = os.path.join(version_dir, fname + date_string + ".ipynb")
+        with metrics.timer('diff'):
+            new_index = CellIndex(action_data['model']['cells'])
+            diff, cell_order = diff_against(prior, action_data, True,
+                                            new_index)
+        records.append((action_data, diff, cell_order))
 
-        # get the notebook in the correct format (nbnode)
-        current_nb = nbformat.from_dict(action_data['model'])
+        # only keep notebooks that have meaningfully changed, as the plain
+        # JSON they were posted as
+        if diff or not saved:
+            latest = prior = (action_data['model'], new_index)
+            latest_time = action_data['time']
+            saved = True
 
-        # save information about the action to the database
-        if track_actions:
-            db_manager.record_action_to_db(action_data, dest_fname)
+    # save information about the actions to the journal, which is loaded
+    # into the database in the background, or straight to the database
+    if track_actions:
+        encoder = context.diff_encoder
+        encoder.keyframe_interval = int(config.get('source_keyframe_interval',
+                                                    20))
+        with metrics.timer('db_record'):
+            try:
+                if action_journal.enabled(context.backend):
+                    num_recorded = action_journal.append(context.key, records,
+                                                        encoder)
+                else:
+                    num_recorded = context.db_manager.record_actions_to_db(
+                                                        records, encoder)
+            except:
+                # the encoder saw revisions that may not have been stored
+                encoder.reset()
+                raise
+        context.actions_since_version += len(records)
+        update_catalog(context, actions[0]['time'], actions[-1]['time'],
+                        num_recorded, nb=records[-1][0]['model'])
 
-        # save file versions and only continue if nb has meaningfully changed
-        if os.path.isfile(dest_fname):
-            diff, cell_order = get_nb_diff(action_data, dest_fname, True)
-            if not diff:
-                return
+    # save file versions and only continue if nb has meaningfully changed
+    if latest is None or late:
+        return
+    current_nb, new_index = latest
+
+    # schema validation is slow, so only do it when debugging
+    if config.get('validate_snapshots', False):
+        with metrics.timer('validate'):
+            validate_notebook(current_nb)
+
+    # save the current file for future comparison, serializing it once for
+    # both the snapshot and the version
+    with metrics.timer('snapshot_write'):
+        data = serialize_notebook(current_nb)
+        backend.write_snapshot(context.key, current_nb, data, new_index)
+    metrics.inc('bytes_written', len(data), 'snapshot')
+
+    # save a time-stamped version periodically, and whenever enough actions
+    # were recorded since the last one, so that versions can serve as
+    # keyframes and rebuilding any point in time replays only a few actions
+    if track_versions:
+        with metrics.timer('version_check'):
+            saved_recently = backend.saved_recently(context.key,
+                                float(config.get('version_interval', 300)))
+        keyframe_interval = int(config.get('keyframe_interval', 200))
+        if (not saved_recently or (keyframe_interval > 0 and
+                context.actions_since_version >= keyframe_interval)):
+            with metrics.timer('version_save'):
+                size = backend.save_version(context.key, current_nb, ver_fname,
+                                            data, latest_time)
+            metrics.inc('bytes_written', size, 'version')
+            context.actions_since_version = 0
+            update_catalog(context, latest_time, latest_time, num_versions=1)
+
+            # add the new version to the viewer's summary now, so viewing
+            # the history doesn't need to read it again
+            try:
+                with metrics.timer('summary_update'):
+                    update_summary(context.data_dir, context.hashed_path,
+                                    context.fname, nb=current_nb)
+            except Exception as e:
+                print("Could not update NBComet viewer summary: %s" % e)
+
+def update_catalog(context, first_time, last_time, num_actions=0,
+                    num_versions=0, nb=None):
+    """
+    Add saved actions and versions to the notebook's entry in the catalog,
+    and record the names it was saved under whenever they change
+    context: (TrackingContext) paths and state of the tracked notebook
+    first_time: (int) time of the first action saved, in ms since epoch
+    last_time: (int) time of the last action saved, in ms since epoch
+    num_actions: (int) number of actions saved
+    num_versions: (int) number of versions saved
+    nb: (dict) latest notebook JSON, holding the names in its metadata
+    """
+    catalog = get_catalog(context.data_dir)
+    try:
+        with metrics.timer('catalog'):
+            catalog.record_activity(context.key, int(first_time),
+                                    int(last_time), num_actions, num_versions)
+            if nb is not None:
+                names = names_from_metadata(nb, context.key)
+                if names != context.catalog_names:
+                    catalog.record_names(context.key, names)
+                    context.catalog_names = names
+    except sqlite3.Error as e:
+        print("Could not update NBComet catalog: %s" % e)
+
+def evict_idle_contexts():
+    # closing a context flushes its database, so don't do it on the IOLoop
+    thread = threading.Thread(target=context_registry.evict_idle,
+                                name='nbcomet-evict')
+    thread.daemon = True
+    thread.start()
 
-        # save the current file for future comparison
-        nbformat.write(current_nb, dest_fname, nbformat.NO_CONVERT)
+def run_retention():
+    # thin out old versions and archive old actions in the background,
+    # skipping notebooks that are being saved
+    policy = RetentionPolicy.from_config(get_comet_config())
+    if policy.enabled():
+        retention_job.start(find_storage_dir(), policy)
 
-        # save a time-stamped version periodically
-        if track_versions:
-            if not was_saved_recently(version_dir):
-                nbformat.write(current_nb, ver_fname, nbformat.NO_CONVERT)
+# background job applying the retention settings
+retention_job = RetentionJob(is_busy=ingest_pipeline.is_busy)
 
 def _jupyter_server_extension_paths():
     """
@@ -162,8 +511,81 @@ def load_jupyter_server_extension(nb_app):
     """
 
     nb_app.log.info('NBComet Server extension loaded')
+    config = get_comet_config()
+    snapshot_cache.max_size = int(config.get('snapshot_cache_size',
+                                            snapshot_cache.max_size))
+    db_writer.configure(
+        flush_interval=float(config.get('db_flush_interval', 2.0)),
+        batch_size=int(config.get('db_batch_size', 200)))
+    ingest_pipeline.configure(
+        max_workers=int(config.get('ingest_workers', 4)),
+        max_queue_size=int(config.get('ingest_queue_size', 100)))
+
+    # journal actions before loading them into the databases, first loading
+    # whatever servers that are gone journaled but did not load
+    if config.get('action_journal', True):
+        data_dir = find_storage_dir()
+        action_journal.start(config.get('journal_directory',
+                                        os.path.join(data_dir, 'journal')),
+                            get_backend(data_dir),
+                            fsync=config.get('journal_fsync', True),
+                            load_interval=float(config.get('db_flush_interval',
+                                                            2.0)))
+
+    # close the tracking contexts of notebooks that are no longer in use
+    context_registry.idle_timeout = float(config.get('context_idle_timeout',
+                                                    3600))
+    evict_interval = min(60, context_registry.idle_timeout) * 1000
+    PeriodicCallback(evict_idle_contexts, evict_interval).start()
+
+    # report queue depths with the per-stage metrics, and optionally log a
+    # summary of them every so often
+    metrics.gauge('ingest_queue_depth', ingest_pipeline.depth,
+                    'Actions waiting to be processed')
+    metrics.gauge('db_queue_length', db_writer.queued,
+                    'Rows waiting to be committed to a database')
+    metrics.gauge('journal_bytes', action_journal.queued,
+                    'Bytes of actions journaled but not yet in a database')
+    metrics.gauge('open_notebooks', lambda: len(context_registry),
+                    'Notebooks with an open tracking context')
+
+    # apply the retention settings a few minutes after startup, then every
+    # so often, checking the settings each time so they can be turned on
+    # without a restart
+    retention_interval = float(config.get('retention_interval', 24)) * HOUR
+    IOLoop.current().call_later(300, run_retention)
+    PeriodicCallback(run_retention, retention_interval * 1000).start()
+
+    log_interval = float(config.get('metrics_log_interval', 0))
+    if log_interval > 0:
+        PeriodicCallback(lambda: metrics.log_summary(nb_app.log),
+                            log_interval * 1000).start()
+
     web_app = nb_app.web_app
     host_pattern = '.*$'
     route_pattern = url_path_join(web_app.settings['base_url'],
                                     r"/api/nbcomet%s" % path_regex)
-    web_app.add_handlers(host_pattern, [(route_pattern, NBCometHandler)])
+    stats_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/nbcomet-stats")
+    metrics_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/nbcomet-metrics")
+    replay_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/nbcomet-at%s" % path_regex)
+    summary_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/nbcomet-summary%s" % path_regex)
+    versions_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/nbcomet-versions%s" % path_regex)
+    notebooks_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/nbcomet-notebooks")
+    web_app.add_handlers(host_pattern, [(route_pattern, NBCometHandler),
+                                        (stats_pattern, NBCometStatsHandler),
+                                        (metrics_pattern,
+                                            NBCometMetricsHandler),
+                                        (replay_pattern,
+                                            NBCometReplayHandler),
+                                        (summary_pattern,
+                                            NBCometSummaryHandler),
+                                        (versions_pattern,
+                                            NBCometVersionsHandler),
+                                        (notebooks_pattern,
+                                            NBCometNotebooksHandler)])
@@ -0,0 +1,492 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Storage backends keep the history of every tracked notebook: its actions,
+its latest snapshot, and its versions. Notebooks are identified by their key,
+their hashed directory and name (e.g. 1a2b3c4d/nb). The backend is chosen
+with the storage_backend setting of the "Comet" config section:
+
+    files:   one action database per notebook, next to its snapshot and
+             versions (the default)
+    sharded: the actions of all notebooks spread over storage_shards shared
+             databases, each with a single writer, with snapshots and
+             versions saved as files as above
+"""
+
+import os
+import json
+import heapq
+import sqlite3
+import logging
+import threading
+from hashlib import sha1
+
+from nbcomet.nbcomet_dir import (find_storage_dir, create_dir, get_comet_config,
+    get_version_index, forget_version_index, was_saved_recently, split_key,
+    find_databases)
+from nbcomet.nbcomet_cache import snapshot_cache
+from nbcomet.nbcomet_store import save_version, read_version, atomic_write
+from nbcomet.nbcomet_sqlite import (DbManager, ShardManager, get_viewer_data,
+    iter_actions, archive_path, archive_actions)
+
+log = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ['files', 'sharded']
+
+class StorageBackend(object):
+    """
+    Interface of the storage backends, see the module docstring
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def open_actions(self, key):
+        """
+        get the writer of a notebook's actions, which records batches of
+        actions with record_actions_to_db, and writes queued actions with
+        commit_queue, as DbManager does
+
+        key: (str) hashed directory and name of the notebook
+        """
+        raise NotImplementedError
+
+    def close_notebook(self, key):
+        # forget anything kept for a notebook that is no longer in use
+        pass
+
+    def load_actions(self, rows_by_key, segment):
+        """
+        write actions loaded from a journal segment, at most once per segment
+
+        rows_by_key: (dict) rows of the actions table (see action_row) of
+            each notebook, by notebook key
+        segment: (tuple) name of the journal run and sequence number of the
+            segment in it, which may already have been loaded for some of
+            the notebooks
+        """
+        raise NotImplementedError
+
+    def action_data(self, key, start_time, end_time):
+        """
+        get the viewer's data about a notebook's actions in a time range, see
+        get_viewer_data, or None if the notebook has no actions
+
+        key: (str) hashed directory and name of the notebook
+        start_time: (int) start of the time range, in ms since epoch
+        end_time: (int) end of the time range, in ms since epoch
+        """
+        raise NotImplementedError
+
+    def iter_actions(self, key, start_time=None, end_time=None,
+                    allow_pickle=False):
+        """
+        stream a notebook's actions with their diffs decoded, including
+        those retention archived, in order of time, see iter_actions
+
+        key: (str) hashed directory and name of the notebook
+        start_time: (int) only actions at or after this time, in ms since epoch
+        end_time: (int) only actions at or before this time, in ms since epoch
+        allow_pickle: (bool) decode diffs pickled by older versions of NBComet
+        """
+        raise NotImplementedError
+
+    def read_snapshot(self, key, build_index):
+        """
+        get the latest snapshot of a notebook with an index of its cells, or
+        None if it was never saved
+
+        key: (str) hashed directory and name of the notebook
+        build_index: (function) builds the index from a list of cells
+        """
+        raise NotImplementedError
+
+    def write_snapshot(self, key, nb, data, index=None):
+        """
+        replace the latest snapshot of a notebook
+
+        key: (str) hashed directory and name of the notebook
+        nb: (dict) notebook JSON
+        data: (bytes) the notebook as serialized by serialize_notebook
+        index: (object) index of the notebook's cells, if already built
+        """
+        raise NotImplementedError
+
+    def saved_recently(self, key, min_time=300):
+        """
+        check if a version of the notebook was saved in the last min_time
+        seconds
+
+        key: (str) hashed directory and name of the notebook
+        min_time: (float) seconds
+        """
+        raise NotImplementedError
+
+    def save_version(self, key, nb, version_fname, data=None,
+                    action_time=None):
+        """
+        save a version of the notebook, see save_version
+        returns the number of bytes written
+
+        key: (str) hashed directory and name of the notebook
+        nb: (dict) notebook JSON
+        version_fname: (str) name of the version, without file extension
+        data: (bytes) the notebook as serialized by serialize_notebook
+        action_time: (int) time of the last action the version reflects, in
+            ms since epoch
+        """
+        raise NotImplementedError
+
+    def version_entries(self, key, start_time=None, end_time=None):
+        """
+        get the index entries of a notebook's versions, sorted by time, see
+        VersionIndex
+
+        key: (str) hashed directory and name of the notebook
+        start_time: (float) only versions saved at or after this time, in
+            seconds since epoch
+        end_time: (float) only versions saved at or before this time, in
+            seconds since epoch
+        """
+        raise NotImplementedError
+
+    def find_keyframe(self, key, t):
+        """
+        get the index entry of the version of a notebook to replay its
+        actions at a point in time from, see VersionIndex.keyframe, or None
+        if no version was saved before then
+
+        key: (str) hashed directory and name of the notebook
+        t: (int) point in time, in ms since epoch
+        """
+        raise NotImplementedError
+
+    def read_version(self, key, filename):
+        """
+        get a saved version of a notebook
+
+        key: (str) hashed directory and name of the notebook
+        filename: (str) file name of the version, from its index entry
+        """
+        raise NotImplementedError
+
+    # the methods below are used by the commands that go over every notebook
+    # (retention, export, migration, and rebuilding the catalog), which raise
+    # NotImplementedError for backends that don't keep their data in files
+
+    def notebooks(self):
+        """
+        lazily find the keys of the notebooks with recorded actions
+        """
+        raise NotImplementedError
+
+    def action_databases(self):
+        """
+        lazily find the paths of the databases holding actions
+        """
+        raise NotImplementedError
+
+    def action_source(self, key):
+        """
+        get where a notebook's actions are stored
+        returns the path of the action database, and the notebook key to
+        select its rows by if the database holds the actions of many
+        notebooks, or None
+
+        key: (str) hashed directory and name of the notebook
+        """
+        raise NotImplementedError
+
+    def archive_actions(self, key, before_time, dry_run=False):
+        """
+        move a notebook's actions recorded before a given time to an archive
+        database, see archive_actions
+        returns the number of actions archived
+
+        key: (str) hashed directory and name of the notebook
+        before_time: (int) time before which actions are archived, in ms
+            since epoch, or None to only compact the database
+        dry_run: (bool) only count what would be archived
+        """
+        raise NotImplementedError
+
+    def version_dir(self, key):
+        """
+        get the directory holding a notebook's versions and their index
+
+        key: (str) hashed directory and name of the notebook
+        """
+        raise NotImplementedError
+
+    def dest_dir(self, key):
+        """
+        get the directory holding a notebook's files, e.g. the viewer's
+        summary of its versions
+
+        key: (str) hashed directory and name of the notebook
+        """
+        raise NotImplementedError
+
+    def close(self):
+        # write anything still queued and release open databases
+        pass
+
+class FileBackend(StorageBackend):
+    """
+    Keep each notebook's action database, snapshot, and versions in its own
+    directory of the data directory, as NBComet always has
+    """
+
+    def __init__(self, data_dir):
+        super(FileBackend, self).__init__(data_dir)
+        # writers of the open notebooks, which journaled actions are loaded
+        # through too
+        self.managers = {}
+        self.lock = threading.Lock()
+
+    def dest_dir(self, key):
+        return os.path.join(self.data_dir, *split_key(key))
+
+    def version_dir(self, key):
+        return os.path.join(self.dest_dir(key), 'versions')
+
+    def snapshot_path(self, key):
+        return os.path.join(self.dest_dir(key), split_key(key)[1] + '.ipynb')
+
+    def db_path(self, key):
+        return os.path.join(self.dest_dir(key), split_key(key)[1] + '.db')
+
+    def open_actions(self, key):
+        # if needed, create storage directories
+        create_dir(self.dest_dir(key))
+        create_dir(self.version_dir(key))
+        manager = DbManager(key, self.db_path(key))
+        with self.lock:
+            self.managers[key] = manager
+        return manager
+
+    def close_notebook(self, key):
+        with self.lock:
+            self.managers.pop(key, None)
+        forget_version_index(self.version_dir(key))
+
+    def load_actions(self, rows_by_key, segment):
+        for key, rows in rows_by_key.items():
+            with self.lock:
+                manager = self.managers.get(key)
+            if manager is not None and not manager.closed:
+                manager.load_rows({key: rows}, segment)
+                continue
+            # the notebook was closed, e.g. by a server that is gone
+            create_dir(self.dest_dir(key))
+            manager = DbManager(key, self.db_path(key))
+            try:
+                manager.load_rows({key: rows}, segment)
+            finally:
+                manager.close()
+
+    def action_data(self, key, start_time, end_time):
+        # don't let sqlite create an empty database for a missing one
+        db, shard_key = self.action_source(key)
+        if not os.path.isfile(db):
+            return None
+        return get_viewer_data(db, start_time, end_time, shard_key)
+
+    def iter_actions(self, key, start_time=None, end_time=None,
+                    allow_pickle=False):
+        # actions are archived once they are old, but ones loaded late may
+        # still be older than the last archived, so merge the two by time
+        db, shard_key = self.action_source(key)
+        streams = [iter_actions(path, start_time, end_time,
+                                allow_pickle=allow_pickle, key=shard_key)
+                    for path in [archive_path(db), db] if os.path.isfile(path)]
+        for a in heapq.merge(*streams, key=lambda a: a['time']):
+            yield a
+
+    def notebooks(self):
+        for db in find_databases(self.data_dir):
+            yield os.path.relpath(os.path.dirname(db),
+                                self.data_dir).replace(os.sep, '/')
+
+    def action_databases(self):
+        return find_databases(self.data_dir)
+
+    def action_source(self, key):
+        return self.db_path(key), None
+
+    def archive_actions(self, key, before_time, dry_run=False):
+        db, shard_key = self.action_source(key)
+        if not os.path.isfile(db):
+            return 0
+        return archive_actions(db, before_time, dry_run, shard_key)
+
+    def read_snapshot(self, key, build_index):
+        return snapshot_cache.get_with_index(self.snapshot_path(key),
+                                            build_index)
+
+    def write_snapshot(self, key, nb, data, index=None):
+        path = self.snapshot_path(key)
+        atomic_write(path, data)
+        snapshot_cache.put(path, nb, index=index)
+
+    def saved_recently(self, key, min_time=300):
+        return was_saved_recently(self.version_dir(key), min_time)
+
+    def save_version(self, key, nb, version_fname, data=None,
+                    action_time=None):
+        # the version storage setting is picked up without a restart
+        storage = get_comet_config().get('version_storage', 'files')
+        path = save_version(nb, self.version_dir(key), version_fname, storage,
+                            data, action_time)
+        return os.path.getsize(path)
+
+    def version_entries(self, key, start_time=None, end_time=None):
+        version_dir = self.version_dir(key)
+        if not os.path.isdir(version_dir):
+            return []
+        index = get_version_index(version_dir)
+        if start_time is None and end_time is None:
+            return index.all()
+        return index.between(start_time if start_time is not None else 0,
+                            end_time if end_time is not None
+                            else float('inf'))
+
+    def find_keyframe(self, key, t):
+        version_dir = self.version_dir(key)
+        if not os.path.isdir(version_dir):
+            return None
+        return get_version_index(version_dir).keyframe(t)
+
+    def read_version(self, key, filename):
+        return read_version(os.path.join(self.version_dir(key), filename))
+
+class ShardedBackend(FileBackend):
+    """
+    Spread the actions of all notebooks over a fixed number of shared
+    databases in the shards directory, each written by a single connection,
+    so servers sharing a data directory (e.g. on network storage) keep a few
+    databases open and locked instead of one per notebook. Snapshots and
+    versions are written once and never locked, so they stay files.
+
+    The number of shards is saved in the shards directory when it is
+    created, since notebooks could not be found if it changed.
+    """
+
+    def __init__(self, data_dir, num_shards=16):
+        super(ShardedBackend, self).__init__(data_dir)
+        self.shard_dir = os.path.join(data_dir, 'shards')
+        self.num_shards = self.read_num_shards(num_shards)
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def read_num_shards(self, num_shards):
+        # use the number of shards the shards directory was created with
+        path = os.path.join(self.shard_dir, 'shards.json')
+        try:
+            with open(path) as f:
+                saved = int(json.load(f)['shards'])
+            if saved != num_shards:
+                log.warning("NBComet data has %d shards, ignoring the "
+                            "storage_shards setting of %d", saved, num_shards)
+            return saved
+        except (IOError, OSError, ValueError, KeyError):
+            create_dir(self.shard_dir)
+            atomic_write(path, json.dumps({'shards': num_shards}).encode())
+            return num_shards
+
+    def shard_index(self, key):
+        h = sha1(key.encode()).hexdigest()
+        return int(h[0:8], 16) % self.num_shards
+
+    def shard_path(self, i):
+        return os.path.join(self.shard_dir, 'actions-%d.db' % i)
+
+    def shard(self, key):
+        # get the single writer of a notebook's shard, opening it on first use
+        i = self.shard_index(key)
+        with self.lock:
+            shard = self.shards.get(i)
+            if shard is None:
+                shard = ShardManager('shard-%d' % i, self.shard_path(i))
+                self.shards[i] = shard
+            return shard
+
+    def open_actions(self, key):
+        create_dir(self.dest_dir(key))
+        create_dir(self.version_dir(key))
+        return self.shard(key).notebook(key)
+
+    def load_actions(self, rows_by_key, segment):
+        # one transaction per shard, with the rows of all its notebooks,
+        # through the shard's single writer
+        shards = {}
+        for key, rows in rows_by_key.items():
+            shard = self.shard(key)
+            shards.setdefault(shard.db_path, (shard, {}))[1][key] = rows
+        for path, (shard, shard_rows) in sorted(shards.items()):
+            shard.load_rows(shard_rows, segment)
+
+    def notebooks(self):
+        for db in self.action_databases():
+            # a notebook may only have archived actions left
+            keys = set()
+            for path in [db, archive_path(db)]:
+                if not os.path.isfile(path):
+                    continue
+                conn = sqlite3.connect(path)
+                try:
+                    keys.update(r[0] for r in conn.execute(
+                                'SELECT DISTINCT notebook FROM actions'))
+                finally:
+                    conn.close()
+            for key in sorted(keys):
+                yield key
+
+    def action_databases(self):
+        for i in range(self.num_shards):
+            db = self.shard_path(i)
+            if os.path.isfile(db):
+                yield db
+
+    def action_source(self, key):
+        return self.shard_path(self.shard_index(key)), key
+
+    def close(self):
+        with self.lock:
+            shards = list(self.shards.values())
+            self.shards = {}
+        for shard in shards:
+            shard.close()
+
+def create_backend(data_dir, config):
+    """
+    create the storage backend chosen in the Comet config
+
+    data_dir: (str) NBComet data directory
+    config: (dict) settings from the "Comet" section of the nbconfig
+    """
+    name = config.get('storage_backend', 'files')
+    if name == 'sharded':
+        return ShardedBackend(data_dir, int(config.get('storage_shards', 16)))
+    if name != 'files':
+        log.warning("NBComet has no storage backend %r, using 'files'", name)
+    return FileBackend(data_dir)
+
+def get_backend(data_dir=None):
+    """
+    get the shared storage backend of a data directory, created on first use
+    with the settings of the Comet config. Changing the backend takes a
+    restart, since notebooks already open keep writing to the old one.
+
+    data_dir: (str) NBComet data directory, the configured one if not given
+    """
+    data_dir = data_dir or find_storage_dir()
+    with backends_lock:
+        backend = backends.get(data_dir)
+        if backend is None:
+            backend = create_backend(data_dir, get_comet_config())
+            backends[data_dir] = backend
+        return backend
+
+backends = {}
+backends_lock = threading.Lock()
@@ -0,0 +1,108 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import nbformat
+
+class SnapshotCache(object):
+    """
+    Keep the last committed version of recently used notebooks in memory so
+    we only parse the stored snapshot from disk on a cache miss, or if the
+    file was changed by someone else since we cached it
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, dest_fname):
+        """
+        get the last committed notebook, or None if it was never saved
+
+        dest_fname: (str) full path to where the snapshot is saved on volume
+        """
+        entry = self._lookup(dest_fname, file_stamp(dest_fname))
+        if entry is None:
+            return None
+        return entry[1]
+
+    def get_with_index(self, dest_fname, build_index):
+        """
+        get the last committed notebook along with an index of its cells,
+        building the index only once per snapshot, or None if never saved
+
+        dest_fname: (str) full path to where the snapshot is saved on volume
+        build_index: (function) builds the index from a list of cells
+        """
+        entry = self._lookup(dest_fname, file_stamp(dest_fname))
+        if entry is None:
+            return None
+        if entry[2] is None:
+            entry[2] = build_index(entry[1]['cells'])
+        return entry[1], entry[2]
+
+    def _lookup(self, dest_fname, stamp):
+        # find a fresh cache entry, reading the snapshot from disk if needed
+        if stamp is None:
+            self.discard(dest_fname)
+            return None
+
+        with self.lock:
+            entry = self.entries.get(dest_fname)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(dest_fname)
+                return entry
+
+        nb = nbformat.read(dest_fname, nbformat.NO_CONVERT)
+        return self.put(dest_fname, nb, stamp)
+
+    def put(self, dest_fname, nb, stamp=None, index=None):
+        """
+        remember the notebook we just committed to disk
+
+        dest_fname: (str) full path to where the snapshot is saved on volume
+        nb: (dict) notebook that was written to dest_fname
+        stamp: (tuple) file stamp of dest_fname, looked up if not given
+        index: (object) index of the notebook's cells, if already built
+        """
+        if stamp is None:
+            stamp = file_stamp(dest_fname)
+            if stamp is None:
+                return None
+
+        entry = [stamp, nb, index]
+        with self.lock:
+            self.entries[dest_fname] = entry
+            self.entries.move_to_end(dest_fname)
+            while len(self.entries) > max(self.max_size, 0):
+                self.entries.popitem(last=False)
+        return entry
+
+    def discard(self, dest_fname):
+        # forget a snapshot, e.g. when it was removed from disk
+        with self.lock:
+            self.entries.pop(dest_fname, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def file_stamp(fname):
+    """
+    get the modification time and size of a file, or None if it does not exist
+
+    fname: (str) path to file
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+# cache of the last committed snapshot of each recently tracked notebook
+snapshot_cache = SnapshotCache()
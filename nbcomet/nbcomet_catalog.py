@@ -0,0 +1,337 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+A catalog of every tracked notebook, kept in one database at the root of the
+data directory and updated as actions are saved, so the history of a
+notebook (and the list of all notebooks) can be looked up without walking
+the data directory. Rebuild it from the data directory with:
+
+    python -m nbcomet.nbcomet_catalog [data_directory] --rebuild
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import posixpath
+
+from nbcomet.nbcomet_dir import find_storage_dir, VersionIndex, split_key
+from nbcomet.nbcomet_sqlite import action_counts, archive_path, db_writer
+from nbcomet.nbcomet_backend import get_backend
+
+log = logging.getLogger(__name__)
+
+CATALOG_FILE = 'catalog.db'
+
+# notebooks are keyed by their hashed directory and name, e.g. 1a2b3c4d/nb,
+# which is also where their history is stored in the data directory
+CATALOG_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS notebooks (key text PRIMARY KEY,
+        hashed_path text, name text, location text, first_time integer,
+        last_time integer, num_actions integer, num_versions integer,
+        last_activity real)''',
+    '''CREATE INDEX IF NOT EXISTS notebooks_last_activity
+        ON notebooks (last_activity)''',
+    # names the notebook was saved under, in order, with the time (in ms
+    # since epoch) it was first saved under each
+    '''CREATE TABLE IF NOT EXISTS names (key text, position integer,
+        name_key text, start_time integer, PRIMARY KEY (key, position))''',
+    '''CREATE INDEX IF NOT EXISTS names_name_key ON names (name_key)''']
+
+NOTEBOOK_COLUMNS = ['key', 'hashed_path', 'name', 'location', 'first_time',
+                    'last_time', 'num_actions', 'num_versions',
+                    'last_activity']
+
+def name_key(path):
+    """
+    get the catalog key of a notebook from its hashed path, as stored in the
+    comet_paths metadata of the notebook, e.g. 1a2b3c4d/nb.ipynb -> 1a2b3c4d/nb
+
+    path: (str) hashed directory and file name of the notebook
+    """
+    hashed_path, fname = posixpath.split(path.replace(os.sep, '/'))
+    return posixpath.join(hashed_path, os.path.splitext(fname)[0])
+
+class Catalog(object):
+    """
+    The catalog database of one data directory, written through a single
+    connection shared by the threads saving notebooks. Activity is queued
+    and written by the DbWriter along with the actions, so saving a batch of
+    actions doesn't write the catalog too; reads write what is queued first.
+    """
+
+    def __init__(self, data_dir, writer=None):
+        self.data_dir = data_dir
+        self.path = self.db_path = os.path.join(data_dir, CATALOG_FILE)
+        self.writer = writer if writer is not None else db_writer
+        self.lock = threading.Lock()
+        self.conn = None
+        # key -> [first_time, last_time, num_actions, num_versions,
+        # last_activity] of the activity not yet written
+        self.queue = {}
+        self.queue_lock = threading.Lock()
+
+    def connect(self):
+        # open the connection and create the tables on first use
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                    check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in CATALOG_TABLES:
+                conn.execute(statement)
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def record_activity(self, key, first_time, last_time, num_actions=0,
+                        num_versions=0):
+        """
+        queue saved actions and versions to add to a notebook's entry,
+        creating it if needed
+
+        key: (str) hashed directory and name of the notebook
+        first_time: (int) time of the first action saved, in ms since epoch
+        last_time: (int) time of the last action saved, in ms since epoch
+        num_actions: (int) number of actions saved
+        num_versions: (int) number of versions saved
+        """
+        with self.queue_lock:
+            if not self.queue:
+                self.writer.register(self)
+            add_activity(self.queue, key, [first_time, last_time, num_actions,
+                                            num_versions, time.time()])
+
+    def commit_queue(self):
+        # write the queued activity, in one transaction
+        with self.lock:
+            with self.queue_lock:
+                queue = self.queue
+                self.queue = {}
+            if not queue:
+                return
+            conn = self.connect()
+            try:
+                with conn:
+                    for key, activity in sorted(queue.items()):
+                        hashed_path, fname = split_key(key)
+                        # sqlite before 3.24 has no upsert
+                        conn.execute('''INSERT OR IGNORE INTO notebooks
+                            VALUES (?,?,?,?,?,?,0,0,?)''',
+                            (key, hashed_path, fname, key, activity[0],
+                            activity[1], activity[4]))
+                        conn.execute('''UPDATE notebooks SET
+                            first_time = MIN(first_time, ?),
+                            last_time = MAX(last_time, ?),
+                            num_actions = num_actions + ?,
+                            num_versions = num_versions + ?,
+                            last_activity = ? WHERE key = ?''',
+                            tuple(activity) + (key,))
+            except:
+                # queue the activity again, so it is retried on the next flush
+                with self.queue_lock:
+                    for key, activity in queue.items():
+                        add_activity(self.queue, key, activity)
+                raise
+
+    def remove_versions(self, key, num_versions):
+        """
+        take versions removed by retention off a notebook's entry
+
+        key: (str) hashed directory and name of the notebook
+        num_versions: (int) number of versions removed
+        """
+        self.commit_queue()
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('''UPDATE notebooks SET num_versions =
+                    MAX(num_versions - ?, 0) WHERE key = ?''',
+                    (num_versions, key))
+
+    def record_names(self, key, names):
+        """
+        replace the names a notebook was saved under
+
+        key: (str) hashed directory and name of the notebook
+        names: (list) [name key, time first saved under it] of each name,
+            in order, see name_key
+        """
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('DELETE FROM names WHERE key = ?', (key,))
+                conn.executemany('INSERT INTO names VALUES (?,?,?,?)',
+                                [(key, i, n, int(t))
+                                for i, (n, t) in enumerate(names)])
+
+    def get(self, key):
+        """
+        get a notebook's entry as a dict, or None if it is not in the catalog
+
+        key: (str) hashed directory and name of the notebook
+        """
+        self.commit_queue()
+        with self.lock:
+            row = self.connect().execute('SELECT * FROM notebooks WHERE key = ?',
+                                        (key,)).fetchone()
+        return dict(zip(NOTEBOOK_COLUMNS, row)) if row else None
+
+    def prior_names(self, key):
+        """
+        get the names a notebook was saved under, or None if the catalog has
+        none for it
+        returns [[name key, start time, end time], ...], see
+        get_prior_filenames
+
+        key: (str) hashed directory and name of the notebook
+        """
+        with self.lock:
+            rows = self.connect().execute('''SELECT name_key, start_time
+                FROM names WHERE key = ? ORDER BY position''',
+                (key,)).fetchall()
+        if not rows:
+            return None
+
+        # each name is used until the next one is first used
+        now = int(time.time() * 1000)
+        return [[n, t, rows[i + 1][1] if i + 1 < len(rows) else now]
+                for i, (n, t) in enumerate(rows)]
+
+    def notebooks(self, limit=None):
+        """
+        get the entries of all notebooks, most recently active first
+
+        limit: (int) maximum number of entries
+        """
+        self.commit_queue()
+        with self.lock:
+            rows = self.connect().execute('''SELECT * FROM notebooks
+                ORDER BY last_activity DESC LIMIT ?''',
+                (limit if limit is not None else -1,)).fetchall()
+        return [dict(zip(NOTEBOOK_COLUMNS, r)) for r in rows]
+
+    def close(self):
+        self.writer.unregister(self)
+        self.commit_queue()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+def add_activity(queue, key, activity):
+    # merge activity into a notebook's queued activity, see Catalog.queue
+    queued = queue.get(key)
+    if queued is None:
+        queue[key] = list(activity)
+    else:
+        queue[key] = [min(queued[0], activity[0]), max(queued[1], activity[1]),
+                    queued[2] + activity[2], queued[3] + activity[3],
+                    max(queued[4], activity[4])]
+
+def get_catalog(data_dir):
+    """
+    get the shared catalog of a data directory
+
+    data_dir: (str) NBComet data directory
+    """
+    with catalogs_lock:
+        catalog = catalogs.get(data_dir)
+        if catalog is None:
+            catalog = Catalog(data_dir)
+            catalogs[data_dir] = catalog
+        return catalog
+
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+def names_from_metadata(nb, key):
+    """
+    get the names a notebook was saved under from its comet_paths metadata
+    returns [[name key, time first saved under it], ...], see name_key
+
+    nb: (dict) notebook JSON
+    key: (str) hashed directory and name of the notebook
+    """
+    paths = nb.get('metadata', {}).get('comet_paths')
+    if not paths:
+        return [[key, 0]]
+    return [[name_key(p), t] for p, t in paths]
+
+def rebuild_catalog(data_dir, backend=None):
+    """
+    fill the catalog from the databases, versions, and latest snapshots in
+    the data directory, e.g. for data saved before there was a catalog
+    returns the number of notebooks cataloged
+
+    data_dir: (str) NBComet data directory
+    backend: (StorageBackend) storage holding the notebooks, the configured
+        one if not given
+    """
+    backend = backend if backend is not None else get_backend(data_dir)
+    catalog = get_catalog(data_dir)
+    catalog.commit_queue()
+    conn = catalog.connect()
+    num_notebooks = 0
+    for key in backend.notebooks():
+        db, shard_key = backend.action_source(key)
+        try:
+            # count the archived actions too, as they were when recorded
+            counts = [action_counts(path, shard_key)
+                        for path in [db, archive_path(db)]
+                        if os.path.isfile(path)]
+        except sqlite3.Error:
+            log.warning("NBComet could not read the actions of %s", key)
+            continue
+        num_actions = sum(c[0] for c in counts)
+        times = [t for c in counts for t in c[1:] if t is not None]
+        first_time = min(times) if times else 0
+        last_time = max(times) if times else 0
+
+        version_dir = backend.version_dir(key)
+        num_versions = 0
+        if os.path.isdir(version_dir):
+            num_versions = len(VersionIndex(version_dir).all())
+
+        names = [[key, 0]]
+        try:
+            snapshot = backend.read_snapshot(key, lambda cells: None)
+            if snapshot is not None:
+                names = names_from_metadata(snapshot[0], key)
+        except Exception:
+            log.warning("NBComet could not read the snapshot of %s", key)
+
+        with catalog.lock:
+            with conn:
+                conn.execute('DELETE FROM notebooks WHERE key = ?', (key,))
+        catalog.record_activity(key, first_time, last_time, num_actions,
+                                num_versions)
+        catalog.commit_queue()
+        catalog.record_names(key, names)
+        num_notebooks += 1
+    return num_notebooks
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="List the notebooks tracked by NBComet")
+    parser.add_argument('data_dir', nargs='?', default=None,
+        help="NBComet data directory (default: the configured directory)")
+    parser.add_argument('--rebuild', action='store_true',
+        help="rebuild the catalog from the data directory first")
+    parser.add_argument('--limit', type=int, default=None,
+        help="only list this many of the most recently active notebooks")
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or find_storage_dir()
+    if args.rebuild:
+        print("%d notebooks cataloged" % rebuild_catalog(data_dir))
+    for e in get_catalog(data_dir).notebooks(args.limit):
+        print("%s\t%d actions\t%d versions\tlast active %s" % (e['key'],
+            e['num_actions'], e['num_versions'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_activity']))))
+
+if __name__ == '__main__':
+    sys.exit(main())
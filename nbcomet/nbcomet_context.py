@@ -0,0 +1,133 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import os
+import time
+import logging
+import threading
+
+from nbcomet.nbcomet_dir import find_storage_dir, hash_path
+from nbcomet.nbcomet_delta import DeltaState
+from nbcomet.nbcomet_encoding import DiffEncoder
+from nbcomet.nbcomet_backend import get_backend
+from nbcomet.nbcomet_ingest import ingest_pipeline
+
+log = logging.getLogger(__name__)
+
+class TrackingContext(object):
+    """
+    Everything needed to track one notebook: its key in the storage backend,
+    its open action writer, the state used to rebuild posted deltas, and
+    the encoder that stores its edited sources as deltas.
+    Storage is set up once, when the context is created.
+    """
+
+    def __init__(self, data_dir, os_dir, fname, file_ext='.ipynb',
+                    backend=None):
+        # we hash the path for a private, short, and unique identifier
+        self.data_dir = data_dir
+        self.hashed_path = hash_path(os_dir)
+        self.fname = fname
+        self.file_ext = file_ext
+        self.key = self.hashed_path + '/' + fname
+        self.hashed_full_path = os.path.join(self.hashed_path,
+                                            fname + file_ext)
+
+        self.backend = backend if backend is not None else get_backend(data_dir)
+        self.db_manager = self.backend.open_actions(self.key)
+        self.delta_state = DeltaState()
+        self.diff_encoder = DiffEncoder()
+        self.last_used = time.time()
+
+        # actions recorded since the last version, to bound replay lengths
+        self.actions_since_version = 0
+
+        # time of the latest action saved, to tell batches that arrive late
+        self.last_action_time = None
+
+        # names last recorded in the catalog, see update_catalog
+        self.catalog_names = None
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def close(self):
+        # write queued actions and release the database connection
+        self.backend.close_notebook(self.key)
+        self.db_manager.close()
+
+class ContextRegistry(object):
+    """
+    Tracking contexts of the notebooks in use, closing (and flushing) the
+    ones that have not been used for a while so long-running servers don't
+    keep every notebook they ever saw open
+    """
+
+    def __init__(self, idle_timeout=3600, is_busy=None):
+        self.idle_timeout = idle_timeout
+        self.is_busy = is_busy
+        self.contexts = {}
+        self.lock = threading.Lock()
+
+    def get(self, os_path):
+        """
+        get the context of a notebook, creating it on first use
+
+        os_path: (str) path to notebook as saved on the operating system
+        """
+        data_dir = find_storage_dir()
+        key = (data_dir, os_path)
+        with self.lock:
+            context = self.contexts.get(key)
+            if context is None:
+                os_dir, fname = os.path.split(os_path)
+                fname, file_ext = os.path.splitext(fname)
+                context = TrackingContext(data_dir, os_dir, fname, file_ext)
+                self.contexts[key] = context
+            context.touch()
+            return context
+
+    def find(self, os_path):
+        """
+        get the context of a notebook if it is open, without creating one
+
+        os_path: (str) path to notebook as saved on the operating system
+        """
+        with self.lock:
+            return self.contexts.get((find_storage_dir(), os_path))
+
+    def evict_idle(self, now=None):
+        """
+        close the contexts that were idle for longer than the idle timeout
+        returns the number of contexts closed
+
+        now: (float) current time, in seconds since epoch
+        """
+        now = now if now is not None else time.time()
+        with self.lock:
+            idle = [(k, c) for k, c in self.contexts.items()
+                    if now - c.last_used > self.idle_timeout
+                    and not (self.is_busy and self.is_busy(c.key))]
+            for k, c in idle:
+                del self.contexts[k]
+
+        for k, c in idle:
+            try:
+                c.close()
+            except Exception:
+                log.exception("NBComet could not close %s", c.key)
+        return len(idle)
+
+    def close_all(self):
+        with self.lock:
+            contexts = list(self.contexts.values())
+            self.contexts = {}
+        for c in contexts:
+            c.close()
+
+    def __len__(self):
+        return len(self.contexts)
+
+# contexts of the notebooks tracked by this server
+context_registry = ContextRegistry(is_busy=ingest_pipeline.is_busy)
@@ -0,0 +1,121 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import uuid
+import threading
+
+class DeltaState(object):
+    """
+    Track the last notebook model each client revision refers to, so clients
+    can post only the cells that changed since their last acknowledged
+    revision instead of the full notebook
+
+    Revisions are assigned on the IOLoop when a request is accepted, while
+    models are rebuilt later, in order, by the ingest pipeline. A revision
+    is only valid for the server process that assigned it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = uuid.uuid4().hex[0:8]
+        self.counter = 0
+        self.revision = None
+        self.model = None
+
+    def next_revision(self, base_revision=None):
+        """
+        accept a request and assign it a new revision
+        returns None if the request is a delta from a revision we don't have
+
+        base_revision: (str) revision a delta was computed against, or None
+            for a full upload
+        """
+        with self.lock:
+            if base_revision is not None and base_revision != self.revision:
+                return None
+            self.counter += 1
+            self.revision = "%s-%d" % (self.epoch, self.counter)
+            return self.revision
+
+    def invalidate(self):
+        # make clients send their next action as a full upload
+        with self.lock:
+            self.revision = None
+
+    def apply(self, action_data):
+        """
+        get the full action data for an accepted request, rebuilding the
+        model from the last one we saw if the client sent a delta
+
+        action_data: (dict) action data with either a model or a delta
+        """
+        with self.lock:
+            try:
+                if 'delta' in action_data:
+                    if self.model is None:
+                        raise ValueError("No base model to apply delta to")
+                    action_data = dict(action_data)
+                    action_data['model'] = apply_delta(self.model,
+                                                        action_data.pop('delta'))
+                self.model = action_data['model']
+            except Exception:
+                # we can't trust our base model anymore, ask for a full upload
+                self.revision = None
+                self.model = None
+                raise
+        return action_data
+
+def rebuild_batch(actions):
+    """
+    get the full action data of a batch that starts with a full upload,
+    rebuilding each delta from the action before it without touching the
+    delta state, which requests still in flight may rely on
+
+    actions: (list) action data with either a model or a delta, in order
+    """
+    model = None
+    rebuilt = []
+    for action_data in actions:
+        if 'delta' in action_data:
+            if model is None:
+                raise ValueError("No base model to apply delta to")
+            action_data = dict(action_data)
+            action_data['model'] = apply_delta(model, action_data.pop('delta'))
+        model = action_data['model']
+        rebuilt.append(action_data)
+    return rebuilt
+
+def apply_delta(base_model, delta):
+    """
+    rebuild a notebook model from the model it was computed against
+
+    base_model: (dict) notebook JSON at the delta's base revision
+    delta: (dict) delta in the form of
+        cells: (dict) cells that changed, keyed by comet_cell_id
+        cell_order: (list) comet_cell_ids of all cells in the new notebook
+        metadata: (dict) notebook metadata
+        nbformat: (int) major notebook format version
+        nbformat_minor: (int) minor notebook format version
+    """
+    base_cells = {}
+    for c in base_model['cells']:
+        cell_id = c['metadata'].get('comet_cell_id')
+        if cell_id is not None:
+            base_cells[cell_id] = c
+
+    changed = delta.get('cells', {})
+    cells = []
+    for cell_id in delta['cell_order']:
+        if cell_id in changed:
+            cells.append(changed[cell_id])
+        elif cell_id in base_cells:
+            cells.append(base_cells[cell_id])
+        else:
+            raise ValueError("Delta refers to unknown cell %s" % cell_id)
+
+    return {'cells': cells,
+            'metadata': delta.get('metadata', base_model['metadata']),
+            'nbformat': delta.get('nbformat', base_model['nbformat']),
+            'nbformat_minor': delta.get('nbformat_minor',
+                                        base_model['nbformat_minor'])}
@@ -2,54 +2,69 @@
 NBComet: Jupyter Notebook extension to track full notebook history
 """
 
-import os
-import nbformat
+import json
+from hashlib import sha1
+
+from nbcomet.nbcomet_cache import snapshot_cache
 
 # TODO see if we can use nbdime to do diff, or continue using our own code
 
-def get_nb_diff(action_data, dest_fname, compare_outputs = False):
+def get_nb_diff(action_data, dest_fname, compare_outputs = False,
+                index_b = None):
     """
     find diff between two notebooks
 
     action_data: (dict) new notebook data to compare
     dest_fname: (str) name of file to compare to
     compare_outputs: (bool) compare cell outputs, or just the sources
+    index_b: (CellIndex) index of the new notebook's cells, if already built
+    """
+
+    # use the last committed notebook, only reading it from disk if needed
+    prior = snapshot_cache.get_with_index(dest_fname, CellIndex)
+    return diff_against(prior, action_data, compare_outputs, index_b)
+
+def diff_against(prior, action_data, compare_outputs = False, index_b = None):
+    """
+    find diff between a notebook and the one before it
+
+    prior: (tuple) prior notebook and its CellIndex, or None if there is none
+    action_data: (dict) new notebook data to compare
+    compare_outputs: (bool) compare cell outputs, or just the sources
+    index_b: (CellIndex) index of the new notebook's cells, if already built
     """
 
+    nb_b = action_data['model']['cells']
+    if index_b is None:
+        index_b = CellIndex(nb_b)
+
     # don't even compare if the old version of the notebook does not exist
-    if not os.path.isfile(dest_fname):
+    if prior is None:
         diff = {}
-        cell_order = []
-
-        nb_b = action_data['model']['cells']
-        if valid_ids([], nb_b):
-            cell_order = [c['metadata']['comet_cell_id'] for c in nb_b]
+        if index_b.ids is not None:
+            cell_order = list(index_b.ids)
         else:
             cell_order = list(range(len(nb_b)))
         return diff, cell_order
 
-    nb_a = nbformat.read(dest_fname, nbformat.NO_CONVERT)['cells']
-    nb_b = action_data['model']['cells']
+    prior_nb, index_a = prior
+    nb_a = prior_nb['cells']
     diff = {}
     cell_order = []
 
     # either use a diff method based on cell ids
-    if valid_ids(nb_a, nb_b):
-        nb_a_cell_ids = [c['metadata']['comet_cell_id'] for c in nb_a]
-        nb_b_cell_ids = [c['metadata']['comet_cell_id'] for c in nb_b]
-        cell_order = nb_b_cell_ids
+    if index_a.ids is not None and index_b.ids is not None:
+        cell_order = list(index_b.ids)
 
-        for i in nb_b_cell_ids:
+        for j, i in enumerate(index_b.ids):
             # if it is a cell id seen in prior nb, check if contents changed
-            if i in nb_a_cell_ids:
-                # get the old and new cell contents
-                cell_a = nb_a[nb_a_cell_ids.index(i)]
-                cell_b = nb_b[nb_b_cell_ids.index(i)]
-                if cells_different(cell_a, cell_b, compare_outputs):
-                    diff[i] = cell_b
+            k = index_a.positions.get(i)
+            if k is not None:
+                if index_a.different(k, index_b, j, compare_outputs):
+                    diff[i] = nb_b[j]
             # the cell is entirely new, so it is part of the diff
             else:
-                diff[i] = nb_b[nb_b_cell_ids.index(i)]
+                diff[i] = nb_b[j]
 
     # or if no cell ids, rely on more targeted method based on type of action
     else:
@@ -60,20 +75,60 @@ def get_nb_diff(action_data, dest_fname, compare_outputs = False):
 
         check_indices = indices_to_check(action, selected_index,
                                         selected_indices, nb_a, nb_b)
-        for i in check_indices:
+        for i in check_indices or []:
             # don't compare cells that don't exist in the current notebook
             if i >= len(nb_b):
                 continue
             # if its a new cell at the end of the nb, it is part of the diff
             elif i >= len(nb_a):
                 diff[i] = nb_b[i]
-            else:
-                cell_a = nb_a[i]
-                cell_b = nb_b[i]
-                if cells_different(cell_a, cell_b, compare_outputs):
-                    diff[i] = cell_b
+            elif index_a.different(i, index_b, i, compare_outputs):
+                diff[i] = nb_b[i]
     return diff, cell_order
 
+class CellIndex(object):
+    """
+    Cell ids, positions, and content digests of one notebook snapshot, built
+    once so diffing two snapshots takes time linear in the number of cells
+    """
+
+    def __init__(self, cells):
+        self.cells = cells
+        self.ids = cell_ids(cells)
+        self.positions = {}
+        if self.ids is not None:
+            self.positions = dict((c, i) for i, c in enumerate(self.ids))
+        self.digests = [cell_digests(c) for c in cells]
+
+    def different(self, i, other, j, compare_outputs):
+        """
+        check if cell i of this snapshot differs from cell j of another
+
+        i: (int) position of the cell in this snapshot
+        other: (CellIndex) index of the snapshot to compare to
+        j: (int) position of the cell in the other snapshot
+        compare_outputs: (bool) compare cell outputs, or just the sources
+        """
+        return digests_different(self.digests[i], other.digests[j],
+                                compare_outputs)
+
+def cell_ids(cells):
+    """
+    get the comet cell ids of a list of cells, or None if any cell is missing
+    an id or two cells share the same id
+
+    cells: (list) cells of a notebook
+    """
+    ids = []
+    seen = set()
+    for c in cells:
+        cell_id = c["metadata"].get("comet_cell_id")
+        if cell_id is None or cell_id in seen:
+            return None
+        seen.add(cell_id)
+        ids.append(cell_id)
+    return ids
+
 def valid_ids(nb_a, nb_b):
     """
     Ensure each notebook we are comparing has a full set of unique cell ids
@@ -81,57 +136,60 @@ def valid_ids(nb_a, nb_b):
     nb_a: (dict) one notebook to compare
     nb_b: (dict) the other notebook to compare
     """
+    return cell_ids(nb_a) is not None and cell_ids(nb_b) is not None
 
-    prior_a_ids = []
-    prior_b_ids = []
+def cell_digests(cell):
+    """
+    fingerprint the parts of a cell that we compare when diffing
+    returns (source digest, output digest), where the output digest is None
+    for cells that are not code cells
 
-    for c in nb_a:
-        if "comet_cell_id" not in c["metadata"]:
-            return False
-        elif c["metadata"]["comet_cell_id"] in prior_a_ids:
-            return False
-        else:
-            prior_a_ids.append(c["metadata"]["comet_cell_id"])
+    cell: (dict) notebook cell
+    """
+    source = join_lines(cell["source"])
+    h = sha1(cell["cell_type"].encode("utf-8"))
+    h.update(b"\0")
+    h.update(source.encode("utf-8"))
+    source_digest = h.hexdigest()
+
+    output_digest = None
+    if cell["cell_type"] == "code":
+        # only the type and the data, text, or error value of each output
+        # count as a change, not e.g. execution counts or output metadata
+        outs = []
+        for o in cell.get("outputs", []):
+            out_type = o["output_type"]
+            if out_type in ["display_data", "execute_result"]:
+                data = dict((k, join_lines(v))
+                            for k, v in o.get("data", {}).items())
+                outs.append([out_type, data])
+            elif out_type == "stream":
+                outs.append([out_type, join_lines(o.get("text", ""))])
+            elif out_type == "error":
+                outs.append([out_type, o.get("evalue")])
+            else:
+                outs.append([out_type])
+        output_digest = sha1(json.dumps(outs, sort_keys=True)
+                            .encode("utf-8")).hexdigest()
 
-    for c in nb_b:
-        if "comet_cell_id" not in c["metadata"]:
-            return False
-        elif c["metadata"]["comet_cell_id"] in prior_b_ids:
-            return False
-        else:
-            prior_b_ids.append(c["metadata"]["comet_cell_id"])
+    return source_digest, output_digest
 
-    return True
+def join_lines(text):
+    # multiline strings may be stored either as one string or a list of lines
+    if isinstance(text, list):
+        return "".join(text)
+    return text
 
-def cells_different(cell_a, cell_b, compare_outputs):
+def digests_different(digests_a, digests_b, compare_outputs):
     # check if cell type or source is different
-    if (cell_a["cell_type"] != cell_b["cell_type"]
-        or cell_a["source"] != cell_b["source"]):
+    if digests_a[0] != digests_b[0]:
         return True
-
     # otherwise compare outputs if it is a code cell
-    elif compare_outputs and cell_b["cell_type"] == "code":
-        # get the outputs
-        cell_a_outs = cell_a['outputs']
-        cell_b_outs = cell_b['outputs']
-        # if different number of outputs, the cell has changed
-        if len(cell_a_outs) != len(cell_b_outs):
-            return True
-        # compare the outputs one by one
-        for j in range(len(cell_b_outs)):
-            # check that the output type matches
-            if cell_b_outs[j]['output_type'] != cell_a_outs[j]['output_type']:
-                return True
-            # and that the relevant data matches
-            elif((cell_a_outs[j]['output_type'] in ["display_data","execute_result"]
-                and cell_a_outs[j]['data'] != cell_b_outs[j]['data'])
-                or (cell_a_outs[j]['output_type'] == "stream"
-                and cell_a_outs[j]['text'] != cell_b_outs[j]['text'])
-                or (cell_a_outs[j]['output_type'] == "error"
-                and cell_a_outs[j]['evalue'] != cell_b_outs[j]['evalue'])):
-                return True
-
-    return False
+    return compare_outputs and digests_a[1] != digests_b[1]
+
+def cells_different(cell_a, cell_b, compare_outputs):
+    return digests_different(cell_digests(cell_a), cell_digests(cell_b),
+                            compare_outputs)
 
 def indices_to_check(action, selected_index, selected_indices, nb_a, nb_b):
     """
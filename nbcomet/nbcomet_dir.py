@@ -4,27 +4,67 @@ NBComet: Jupyter Notebook extension to track full notebook history
 
 import os
 import json
+import time
+import bisect
 import datetime
+import threading
+import posixpath
 from hashlib import sha1
 
+from nbcomet.nbcomet_cache import file_stamp
+
 # TODO write function docstrings
 # TODO enable use on Windows machines (check directory structure)
 
+# versions are saved as <fname>-<date>.<ext>, where the extension depends on
+# whether a full notebook or a manifest of deduplicated cells was saved
+VERSION_TIME_FORMAT = "%Y-%m-%d-%H-%M-%S-%f"
+VERSION_EXTENSIONS = ['.ipynb', '.manifest']
+
+# each versions directory has an append-only index of the versions it holds
+VERSION_INDEX = 'index.jsonl'
+
+def get_comet_config():
+    """
+    Read the "Comet" section of the notebook config, returning an empty dict
+    if the config file or the section is missing. The file is only parsed
+    again when its modification time or size changes.
+    """
+    filename = os.path.expanduser('~/.jupyter/nbconfig/notebook.json')
+    stamp = file_stamp(filename)
+    with config_cache_lock:
+        if config_cache.get('filename') == filename and \
+                config_cache.get('stamp') == stamp:
+            return dict(config_cache['config'])
+
+        config = {}
+        if stamp is not None:
+            with open(filename) as data_file:
+                try:
+                    data = json.load(data_file)
+                    config = dict(data["Comet"])
+                except:
+                    pass
+        config_cache.update(filename=filename, stamp=stamp, config=config)
+        return dict(config)
+
+config_cache = {}
+config_cache_lock = threading.Lock()
+
 def find_storage_dir():
     storage_dir = default_storage_dir()
-    filename = os.path.expanduser('~/.jupyter/nbconfig/notebook.json')
-    if os.path.isfile(filename):
-        with open(filename) as data_file:
-            data = json.load(data_file)
-            try:
-                if data["Comet"]["data_directory"]:
-                    storage_dir = data["Comet"]["data_directory"]
-            except:
-                pass
-    if not os.path.exists(storage_dir):
-        create_dir(storage_dir)
+    config = get_comet_config()
+    if config.get("data_directory"):
+        storage_dir = config["data_directory"]
+    if storage_dir not in created_dirs:
+        if not os.path.exists(storage_dir):
+            create_dir(storage_dir)
+        created_dirs.add(storage_dir)
     return storage_dir
 
+# storage directories we already made sure exist
+created_dirs = set()
+
 def default_storage_dir():
     return os.path.expanduser('~/.jupyter/nbcomet')
 
@@ -40,19 +80,269 @@ def was_saved_recently(version_dir, min_time=300):
     version_dir: (str) dir to look for previous versions
     min_time: (int) minimum time in seconds allowed between saves """
 
-    versions = [f for f in os.listdir(version_dir)
-        if os.path.isfile(os.path.join(version_dir, f))
-        and f[-6:] == '.ipynb']
-    if len(versions) > 0:
-        vdir, vname = os.path.split(versions[-1])
-        vname, vext = os.path.splitext(vname)
-        last_time_saved = datetime.datetime.strptime(vname[-26:],
-            "%Y-%m-%d-%H-%M-%S-%f")
-        delta = (datetime.datetime.now() - last_time_saved).seconds
+    last = get_version_index(version_dir).last()
+    if last is not None:
+        delta = time.time() - last['time']
         return delta <= min_time
     else:
         return False
 
+class VersionIndex(object):
+    """
+    Index of the versions saved in one versions directory, kept in memory
+    and in an append-only file, so we never have to list the directory or
+    parse version file names to find versions in a time range
+
+    Each entry holds the time the version was saved (in seconds since
+    epoch), its file name, its size in bytes, and its number of cells.
+    Versions saved by the server extension also hold the time of the action
+    they reflect (in ms since epoch, as in the action database), so they can
+    serve as keyframes to replay actions from. The entries are also kept
+    sorted by that time, to find keyframes without going over every version.
+    """
+
+    def __init__(self, version_dir):
+        self.version_dir = version_dir
+        self.path = os.path.join(version_dir, VERSION_INDEX)
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.set_entries([])
+
+    def set_entries(self, entries):
+        # keep the entries sorted by time, and by the time of their action
+        self.entries = entries
+        self.times = [e['time'] for e in entries]
+        self.keyframes = sorted(entries, key=keyframe_time)
+        self.keyframe_times = [keyframe_time(e) for e in self.keyframes]
+
+    def refresh(self):
+        # reload the index if another process changed it, or build it from
+        # the directory if it does not exist yet
+        stamp = file_stamp(self.path)
+        if stamp is not None and stamp == self.stamp:
+            return
+        if stamp is None:
+            # only look again once something changed in the directory
+            dir_stamp = ('scanned', file_stamp(self.version_dir))
+            if dir_stamp == self.stamp:
+                return
+            entries = scan_versions(self.version_dir)
+            if entries:
+                self.write(entries)
+            else:
+                self.set_entries(entries)
+                self.stamp = dir_stamp
+                return
+        else:
+            entries = []
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        pass # skip partially written lines
+            entries.sort(key=lambda e: e['time'])
+        self.set_entries(entries)
+        self.stamp = file_stamp(self.path)
+
+    def write(self, entries):
+        """
+        replace the index, e.g. after versions were removed
+
+        entries: (list) all index entries, sorted by time
+        """
+        # imported here, since nbcomet_store imports this module
+        from nbcomet.nbcomet_store import atomic_write
+        atomic_write(self.path, ''.join(json.dumps(e) + '\n'
+                                        for e in entries).encode('utf-8'),
+                    fsync=True)
+
+    def add(self, filename, size=0, num_cells=0, action_time=None):
+        """
+        add a newly saved version to the index
+
+        filename: (str) name of the version file
+        size: (int) size of the version file in bytes
+        num_cells: (int) number of cells in the version
+        action_time: (int) time of the last action the version reflects, in
+            ms since epoch
+        """
+        entry = {'time': to_timestamp(version_time(filename)),
+                'file': filename,
+                'size': size,
+                'cells': num_cells}
+        if action_time is not None:
+            entry['action_time'] = action_time
+        with self.lock:
+            self.refresh()
+            # a freshly built index may already include the new version
+            for e in self.entries:
+                if e['file'] == filename:
+                    e.update(entry)
+                    self.set_entries(self.entries)
+                    self.write(self.entries)
+                    self.stamp = file_stamp(self.path)
+                    return e
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            i = bisect.bisect_right(self.times, entry['time'])
+            self.entries.insert(i, entry)
+            self.times.insert(i, entry['time'])
+            i = bisect.bisect_right(self.keyframe_times, keyframe_time(entry))
+            self.keyframes.insert(i, entry)
+            self.keyframe_times.insert(i, keyframe_time(entry))
+            self.stamp = file_stamp(self.path)
+        return entry
+
+    def remove(self, filenames):
+        """
+        drop versions from the index, before their files are deleted
+        returns the entries that were removed
+
+        filenames: (list) names of the version files to drop
+        """
+        filenames = set(filenames)
+        with self.lock:
+            self.refresh()
+            removed = [e for e in self.entries if e['file'] in filenames]
+            if removed:
+                self.set_entries([e for e in self.entries
+                                    if e['file'] not in filenames])
+                self.write(self.entries)
+                self.stamp = file_stamp(self.path)
+        return removed
+
+    def all(self):
+        with self.lock:
+            self.refresh()
+            return list(self.entries)
+
+    def last(self):
+        # get the most recently saved version, or None if there are none
+        with self.lock:
+            self.refresh()
+            return self.entries[-1] if self.entries else None
+
+    def between(self, start_time, end_time):
+        """
+        get the versions saved in a time range, inclusive
+
+        start_time: (float) start of the range, in seconds since epoch
+        end_time: (float) end of the range, in seconds since epoch
+        """
+        with self.lock:
+            self.refresh()
+            i = bisect.bisect_left(self.times, start_time)
+            j = bisect.bisect_right(self.times, end_time)
+            return self.entries[i:j]
+
+    def keyframe(self, t):
+        """
+        find the version reflecting the last action at or before a point in
+        time, the last saved if several do, or None if there is none
+
+        t: (int) point in time, in ms since epoch
+        """
+        with self.lock:
+            self.refresh()
+            i = bisect.bisect_right(self.keyframe_times, t)
+            return self.keyframes[i - 1] if i else None
+
+def keyframe_time(entry):
+    # time of the last action a version reflects, in ms since epoch, which
+    # versions saved before keyframes were indexed approximate by the time
+    # the version was saved
+    return entry.get('action_time', int(entry['time'] * 1000))
+
+def scan_versions(version_dir):
+    """
+    build index entries for the versions in a directory, used once for
+    directories saved before the index existed
+
+    version_dir: (str) dir to look for versions
+    """
+    entries = []
+    if not os.path.isdir(version_dir):
+        return entries
+    for f in os.listdir(version_dir):
+        path = os.path.join(version_dir, f)
+        if os.path.isfile(path) and is_version_file(f):
+            try:
+                t = to_timestamp(version_time(f))
+            except ValueError:
+                continue
+            entries.append({'time': t, 'file': f,
+                            'size': os.path.getsize(path), 'cells': None})
+    entries.sort(key=lambda e: e['time'])
+    return entries
+
+def to_timestamp(dt):
+    # seconds since epoch of a naive local datetime, like time.time()
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+def get_version_index(version_dir):
+    """
+    get the shared, cached index of a versions directory
+
+    version_dir: (str) dir holding the versions
+    """
+    with version_indices_lock:
+        index = version_indices.get(version_dir)
+        if index is None:
+            index = VersionIndex(version_dir)
+            version_indices[version_dir] = index
+        return index
+
+def forget_version_index(version_dir):
+    # drop a cached index, e.g. when its notebook is no longer in use
+    with version_indices_lock:
+        version_indices.pop(version_dir, None)
+
+version_indices = {}
+version_indices_lock = threading.Lock()
+
+def is_version_file(filename):
+    # check if a file in the versions directory is a saved version
+    return os.path.splitext(filename)[1] in VERSION_EXTENSIONS
+
+def version_time(filename):
+    """
+    get the time a version was saved from its file name
+
+    filename: (str) name or path of a saved version
+    """
+    vname = os.path.splitext(os.path.basename(filename))[0]
+    return datetime.datetime.strptime(vname[-26:], VERSION_TIME_FORMAT)
+
+def version_name(filename):
+    """
+    get the name of the notebook a version was saved from
+
+    filename: (str) name or path of a saved version
+    """
+    vname = os.path.splitext(os.path.basename(filename))[0]
+    return vname[0:-27] + '.ipynb'
+
+def split_key(key):
+    # get the hashed directory and name of a notebook from its key, e.g.
+    # 1a2b3c4d/nb -> (1a2b3c4d, nb)
+    return posixpath.split(key)
+
+def find_databases(data_dir):
+    """
+    lazily find the action databases of the "files" storage backend in the
+    data directory
+
+    data_dir: (str) NBComet data directory
+    """
+    for root, dirs, files in os.walk(data_dir):
+        # don't descend into the (possibly huge) version directories
+        dirs[:] = sorted(d for d in dirs if d != 'versions')
+        # each notebook's database is named after its storage directory
+        for f in sorted(files):
+            if f == os.path.basename(root) + '.db':
+                yield os.path.join(root, f)
+
 def hash_path(path):
     h = sha1(path.encode())
     return h.hexdigest()[0:8] #only need first 8 chars to be uniquely identified
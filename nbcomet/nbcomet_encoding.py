@@ -0,0 +1,299 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import ast
+import json
+import zlib
+import pickle
+import difflib
+
+# Diffs are stored as a schema version byte followed by the encoded diff.
+# Version 1 is zlib compressed JSON of a list of [key, cell] pairs, which
+# keeps integer keys (cell indices) apart from string keys (cell ids).
+# Version 2, written by DiffEncoder, may also store the source of a cell
+# with an id as a line delta against the cell's previous stored revision:
+# such entries are [key, cell without its source, [base time, ops]], see
+# source_delta. Rows written by older versions of NBComet hold a pickled
+# dict instead.
+DIFF_VERSION = 1
+DELTA_DIFF_VERSION = 2
+
+def encode_diff(diff):
+    """
+    encode a diff for the diff column of the actions table
+
+    diff: (dict) changed cells, as returned by get_nb_diff
+    """
+    pairs = [[k, v] for k, v in diff.items()]
+    data = json.dumps(pairs, separators=(',', ':')).encode('utf-8')
+    return bytes(bytearray([DIFF_VERSION])) + zlib.compress(data)
+
+def decode_diff(blob, allow_pickle=False, lookup=None):
+    """
+    decode a diff stored in the diff column of the actions table, rebuilding
+    the full source of cells stored as line deltas from the diffs stored
+    before it, see DiffDecoder
+
+    blob: (bytes) stored diff
+    allow_pickle: (bool) also decode diffs pickled by older versions of
+        NBComet, only do this for databases you trust
+    lookup: (function) takes a time in ms since epoch and returns the stored
+        diffs of the notebook's actions at that time, e.g. a DiffLookup,
+        needed to decode diffs with source deltas
+    """
+    if blob is None:
+        return {}
+    if not isinstance(blob, bytes):
+        blob = blob.encode('latin-1')
+
+    version = bytearray(blob[0:1])[0] if blob else None
+    if version == 1:
+        pairs = json.loads(zlib.decompress(blob[1:]).decode('utf-8'))
+        return dict((k, v) for k, v in pairs)
+    elif version == DELTA_DIFF_VERSION:
+        entries = decode_entries(blob)
+        if any(len(e) > 2 for e in entries):
+            if lookup is None:
+                raise ValueError("Diff stores source deltas, pass a lookup "
+                                "of the diffs stored before it")
+            return DiffDecoder(lookup, allow_pickle).decode(blob, None)
+        return dict((e[0], e[1]) for e in entries)
+    elif is_legacy_diff(blob):
+        if not allow_pickle:
+            raise ValueError("Diff was pickled by an older version of NBComet,"
+                            " migrate the database or pass allow_pickle=True")
+        return pickle.loads(blob, encoding='latin-1')
+    else:
+        raise ValueError("Unknown diff encoding version %s" % version)
+
+def decode_entries(blob):
+    # the [key, cell] and [key, cell, delta] entries of a version 2 diff
+    return json.loads(zlib.decompress(blob[1:]).decode('utf-8'))
+
+def source_delta(a, b):
+    """
+    get the line delta that turns one cell source into another
+    returns [[start, end, lines], ...], replacing lines start to end of a
+    by lines, with positions in a and in order
+
+    a: (str) source of the previous revision
+    b: (str) source of the new revision
+    """
+    lines_a = a.splitlines(True)
+    lines_b = b.splitlines(True)
+
+    # most edits touch a line or two, so only match what lies between the
+    # common first and last lines
+    start = 0
+    while (start < len(lines_a) and start < len(lines_b)
+            and lines_a[start] == lines_b[start]):
+        start += 1
+    end_a = len(lines_a)
+    end_b = len(lines_b)
+    while (end_a > start and end_b > start
+            and lines_a[end_a - 1] == lines_b[end_b - 1]):
+        end_a -= 1
+        end_b -= 1
+
+    matcher = difflib.SequenceMatcher(None, lines_a[start:end_a],
+                                    lines_b[start:end_b], autojunk=False)
+    return [[start + i1, start + i2, lines_b[start + j1:start + j2]]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+def apply_source_delta(source, ops):
+    """
+    rebuild a cell source from the one before it and a line delta
+    returns the new source
+
+    source: (str) source of the previous revision
+    ops: (list) line delta, see source_delta
+    """
+    lines = source.splitlines(True)
+    new_lines = []
+    pos = 0
+    for start, end, replacement in ops:
+        new_lines.extend(lines[pos:start])
+        new_lines.extend(replacement)
+        pos = end
+    new_lines.extend(lines[pos:])
+    return ''.join(new_lines)
+
+class DiffEncoder(object):
+    """
+    Encode the diffs of one notebook's actions, in the order they are
+    stored, keeping the last stored source of each cell so that sources
+    edited since can be stored as line deltas (see source_delta). Every
+    keyframe_interval revisions of a cell, and whenever a delta would not
+    be smaller, the full source is stored instead, which bounds how far back
+    a decoder has to look. A new encoder (e.g. after a restart) starts with
+    full sources.
+    """
+
+    def __init__(self, keyframe_interval=20):
+        self.keyframe_interval = keyframe_interval
+        # cell id -> [time, source, deltas stored since the full source]
+        self.revisions = {}
+
+    def encode(self, diff, t):
+        """
+        encode a diff for the diff column of the actions table
+
+        diff: (dict) changed cells, as returned by get_nb_diff
+        t: (int) time of the action, in ms since epoch, as stored
+        """
+        entries = []
+        for k, cell in diff.items():
+            source = cell.get('source') if isinstance(cell, dict) else None
+            if not (isinstance(k, str) and isinstance(source, str)):
+                entries.append([k, cell])
+                continue
+
+            prior = self.revisions.get(k)
+            ops = None
+            # deltas are never against a revision stored at the same time,
+            # so decoders can always look further back
+            if (prior is not None and self.keyframe_interval > 0
+                    and prior[2] < self.keyframe_interval and prior[0] < t):
+                ops = source_delta(prior[1], source)
+                # roughly the size of the delta as JSON
+                size = sum(12 + sum(len(l) + 3 for l in op[2]) for op in ops)
+                if size >= len(source):
+                    ops = None
+
+            if ops is None:
+                entries.append([k, cell])
+                self.revisions[k] = [t, source, 0]
+            else:
+                stripped = dict((f, v) for f, v in cell.items()
+                                if f != 'source')
+                entries.append([k, stripped, [prior[0], ops]])
+                self.revisions[k] = [t, source, prior[2] + 1]
+
+        data = json.dumps(entries, separators=(',', ':')).encode('utf-8')
+        return bytes(bytearray([DELTA_DIFF_VERSION])) + zlib.compress(data)
+
+    def reset(self):
+        # store full sources again, e.g. after encoded diffs were lost
+        self.revisions = {}
+
+class DiffDecoder(object):
+    """
+    Decode the diffs of one notebook's actions, rebuilding the full source
+    of cells stored as line deltas. Diffs are expected in the order they were
+    stored; a delta whose previous revision was not decoded first (e.g. when
+    reading from the middle of a notebook's history) is resolved by looking
+    up the diffs stored at the time of that revision, and further back until
+    a full source is found.
+    """
+
+    def __init__(self, lookup=None, allow_pickle=False):
+        """
+        lookup: (function) takes a time in ms since epoch and returns the
+            stored diffs of the notebook's actions at that time, in the
+            order they were stored
+        allow_pickle: (bool) decode diffs pickled by older versions of
+            NBComet, only do this for databases you trust
+        """
+        self.lookup = lookup
+        self.allow_pickle = allow_pickle
+        # cell id -> (time, source) of the last revision decoded
+        self.sources = {}
+
+    def decode(self, blob, t):
+        """
+        decode a diff stored in the diff column of the actions table, with
+        the full source of every cell
+
+        blob: (bytes) stored diff
+        t: (int) time of the action, in ms since epoch, as stored
+        """
+        if blob is not None and not isinstance(blob, bytes):
+            blob = blob.encode('latin-1')
+        if not blob or bytearray(blob[0:1])[0] != DELTA_DIFF_VERSION:
+            diff = decode_diff(blob, self.allow_pickle)
+            for k, cell in diff.items():
+                self.remember(k, cell, t)
+            return diff
+
+        diff = {}
+        for entry in decode_entries(blob):
+            k, cell = entry[0], entry[1]
+            if len(entry) > 2:
+                base_time, ops = entry[2]
+                cell = dict(cell)
+                cell['source'] = apply_source_delta(
+                                    self.base_source(k, base_time), ops)
+            self.remember(k, cell, t)
+            diff[k] = cell
+        return diff
+
+    def remember(self, k, cell, t):
+        if isinstance(k, str) and isinstance(cell, dict) and isinstance(
+                                                cell.get('source'), str):
+            self.sources[k] = (t, cell['source'])
+
+    def base_source(self, k, base_time):
+        # get the source of cell k stored at base_time, following the
+        # deltas stored before it back to a full source if needed
+        chain = []
+        t = base_time
+        while True:
+            known = self.sources.get(k)
+            if known is not None and known[0] == t:
+                source = known[1]
+                break
+            entry = self.find_entry(k, t)
+            if entry is None:
+                raise ValueError("No revision of cell %s at %s to apply a "
+                                "source delta to" % (k, t))
+            if len(entry) > 2:
+                # bases are always stored before the delta, so this ends
+                chain.append(entry[2][1])
+                t = entry[2][0]
+            else:
+                source = entry[1].get('source')
+                if not isinstance(source, str):
+                    raise ValueError("Revision of cell %s at %s has no "
+                                    "source" % (k, t))
+                break
+        for ops in reversed(chain):
+            source = apply_source_delta(source, ops)
+        return source
+
+    def find_entry(self, k, t):
+        # the entry of cell k in the last diff stored at time t, or None
+        if self.lookup is None:
+            return None
+        found = None
+        for blob in self.lookup(t):
+            if blob is not None and not isinstance(blob, bytes):
+                blob = blob.encode('latin-1')
+            if blob and bytearray(blob[0:1])[0] == DELTA_DIFF_VERSION:
+                entries = decode_entries(blob)
+            else:
+                entries = list(decode_diff(blob, self.allow_pickle).items())
+            for entry in entries:
+                if entry[0] == k:
+                    found = entry
+        return found
+
+def is_legacy_diff(blob):
+    # pickles start with a protocol marker (\x80) or a protocol 0 opcode
+    if not isinstance(blob, bytes):
+        blob = blob.encode('latin-1')
+    return blob[0:1] in [b'\x80', b'(', b'}']
+
+def decode_list(text):
+    """
+    decode the selected_cells or cell_order column of the actions table,
+    which older versions of NBComet stored as a Python repr instead of JSON
+
+    text: (str) stored list
+    """
+    if text is None:
+        return []
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
@@ -0,0 +1,362 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Export the actions and version metadata of every tracked notebook as JSONL
+(or Parquet, if pyarrow is installed) files, partitioned by notebook, for
+analysis outside of NBComet. Run with:
+
+    python -m nbcomet.nbcomet_export output_directory [--incremental]
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from nbcomet.nbcomet_dir import find_storage_dir, VersionIndex, split_key
+from nbcomet.nbcomet_sqlite import iter_actions
+from nbcomet.nbcomet_backend import get_backend
+
+# file written to the output directory after each export, holding the time
+# up to which versions were exported and, for each notebook, the last row of
+# its database exported, so the next export can start there. Actions are tracked
+# by row rather than by time, since actions can be stored well after they
+# were performed (e.g. when journaled or sent by a client that was offline)
+WATERMARK_FILE = '_watermark.json'
+
+EXPORT_FORMATS = ['jsonl', 'parquet']
+
+class JsonlWriter(object):
+    """
+    Write records as JSON lines, only creating the file once there is
+    something to write
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.count = 0
+
+    def write(self, record):
+        if self.f is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.f = open(self.path + '.tmp', 'w')
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.count += 1
+
+    def close(self):
+        # only show the file under its final name once it is complete
+        if self.f is not None:
+            self.f.close()
+            os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        # throw away what was written, e.g. when reading the notebook failed
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.path + '.tmp')
+
+class ParquetWriter(object):
+    """
+    Write records to a Parquet file, one row group per batch of records.
+    Nested values (lists and dicts) are stored as JSON strings, so every
+    file of a dataset has the same schema.
+    """
+
+    def __init__(self, path, batch_size=10000):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.batch_size = batch_size
+        self.batch = []
+        self.writer = None
+        self.count = 0
+
+    def write(self, record):
+        self.batch.append(dict((k, json.dumps(v) if isinstance(v, (list, dict))
+                                else v) for k, v in record.items()))
+        self.count += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        table = self.pa.Table.from_pylist(self.batch)
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = self.pq.ParquetWriter(self.path + '.tmp',
+                                                table.schema)
+        self.writer.write_table(table)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        self.batch = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.remove(self.path + '.tmp')
+
+def open_writer(path, fmt):
+    # get a writer for the chosen export format
+    if fmt == 'parquet':
+        return ParquetWriter(path + '.parquet')
+    return JsonlWriter(path + '.jsonl')
+
+def read_position(db):
+    """
+    get the position up to which a database's actions are stored
+    returns [rowid of the last row, user_version], where the user_version
+    counts the times retention renumbered the rows, see archive_actions
+
+    db: (str) path to the action database
+    """
+    conn = sqlite3.connect(db)
+    try:
+        last_rowid = conn.execute('SELECT MAX(rowid) FROM actions').fetchone()[0]
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+    return [last_rowid or 0, version]
+
+def export_notebook(key, db, version_dir, data_dir, out_dir, since=None,
+                    until=None, fmt='jsonl', allow_pickle=False, position=None,
+                    shard_key=None):
+    """
+    export the actions and version metadata of one notebook, streaming rows
+    from its database so it is never loaded at once
+    returns the number of actions and versions exported, and the position
+    up to which actions were exported, see read_position
+
+    key: (str) hashed directory and name of the notebook
+    db: (str) path to the notebook's action database
+    version_dir: (str) directory holding the notebook's versions
+    data_dir: (str) NBComet data directory
+    out_dir: (str) directory to export to
+    since: (int) only export versions, and actions if there is no position,
+        saved after this time, in ms since epoch
+    until: (int) only export versions saved up to this time, in ms since
+        epoch
+    fmt: (str) one of EXPORT_FORMATS
+    allow_pickle: (bool) decode diffs pickled by older versions of NBComet
+    position: (list) position up to which an earlier export got, to only
+        export actions stored since, with a user_version of None if any
+    shard_key: (str) key to select the notebook's rows by, if the database
+        is a shard holding the actions of many notebooks
+    """
+    hashed_path, fname = split_key(key)
+    partition = os.path.join('hashed_path=' + hashed_path, 'notebook=' + fname)
+    part = 'part-%d' % (until if until is not None else 0)
+
+    # export the actions stored since the earlier export, unless retention
+    # renumbered the rows since, in which case fall back to their times
+    end = read_position(db)
+    start = since + 1 if since is not None else None
+    after_rowid = None
+    if position is not None and position[1] in [None, end[1]]:
+        start = None
+        after_rowid = position[0]
+
+    # each run writes new part files, so incremental exports add to earlier
+    # ones instead of replacing them, and files of failed runs are thrown
+    # away rather than published
+    writer = open_writer(os.path.join(out_dir, 'actions', partition, part),
+                        fmt)
+    try:
+        for a in iter_actions(db, start, allow_pickle=allow_pickle,
+                            key=shard_key, after_rowid=after_rowid,
+                            max_rowid=end[0]):
+            writer.write({'hashed_path': hashed_path,
+                        'notebook': fname,
+                        'time': a['time'],
+                        'name': a['name'],
+                        'index': a['index'],
+                        'indices': a['indices'],
+                        'cell_order': a['cell_order'],
+                        # diffs are keyed by cell ids or indices, so keep
+                        # them as pairs to tell the two apart
+                        'diff': [[k, v] for k, v in a['diff'].items()]})
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    num_actions = writer.count
+
+    writer = open_writer(os.path.join(out_dir, 'versions', partition, part),
+                        fmt)
+    try:
+        if os.path.isdir(version_dir):
+            for e in VersionIndex(version_dir).all():
+                t = int(e['time'] * 1000)
+                if since is not None and t <= since:
+                    continue
+                if until is not None and t > until:
+                    continue
+                writer.write({'hashed_path': hashed_path,
+                            'notebook': fname,
+                            'time': t,
+                            'file': os.path.join(os.path.relpath(version_dir,
+                                                data_dir), e['file']),
+                            'size': e['size'],
+                            'cells': e['cells']})
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    return num_actions, writer.count, end
+
+def export_all(data_dir, out_dir, since=None, until=None, fmt='jsonl',
+                processes=0, allow_pickle=False, positions=None, backend=None):
+    """
+    export every notebook in the data directory, in parallel across worker
+    processes, finding notebooks as we go rather than listing them up front
+    returns the totals of notebooks, actions, and versions exported, and the
+    position up to which each notebook was exported
+
+    data_dir: (str) NBComet data directory
+    out_dir: (str) directory to export to
+    since: (int) only export versions, and actions of notebooks without a
+        position, saved after this time, in ms since epoch
+    until: (int) only export versions saved up to this time, in ms since
+        epoch
+    fmt: (str) one of EXPORT_FORMATS
+    processes: (int) number of worker processes, 0 to export in this process
+    allow_pickle: (bool) decode diffs pickled by older versions of NBComet
+    positions: (dict) position up to which an earlier export got, by
+        notebook key, see read_position, so notebooks not in it are exported
+        from their first action, or None to export actions by time
+    backend: (StorageBackend) storage holding the notebooks, the configured
+        one if not given
+    """
+    backend = backend if backend is not None else get_backend(data_dir)
+    totals = {'notebooks': 0, 'actions': 0, 'versions': 0, 'failed': 0,
+                'positions': {}}
+
+    def add(key, result):
+        totals['notebooks'] += 1
+        totals['actions'] += result[0]
+        totals['versions'] += result[1]
+        totals['positions'][key] = result[2]
+
+    def fail(key, e):
+        totals['failed'] += 1
+        print("Could not export %s: %s" % (key, e))
+
+    def export_args(key):
+        # worker processes get the paths, rather than the backend
+        db, shard_key = backend.action_source(key)
+        position = None
+        if positions is not None:
+            position = positions.get(key, [0, None])
+        return (key, db, backend.version_dir(key), data_dir, out_dir, since,
+                until, fmt, allow_pickle, position, shard_key)
+
+    if processes <= 0:
+        for key in backend.notebooks():
+            try:
+                add(key, export_notebook(*export_args(key)))
+            except Exception as e:
+                fail(key, e)
+        return totals
+
+    # keep only a few notebooks per worker in flight at a time
+    with ProcessPoolExecutor(processes) as executor:
+        pending = {}
+        for key in backend.notebooks():
+            if len(pending) >= processes * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done, pending, add, fail)
+            pending[executor.submit(export_notebook, *export_args(key))] = key
+        collect(list(pending), pending, add, fail)
+    return totals
+
+def collect(futures, pending, add, fail):
+    # record the results of finished exports
+    for future in futures:
+        db = pending.pop(future)
+        try:
+            add(db, future.result())
+        except Exception as e:
+            fail(db, e)
+
+def read_watermark(out_dir):
+    """
+    get how far an earlier export to a directory got
+    returns the time up to which versions were exported, in ms since epoch,
+    and the position of each notebook (see export_all), or (None, None)
+
+    out_dir: (str) directory exported to
+    """
+    try:
+        with open(os.path.join(out_dir, WATERMARK_FILE)) as f:
+            watermark = json.load(f)
+        return watermark['until'], watermark.get('notebooks')
+    except (IOError, OSError, ValueError, KeyError):
+        return None, None
+
+def write_watermark(out_dir, until, positions):
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'until': until, 'notebooks': positions}, f)
+    os.replace(path + '.tmp', path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export NBComet actions and version metadata")
+    parser.add_argument('out_dir',
+        help="directory to write the exported files to")
+    parser.add_argument('--data-dir', default=None,
+        help="NBComet data directory (default: the configured directory)")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl',
+        help="file format, parquet requires pyarrow (default: jsonl)")
+    parser.add_argument('--since', type=int, default=None,
+        help="only export actions after this time, in ms since epoch")
+    parser.add_argument('--incremental', action='store_true',
+        help="only export actions recorded since the last export to out_dir")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+        help="number of worker processes, 0 to export in this process")
+    parser.add_argument('--allow-pickle', action='store_true',
+        help="decode diffs pickled by older versions of NBComet, only do "
+            "this for data you trust")
+    args = parser.parse_args(argv)
+
+    if args.format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            print("Exporting to Parquet requires pyarrow, try "
+                "'pip install pyarrow' or use --format jsonl")
+            return 1
+
+    since = args.since
+    positions = None
+    if args.incremental and since is None:
+        # watermarks without positions fall back to exporting by time
+        since, positions = read_watermark(args.out_dir)
+    until = int(time.time() * 1000)
+
+    data_dir = args.data_dir or find_storage_dir()
+    totals = export_all(data_dir, args.out_dir, since, until, args.format,
+                        args.processes, args.allow_pickle, positions)
+    if not totals['failed']:
+        write_watermark(args.out_dir, until, totals['positions'])
+    print("%d notebooks: %d actions and %d versions exported, %d failed"
+        % (totals['notebooks'], totals['actions'], totals['versions'],
+        totals['failed']))
+    return 1 if totals['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+class IngestPipeline(object):
+    """
+    Process tracked actions off the Tornado IOLoop on a small thread pool
+
+    Each notebook gets its own bounded FIFO queue, and at most one worker
+    drains a given queue at a time, so actions for one notebook are applied
+    in the order they were received while different notebooks are processed
+    in parallel.
+    """
+
+    def __init__(self, max_workers=4, max_queue_size=100):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.executor = None
+        self.queues = {}
+        self.draining = set()
+        self.lock = threading.Lock()
+
+        # running totals exposed through stats()
+        self.num_submitted = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_rejected = 0
+        self.max_depth_seen = 0
+
+    def configure(self, max_workers=None, max_queue_size=None):
+        """
+        change the pipeline settings, must be called before the first submit
+        to change the number of workers
+
+        max_workers: (int) number of worker threads
+        max_queue_size: (int) maximum number of pending actions per notebook
+        """
+        with self.lock:
+            if max_workers is not None and self.executor is None:
+                self.max_workers = max_workers
+            if max_queue_size is not None:
+                self.max_queue_size = max_queue_size
+
+    def submit(self, key, fn, *args):
+        """
+        queue a call to fn(*args) after all calls already queued for key
+
+        key: (str) identifier of the notebook the work belongs to
+        fn: (function) work to perform on a worker thread
+        returns False, without queueing anything, if the queue for key is full
+        """
+        with self.lock:
+            queue = self.queues.setdefault(key, deque())
+            if len(queue) >= self.max_queue_size:
+                self.num_rejected += 1
+                return False
+
+            queue.append((fn, args))
+            self.num_submitted += 1
+            self.max_depth_seen = max(self.max_depth_seen, len(queue))
+
+            # only one worker drains a queue at a time to preserve order
+            if key not in self.draining:
+                self.draining.add(key)
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(self.max_workers)
+                self.executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key):
+        # run the queued work for one notebook until its queue is empty
+        while True:
+            with self.lock:
+                queue = self.queues.get(key)
+                if not queue:
+                    self.queues.pop(key, None)
+                    self.draining.discard(key)
+                    return
+                fn, args = queue.popleft()
+
+            try:
+                fn(*args)
+                with self.lock:
+                    self.num_completed += 1
+            except Exception:
+                with self.lock:
+                    self.num_failed += 1
+                log.exception("NBComet could not process action for %s", key)
+
+    def depth(self, key=None):
+        """
+        get the number of pending actions for one notebook, or for all of them
+
+        key: (str) identifier of the notebook, or None for the total
+        """
+        with self.lock:
+            if key is not None:
+                return len(self.queues.get(key, ()))
+            return sum(len(q) for q in self.queues.values())
+
+    def is_busy(self, key):
+        # check if a notebook has queued or running work
+        with self.lock:
+            return key in self.draining or bool(self.queues.get(key))
+
+    def stats(self):
+        """
+        get a snapshot of queue depths and throughput counters
+        """
+        with self.lock:
+            depths = dict((k, len(q)) for k, q in self.queues.items() if q)
+            return {'workers': self.max_workers,
+                    'max_queue_size': self.max_queue_size,
+                    'queued': sum(depths.values()),
+                    'active_notebooks': len(self.draining),
+                    'max_depth_seen': self.max_depth_seen,
+                    'submitted': self.num_submitted,
+                    'completed': self.num_completed,
+                    'failed': self.num_failed,
+                    'rejected': self.num_rejected,
+                    'queue_depths': depths}
+
+    def shutdown(self, wait=True):
+        # finish (or abandon) the queued work and stop the workers
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+# pipeline shared by all NBComet handlers in this server
+ingest_pipeline = IngestPipeline()
@@ -0,0 +1,428 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Append-only journal of tracked actions. Saving a batch of actions only
+appends it to the current journal segment and waits for it to reach the
+disk, sharing one fsync between all batches written meanwhile (group
+commit). A background loader then seals the segment and moves its actions
+into the storage backend's databases, deleting segments once they are
+loaded.
+
+Each run of a server journals to its own directory under the journal
+directory, named after the time it started, its host, its process id, and a
+random suffix, and holds a lock on it while it runs, so servers sharing a
+data directory never load each other's segments. Directories left by
+servers that stopped or crashed are no longer locked, and are loaded by the
+next server to find them. A run's directory is created and locked under a
+hidden name first, and only then renamed, so no other server ever sees it
+unlocked.
+"""
+
+import os
+import json
+import time
+import zlib
+import atexit
+import base64
+import shutil
+import socket
+import struct
+import logging
+import uuid
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from nbcomet.nbcomet_dir import create_dir
+from nbcomet.nbcomet_sqlite import action_rows
+from nbcomet.nbcomet_metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# each record is its length and CRC-32, followed by the JSON of the
+# notebook key and the action's row of the actions table (see action_row),
+# with the encoded diff in base64
+RECORD_HEADER = struct.Struct('<II')
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+LOCK_FILE = 'lock'
+# prefix of run directories that are still being created
+NEW_RUN_PREFIX = '.'
+
+# seconds between looks for the journals of servers that are gone
+ADOPT_INTERVAL = 60
+
+def encode_record(key, row):
+    """
+    encode a journal record
+
+    key: (str) hashed directory and name of the notebook
+    row: (tuple) row of the actions table, see action_row
+    """
+    t, name, index, selected, order, diff = row
+    payload = json.dumps([key, t, name, index, selected, order,
+                        base64.b64encode(diff).decode('ascii')],
+                        separators=(',', ':')).encode('utf-8')
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_records(path):
+    """
+    read the records of a journal segment, stopping at the first one that
+    was only partly written
+    returns [(notebook key, row of the actions table), ...]
+
+    path: (str) path to the segment
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    records = []
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, pos)
+        payload = data[pos + RECORD_HEADER.size:
+                        pos + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        key, t, name, index, selected, order, diff = json.loads(
+                                                    payload.decode('utf-8'))
+        records.append((key, (t, name, index, selected, order,
+                            base64.b64decode(diff))))
+        pos += RECORD_HEADER.size + length
+
+    if pos < len(data):
+        log.warning("NBComet skipped %d bytes written partly to %s",
+                    len(data) - pos, path)
+    return records
+
+def segment_number(filename):
+    # sequence number of a segment from its file name, or None
+    if not (filename.startswith(SEGMENT_PREFIX)
+            and filename.endswith(SEGMENT_SUFFIX)):
+        return None
+    try:
+        return int(filename[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+    except ValueError:
+        return None
+
+def segment_numbers(run_dir):
+    # sequence numbers of the segments in a run's directory, in order
+    return sorted(n for n in map(segment_number, os.listdir(run_dir))
+                    if n is not None)
+
+def segment_path(run_dir, number):
+    return os.path.join(run_dir, '%s%012d%s' % (SEGMENT_PREFIX, number,
+                                                SEGMENT_SUFFIX))
+
+def run_name():
+    # name of the journal directory of this run of the server, unique across
+    # servers and runs, and in the order the runs started
+    return '%013d-%s-%d-%s' % (int(time.time() * 1000),
+                                socket.gethostname().replace(os.sep, '_'),
+                                os.getpid(), uuid.uuid4().hex[0:8])
+
+def lock_run(run_dir):
+    """
+    take the lock on a run's journal directory without waiting
+    returns the open lock file, which holds the lock until it is closed, or
+    None if another server holds it
+
+    run_dir: (str) journal directory of one run of a server
+    """
+    f = open(os.path.join(run_dir, LOCK_FILE), 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            return None
+    return f
+
+def create_run(journal_dir, run):
+    """
+    create and lock the journal directory of a run, under a hidden name
+    until it is locked, so another server adopting journals never finds it
+    unlocked and removes it
+    returns the open lock file, see lock_run
+
+    journal_dir: (str) directory holding the journal of each server run
+    run: (str) name of the run
+    """
+    new_dir = os.path.join(journal_dir, NEW_RUN_PREFIX + run)
+    create_dir(new_dir)
+    lock = lock_run(new_dir)
+    if lock is None:
+        raise IOError("NBComet could not lock its journal directory %s"
+                        % new_dir)
+    try:
+        # the lock is on the lock file, so it moves with the directory
+        os.rename(new_dir, os.path.join(journal_dir, run))
+    except:
+        lock.close()
+        raise
+    return lock
+
+def load_run(run_dir, run, backend, numbers=None, key=None):
+    """
+    load the segments of a run's journal directory into the backend, in
+    order, removing each once it is loaded and stopping at the first one
+    that fails to load
+    returns the number of actions loaded
+
+    run_dir: (str) journal directory of one run of a server
+    run: (str) name of the run
+    backend: (StorageBackend) backend to load the actions into
+    numbers: (list) sequence numbers of the segments to load, all if None
+    key: (str) only load the actions of this notebook, keeping the segments
+        for the other notebooks in them
+    """
+    num_loaded = 0
+    for n in (numbers if numbers is not None else segment_numbers(run_dir)):
+        path = segment_path(run_dir, n)
+        try:
+            with metrics.timer('journal_load'):
+                rows_by_key = {}
+                for k, row in read_records(path):
+                    if key is None or k == key:
+                        rows_by_key.setdefault(k, []).append(row)
+                if rows_by_key:
+                    backend.load_actions(rows_by_key, (run, n))
+                num_loaded += sum(len(r) for r in rows_by_key.values())
+        except Exception:
+            # keep the segment, and the ones after it, for next time
+            log.exception("NBComet could not load journal segment %s", path)
+            return num_loaded
+        if key is None:
+            os.remove(path)
+    return num_loaded
+
+class ActionJournal(object):
+    """
+    The journal of one server, see the module docstring. Appends take the
+    write lock only to write to the open segment; fsyncs take the sync lock,
+    so batches keep being written while one fsync covers all of them.
+    """
+
+    def __init__(self):
+        self.journal_dir = None
+        self.run = None
+        self.run_dir = None
+        self.run_lock = None
+        self.backend = None
+        self.fsync = True
+        self.load_interval = 2.0
+        self.last_adopted = 0
+
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.running = False
+
+        self.file = None
+        self.segment = 0
+        self.written = 0
+        self.synced = 0
+
+    def enabled(self, backend=None):
+        """
+        check if the journal is running, for a given backend if any
+
+        backend: (StorageBackend) backend the actions are saved to
+        """
+        return self.running and (backend is None or backend is self.backend)
+
+    def start(self, journal_dir, backend, fsync=True, load_interval=2.0):
+        """
+        load the journals left over by servers that are gone, then start
+        this run's journal and its background loader
+
+        journal_dir: (str) directory holding the journal of each server run
+        backend: (StorageBackend) backend to load the actions into
+        fsync: (bool) wait for appended actions to reach the disk
+        load_interval: (float) seconds between loads into the backend
+        """
+        self.journal_dir = journal_dir
+        self.backend = backend
+        self.fsync = fsync
+        self.load_interval = load_interval
+
+        self.run = run_name()
+        self.run_lock = create_run(journal_dir, self.run)
+        self.run_dir = os.path.join(journal_dir, self.run)
+        self.segment = 0
+
+        num_loaded = self.adopt()
+        if num_loaded:
+            log.info("NBComet replayed %d journaled actions", num_loaded)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run_loader,
+                                        name='nbcomet-journal-loader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def adopt(self):
+        """
+        load and remove the journals of server runs that are gone, that is
+        whose directories are not locked, oldest first
+        returns the number of actions loaded
+        """
+        self.last_adopted = time.time()
+        if fcntl is None:
+            # without locks, other servers can't be told apart from ones
+            # that are gone, so their journals are left for them
+            return 0
+        num_loaded = 0
+        for run in sorted(os.listdir(self.journal_dir)):
+            run_dir = os.path.join(self.journal_dir, run)
+            if run == self.run or not os.path.isdir(run_dir):
+                continue
+            if run.startswith(NEW_RUN_PREFIX):
+                # a directory still being created has no segments yet, so
+                # only remove the ones of servers that stopped creating it
+                if time.time() - os.path.getmtime(run_dir) >= ADOPT_INTERVAL:
+                    lock = lock_run(run_dir)
+                    if lock is not None:
+                        shutil.rmtree(run_dir, ignore_errors=True)
+                        lock.close()
+                continue
+            lock = lock_run(run_dir)
+            if lock is None:
+                continue
+            try:
+                numbers = segment_numbers(run_dir)
+                num_loaded += load_run(run_dir, run, self.backend, numbers)
+                if not segment_numbers(run_dir):
+                    shutil.rmtree(run_dir, ignore_errors=True)
+            finally:
+                lock.close()
+        return num_loaded
+
+    def append(self, key, records, encoder=None):
+        """
+        journal a batch of actions, returning once they are on disk
+        returns the number of actions journaled
+
+        key: (str) hashed directory and name of the notebook
+        records: (list) (action_data, diff, cell_order) of each action, as
+            for DbManager.record_actions_to_db
+        encoder: (DiffEncoder) encoder of the notebook's diffs, see
+            DbManager.record_actions_to_db
+        """
+        rows = action_rows(records, encoder)
+        if not rows:
+            return 0
+        data = b''.join(encode_record(key, r) for r in rows)
+
+        with metrics.timer('journal_append'):
+            with self.lock:
+                if self.file is None:
+                    self.segment += 1
+                    self.file = open(segment_path(self.run_dir, self.segment),
+                                    'ab')
+                self.file.write(data)
+                self.file.flush()
+                self.written += 1
+                ticket = self.written
+        metrics.inc('bytes_written', len(data), 'journal')
+
+        if self.fsync:
+            self.sync(ticket)
+        return len(rows)
+
+    def sync(self, ticket):
+        # make sure the write with the given ticket is on disk, fsyncing
+        # every write made so far unless another thread already did
+        with self.sync_lock:
+            if self.synced >= ticket:
+                return
+            with self.lock:
+                target = self.written
+                fd = self.file.fileno() if self.file is not None else None
+            if fd is not None:
+                with metrics.timer('journal_fsync'):
+                    os.fsync(fd)
+            self.synced = target
+
+    def seal(self):
+        # close the open segment, so the next append starts a new one
+        # returns the sequence number of the last sealed segment
+        with self.sync_lock:
+            with self.lock:
+                if self.file is not None:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.file.close()
+                    self.file = None
+                self.synced = self.written
+                return self.segment
+
+    def load(self, key=None):
+        """
+        seal the open segment and load every sealed segment of this run into
+        the backend, in order, stopping at the first one that fails to load
+        returns the number of actions loaded
+
+        key: (str) only load the actions of this notebook, e.g. to read its
+            history right away, leaving the rest for the background loader
+        """
+        if self.run_dir is None:
+            return 0
+        with self.load_lock:
+            last = self.seal()
+            numbers = [n for n in segment_numbers(self.run_dir) if n <= last]
+            return load_run(self.run_dir, self.run, self.backend, numbers,
+                            key)
+
+    def queued(self):
+        # number of bytes journaled but not yet loaded into the backend
+        if self.run_dir is None:
+            return 0
+        total = 0
+        for f in os.listdir(self.run_dir):
+            if segment_number(f) is not None:
+                try:
+                    total += os.path.getsize(os.path.join(self.run_dir, f))
+                except OSError:
+                    pass
+        return total
+
+    def run_loader(self):
+        while self.running:
+            self.event.wait(self.load_interval)
+            self.event.clear()
+            # keep loading after a failure, the segments are kept until then
+            try:
+                self.load()
+                if time.time() - self.last_adopted >= ADOPT_INTERVAL:
+                    with self.load_lock:
+                        self.adopt()
+            except Exception:
+                log.exception("NBComet could not load the journal")
+
+    def stop(self):
+        # stop the loader, load everything still journaled, and remove this
+        # run's directory
+        thread = self.thread
+        self.thread = None
+        self.running = False
+        self.event.set()
+        if thread is not None:
+            thread.join()
+        self.load()
+        if self.run_dir is not None and not segment_numbers(self.run_dir):
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            self.run_dir = None
+        if self.run_lock is not None:
+            self.run_lock.close()
+            self.run_lock = None
+
+# journal of this server, started by the server extension if configured
+action_journal = ActionJournal()
+atexit.register(action_journal.stop)
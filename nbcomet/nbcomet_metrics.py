@@ -0,0 +1,195 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the buckets of every stage duration histogram
+STAGE_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Metrics(object):
+    """
+    Per-stage timers, counters, and gauges for the server extension, cheap
+    enough to keep on all the time and rendered in the Prometheus text format
+
+    Each stage gets a histogram of its durations. Counters only go up, and
+    gauges are read from callbacks when the metrics are rendered.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or STAGE_BUCKETS
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.last_summary = {}
+
+    def observe(self, stage, seconds):
+        """
+        record how long one run of a stage took
+
+        stage: (str) name of the stage, e.g. 'diff'
+        seconds: (float) duration of the run
+        """
+        i = bisect_left(self.buckets, seconds)
+        with self.lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                        'buckets': [0] * len(self.buckets)}
+            s['count'] += 1
+            s['sum'] += seconds
+            # longest run since the last summary line
+            s['max'] = max(s['max'], seconds)
+            if i < len(self.buckets):
+                s['buckets'][i] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        time the code run in a with block as one run of a stage
+
+        stage: (str) name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, value=1, kind=None):
+        """
+        add to a counter
+
+        name: (str) name of the counter, e.g. 'bytes_written'
+        value: (int) amount to add
+        kind: (str) optional label value to keep counts of one name apart
+        """
+        with self.lock:
+            key = (name, kind)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, fn, description=''):
+        """
+        report the current value of fn() as a gauge
+
+        name: (str) name of the gauge, e.g. 'ingest_queue_depth'
+        fn: (function) returns the current value
+        description: (str) help text of the gauge
+        """
+        with self.lock:
+            self.gauges[name] = (fn, description)
+
+    def snapshot(self):
+        """
+        get a copy of the stage histograms, counters, and gauge values
+        """
+        with self.lock:
+            stages = dict((k, dict(v, buckets=list(v['buckets'])))
+                          for k, v in self.stages.items())
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        values = {}
+        for name, (fn, description) in gauges.items():
+            try:
+                values[name] = fn()
+            except Exception:
+                log.exception("NBComet could not read gauge %s", name)
+        return {'stages': stages, 'counters': counters, 'gauges': values}
+
+    def render(self, prefix='nbcomet'):
+        """
+        render all metrics in the Prometheus text exposition format
+
+        prefix: (str) prefix of every metric name
+        """
+        data = self.snapshot()
+        lines = []
+
+        name = prefix + '_stage_duration_seconds'
+        lines.append('# HELP %s Time spent in each stage of saving and '
+                    'viewing notebook history' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for stage in sorted(data['stages']):
+            s = data['stages'][stage]
+            cumulative = 0
+            for bound, n in zip(self.buckets, s['buckets']):
+                cumulative += n
+                lines.append('%s_bucket{stage="%s",le="%s"} %d'
+                            % (name, stage, format_bound(bound), cumulative))
+            lines.append('%s_bucket{stage="%s",le="+Inf"} %d'
+                        % (name, stage, s['count']))
+            lines.append('%s_sum{stage="%s"} %r' % (name, stage, s['sum']))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, s['count']))
+
+        for counter in sorted(set(n for n, k in data['counters'])):
+            name = '%s_%s_total' % (prefix, counter)
+            lines.append('# TYPE %s counter' % name)
+            for (n, kind), value in sorted(data['counters'].items(),
+                                            key=lambda x: str(x[0])):
+                if n != counter:
+                    continue
+                if kind is None:
+                    lines.append('%s %d' % (name, value))
+                else:
+                    lines.append('%s{kind="%s"} %d' % (name, kind, value))
+
+        for gauge in sorted(data['gauges']):
+            name = '%s_%s' % (prefix, gauge)
+            description = self.gauges[gauge][1]
+            if description:
+                lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, data['gauges'][gauge]))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary_line(self):
+        """
+        summarize each stage's runs since the last summary in one line, e.g.
+        "diff: 12 runs, avg 1.8 ms, max 4.0 ms; db_commit: ..."
+        """
+        data = self.snapshot()
+        parts = []
+        with self.lock:
+            for stage in sorted(data['stages']):
+                s = data['stages'][stage]
+                count, total = self.last_summary.get(stage, (0, 0.0))
+                self.last_summary[stage] = (s['count'], s['sum'])
+                self.stages[stage]['max'] = 0.0
+                runs = s['count'] - count
+                if runs > 0:
+                    parts.append('%s: %d runs, avg %.1f ms, max %.1f ms'
+                                % (stage, runs, (s['sum'] - total) / runs
+                                * 1000, s['max'] * 1000))
+        if parts:
+            for name in sorted(data['gauges']):
+                parts.append('%s: %s' % (name, data['gauges'][name]))
+        return '; '.join(parts)
+
+    def log_summary(self, logger=None):
+        # log the summary line, if anything happened since the last one
+        line = self.summary_line()
+        if line:
+            (logger or log).info("NBComet metrics: %s", line)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.last_summary = {}
+
+def format_bound(bound):
+    # bucket bounds as Prometheus clients print them, e.g. 0.005 or 1.0
+    return repr(float(bound))
+
+# metrics shared by all NBComet handlers in this server
+metrics = Metrics()
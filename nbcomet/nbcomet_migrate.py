@@ -0,0 +1,103 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Rewrite action databases saved by older versions of NBComet in place, so
+pickled diffs and Python reprs of lists are replaced by the current
+encodings. Run with:
+
+    python -m nbcomet.nbcomet_migrate [data_directory]
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import argparse
+
+from nbcomet.nbcomet_dir import find_storage_dir
+from nbcomet.nbcomet_encoding import (encode_diff, decode_diff, decode_list,
+    is_legacy_diff)
+from nbcomet.nbcomet_sqlite import archive_path
+from nbcomet.nbcomet_backend import get_backend
+
+def migrate_db(db, batch_size=1000):
+    """
+    re-encode the legacy rows of one action database, one batch of rows
+    (and one transaction) at a time
+    returns the number of rows rewritten
+
+    db: (str) path to the action database
+    batch_size: (int) number of rows to read and rewrite at a time
+    """
+    conn = sqlite3.connect(db)
+    num_migrated = 0
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        last_rowid = 0
+        while True:
+            rows = conn.execute('''SELECT rowid, selected_cells, cell_order,
+                diff FROM actions WHERE rowid > ? ORDER BY rowid LIMIT ?''',
+                (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+
+            updates = []
+            for rowid, selected, order, diff in rows:
+                if not needs_migration(selected, order, diff):
+                    continue
+                if diff is not None and is_legacy_diff(diff):
+                    diff = encode_diff(decode_diff(diff, allow_pickle=True))
+                updates.append((json.dumps(decode_list(selected)),
+                                json.dumps(decode_list(order)),
+                                diff, rowid))
+
+            if updates:
+                conn.executemany('''UPDATE actions SET selected_cells = ?,
+                    cell_order = ?, diff = ? WHERE rowid = ?''', updates)
+                conn.commit()
+                num_migrated += len(updates)
+    finally:
+        conn.close()
+    return num_migrated
+
+def needs_migration(selected, order, diff):
+    # check if any column of a row still uses a legacy encoding
+    if diff is not None and is_legacy_diff(diff):
+        return True
+    for text in [selected, order]:
+        try:
+            if text is not None:
+                json.loads(text)
+        except ValueError:
+            return True
+    return False
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rewrite NBComet action databases to the current format")
+    parser.add_argument('data_dir', nargs='?', default=None,
+        help="NBComet data directory (default: the configured directory)")
+    parser.add_argument('--batch-size', type=int, default=1000,
+        help="number of rows rewritten per transaction")
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or find_storage_dir()
+    databases = []
+    for db in get_backend(data_dir).action_databases():
+        # archived actions are read back by the viewer and exports too
+        databases.extend(path for path in [db, archive_path(db)]
+                        if os.path.isfile(path))
+    total = 0
+    for db in databases:
+        try:
+            n = migrate_db(db, args.batch_size)
+        except sqlite3.Error as e:
+            print("Could not migrate %s: %s" % (db, e))
+            continue
+        total += n
+        print("%s: %d rows migrated" % (db, n))
+    print("%d rows migrated" % total)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import json
+from hashlib import sha1
+
+# How much of each cell output we keep in snapshots, versions, and diffs:
+#   full: keep outputs as they are, except those larger than the byte cap
+#   digest: replace every output's content by its hash and size
+#   strip: drop outputs entirely
+OUTPUT_POLICIES = ['full', 'digest', 'strip']
+
+# start of the text that replaces the content of an output
+DIGEST_PREFIX = "[output omitted by nbcomet: "
+
+def apply_output_policy(model, policy='full', max_bytes=None):
+    """
+    get a copy of a notebook model with the output policy applied, leaving
+    the model itself untouched
+
+    model: (dict) notebook JSON
+    policy: (str) one of OUTPUT_POLICIES
+    max_bytes: (int) replace outputs larger than this by their digest, even
+        under the 'full' policy, None or 0 for no limit
+    """
+    if policy not in OUTPUT_POLICIES:
+        policy = 'full'
+    if policy == 'full' and not max_bytes:
+        return model
+
+    cells = []
+    for c in model['cells']:
+        if c.get('cell_type') == 'code' and c.get('outputs'):
+            c = dict(c)
+            if policy == 'strip':
+                c['outputs'] = []
+            else:
+                c['outputs'] = [digest_output(o) if policy == 'digest'
+                                else cap_output(o, max_bytes)
+                                for o in c['outputs']]
+        cells.append(c)
+
+    model = dict(model)
+    model['cells'] = cells
+    return model
+
+def output_content(output):
+    # the part of an output that can grow large, serialized for hashing
+    out_type = output.get('output_type')
+    if out_type in ['display_data', 'execute_result']:
+        content = output.get('data', {})
+    elif out_type == 'stream':
+        content = output.get('text', '')
+    elif out_type == 'error':
+        content = output.get('traceback', [])
+    else:
+        return None
+    return json.dumps(content, sort_keys=True).encode('utf-8')
+
+def cap_output(output, max_bytes):
+    """
+    replace an output by its digest if its content is larger than max_bytes
+
+    output: (dict) cell output
+    max_bytes: (int) largest output content to keep
+    """
+    content = output_content(output)
+    if content is None or len(content) <= max_bytes:
+        return output
+    return digest_output(output, content)
+
+def digest_output(output, content=None):
+    """
+    replace the content of an output by a short placeholder holding the hash
+    and size of the content, keeping the output valid under the notebook
+    format, so outputs can still be told apart and compared by digest
+
+    output: (dict) cell output
+    content: (bytes) serialized content of the output, if already computed
+    """
+    if content is None:
+        content = output_content(output)
+    if content is None or is_digest(output):
+        return output
+
+    digest = sha1(content).hexdigest()
+    size = len(content)
+    placeholder = DIGEST_PREFIX + "sha1 %s, %d bytes]" % (digest, size)
+
+    output = dict(output)
+    out_type = output['output_type']
+    if out_type in ['display_data', 'execute_result']:
+        output['data'] = {'text/plain': placeholder}
+        output['metadata'] = {'comet_digest': digest, 'comet_size': size}
+    elif out_type == 'stream':
+        output['text'] = placeholder
+    elif out_type == 'error':
+        output['traceback'] = [placeholder]
+    return output
+
+def is_digest(output):
+    # check if an output already is a digest placeholder, stream and error
+    # outputs have no metadata to mark it
+    metadata = output.get('metadata') or {}
+    if 'comet_digest' in metadata:
+        return True
+    out_type = output.get('output_type')
+    if out_type == 'stream':
+        text = output.get('text')
+    elif out_type == 'error':
+        text = (output.get('traceback') or [None])[0]
+    else:
+        return False
+    return isinstance(text, str) and text.startswith(DIGEST_PREFIX)
@@ -0,0 +1,74 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+from nbcomet.nbcomet_dir import keyframe_time
+
+# Any point in a notebook's history is rebuilt from the last version saved
+# before it (a keyframe) by replaying the actions recorded since. Each action
+# holds the cells that changed and the order of all cells, so replaying one
+# takes the cells from its diff, or from the notebook before it. Retention
+# thins out old versions, keyframes included, so a point in time may be
+# replayed from an older version kept, with the actions since, archived
+# ones included.
+
+def apply_action(cells, diff, cell_order):
+    """
+    get the cells of the notebook after an action
+    returns the new list of cells, and the number of cells that could not be
+    found in either the diff or the notebook before the action
+
+    cells: (list) cells of the notebook before the action
+    diff: (dict) changed cells, keyed by cell id or index
+    cell_order: (list) ids or indices of all cells after the action
+    """
+    # actions on notebooks with cell ids refer to cells by id, and to cells
+    # by index otherwise, which can only be replayed approximately
+    if any(isinstance(k, int) for k in cell_order):
+        known = dict(enumerate(cells))
+    else:
+        known = dict((c.get('metadata', {}).get('comet_cell_id'), c)
+                    for c in cells)
+
+    new_cells = []
+    missing = 0
+    for k in cell_order:
+        c = diff.get(k, known.get(k))
+        if c is None:
+            missing += 1
+        else:
+            new_cells.append(c)
+    return new_cells, missing
+
+def notebook_at(backend, key, t, allow_pickle=False):
+    """
+    rebuild a notebook as it was at a point in time
+    returns the notebook JSON and a dict describing how it was rebuilt, or
+    (None, None) if no version was saved before that time
+
+    backend: (StorageBackend) storage holding the notebook's history
+    key: (str) hashed directory and name of the notebook
+    t: (int) point in time, in ms since epoch
+    allow_pickle: (bool) decode diffs pickled by older versions of NBComet
+    """
+    keyframe = backend.find_keyframe(key, t)
+    if keyframe is None:
+        return None, None
+
+    nb = dict(backend.read_version(key, keyframe['file']))
+    cells = list(nb['cells'])
+    start = keyframe_time(keyframe)
+    info = {'keyframe': keyframe['file'],
+            'keyframe_time': start,
+            'time': start,
+            'replayed': 0,
+            'missing_cells': 0}
+
+    for a in backend.iter_actions(key, start + 1, t, allow_pickle):
+        cells, missing = apply_action(cells, a['diff'], a['cell_order'])
+        info['replayed'] += 1
+        info['missing_cells'] += missing
+        info['time'] = a['time']
+
+    nb['cells'] = cells
+    return nb, info
@@ -0,0 +1,300 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Thin out old versions and archive old actions so the data directory does
+not grow without limit. The server extension runs this in the background
+when a retention setting is configured, and it can be run by hand with:
+
+    python -m nbcomet.nbcomet_retention [data_directory] [--keep-all-days N]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import sqlite3
+import argparse
+import threading
+
+from nbcomet.nbcomet_dir import (find_storage_dir, get_version_index,
+    forget_version_index, version_indices)
+from nbcomet.nbcomet_store import blob_path, blob_lock
+from nbcomet.nbcomet_catalog import get_catalog
+from nbcomet.nbcomet_backend import get_backend
+
+log = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+HOUR = 60 * 60
+
+class RetentionPolicy(object):
+    """
+    How long to keep notebook history. Versions newer than keep_all_days are
+    all kept, older ones are thinned to the last version of each hour until
+    keep_hourly_days, and to the last version of each day after that. Actions
+    older than archive_actions_days are moved to an archive database next to
+    the action database. A setting of 0 turns that part of the policy off.
+    """
+
+    def __init__(self, keep_all_days=0, keep_hourly_days=30,
+                    archive_actions_days=0):
+        self.keep_all_days = keep_all_days
+        self.keep_hourly_days = keep_hourly_days
+        self.archive_actions_days = archive_actions_days
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        read the policy from the Comet config
+
+        config: (dict) settings from the "Comet" section of the nbconfig
+        """
+        return cls(float(config.get('retention_keep_all_days', 0)),
+                    float(config.get('retention_keep_hourly_days', 30)),
+                    float(config.get('retention_archive_actions_days', 0)))
+
+    def enabled(self):
+        return self.keep_all_days > 0 or self.archive_actions_days > 0
+
+    def versions_to_remove(self, entries, now=None):
+        """
+        pick the versions the policy no longer keeps
+        returns the index entries of those versions
+
+        entries: (list) version index entries, sorted by time
+        now: (float) current time, in seconds since epoch
+        """
+        if self.keep_all_days <= 0:
+            return []
+        now = now if now is not None else time.time()
+        keep_all = now - self.keep_all_days * DAY
+        keep_hourly = now - max(self.keep_hourly_days,
+                                self.keep_all_days) * DAY
+
+        # walk from newest to oldest, keeping the newest version of a bucket
+        kept = set()
+        remove = []
+        for e in reversed(entries):
+            t = e['time']
+            if t >= keep_all:
+                continue
+            if t >= keep_hourly:
+                bucket = ('hour', int(t // HOUR))
+            else:
+                bucket = ('day', int(t // DAY))
+            if bucket in kept:
+                remove.append(e)
+            else:
+                kept.add(bucket)
+        remove.reverse()
+        return remove
+
+    def archive_before(self, now=None):
+        # time before which actions are archived, in ms since epoch, or None
+        if self.archive_actions_days <= 0:
+            return None
+        now = now if now is not None else time.time()
+        return int((now - self.archive_actions_days * DAY) * 1000)
+
+def prune_versions(version_dir, policy, now=None, dry_run=False):
+    """
+    remove the versions of one notebook that the policy no longer keeps, and
+    any blobs only those versions used
+    returns the number of versions and blobs removed
+
+    version_dir: (str) directory holding the versions of the notebook
+    policy: (RetentionPolicy) what to keep
+    now: (float) current time, in seconds since epoch
+    dry_run: (bool) only count what would be removed
+    """
+    # share the index with the server if the notebook is open, but don't
+    # keep the indices of every other notebook around afterwards
+    cached = version_dir in version_indices
+    try:
+        return remove_versions(version_dir, policy, now, dry_run)
+    finally:
+        if not cached:
+            forget_version_index(version_dir)
+
+def remove_versions(version_dir, policy, now=None, dry_run=False):
+    # see prune_versions
+    index = get_version_index(version_dir)
+    remove = policy.versions_to_remove(index.all(), now)
+    if not remove or dry_run:
+        return len(remove), 0
+
+    # drop versions from the index first, so the viewer never lists a
+    # version whose file is gone
+    removed = index.remove([e['file'] for e in remove])
+    for e in removed:
+        try:
+            os.remove(os.path.join(version_dir, e['file']))
+        except OSError:
+            pass
+
+    num_blobs = 0
+    if any(e['file'].endswith('.manifest') for e in removed):
+        num_blobs = remove_unused_blobs(version_dir)
+    return len(removed), num_blobs
+
+def remove_unused_blobs(version_dir):
+    """
+    remove the blobs no remaining version manifest refers to
+    returns the number of blobs removed
+
+    version_dir: (str) directory holding the versions and their blobs
+    """
+    blob_dir = os.path.join(version_dir, 'blobs')
+    if not os.path.isdir(blob_dir):
+        return 0
+    with blob_lock(blob_dir, exclusive=True):
+        return sweep_blobs(version_dir, blob_dir)
+
+def sweep_blobs(version_dir, blob_dir):
+    # see remove_unused_blobs, with the blob directory locked
+
+    # note the time first, so blobs written by versions saved while we are
+    # reading the manifests are left alone where there are no locks
+    start = time.time()
+    used = set()
+    # every manifest on disk, including ones not yet in the index
+    for f in os.listdir(version_dir):
+        if not f.endswith('.manifest'):
+            continue
+        try:
+            with open(os.path.join(version_dir, f)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            # keep every blob if we can't tell which ones are in use
+            log.warning("NBComet could not read manifest %s", f)
+            return 0
+        for body_hash, outputs_hash in manifest['cells']:
+            used.add(body_hash)
+            used.add(outputs_hash)
+
+    num_removed = 0
+    for sub_dir in os.listdir(blob_dir):
+        if not os.path.isdir(os.path.join(blob_dir, sub_dir)):
+            continue
+        for f in os.listdir(os.path.join(blob_dir, sub_dir)):
+            blob_hash = f.split('.')[0]
+            path = blob_path(blob_dir, blob_hash)
+            if blob_hash in used or not os.path.isfile(path):
+                continue
+            if os.path.getmtime(path) >= start:
+                continue
+            os.remove(path)
+            num_removed += 1
+    return num_removed
+
+def apply_retention(data_dir, policy, now=None, dry_run=False, is_busy=None,
+                    pause=0, backend=None):
+    """
+    apply a retention policy to every notebook in the data directory
+    returns the totals of versions, blobs, and actions removed or archived
+
+    data_dir: (str) NBComet data directory
+    policy: (RetentionPolicy) what to keep
+    now: (float) current time, in seconds since epoch
+    dry_run: (bool) only count what would be removed
+    is_busy: (function) takes a notebook key (hashed path and name), and
+        returns True if the notebook is being saved, so it is skipped
+    pause: (float) seconds to wait between notebooks, to go easy on the disk
+    backend: (StorageBackend) storage holding the notebooks, the configured
+        one if not given
+    """
+    backend = backend if backend is not None else get_backend(data_dir)
+    totals = {'notebooks': 0, 'versions': 0, 'blobs': 0, 'actions': 0}
+    before_time = policy.archive_before(now)
+    for key in backend.notebooks():
+        if is_busy is not None and is_busy(key):
+            continue
+
+        try:
+            versions, blobs = 0, 0
+            version_dir = backend.version_dir(key)
+            if os.path.isdir(version_dir):
+                versions, blobs = prune_versions(version_dir, policy, now,
+                                                dry_run)
+            actions = backend.archive_actions(key, before_time, dry_run)
+            if versions and not dry_run:
+                get_catalog(data_dir).remove_versions(key, versions)
+        except (IOError, OSError, sqlite3.Error):
+            log.exception("NBComet could not apply retention to %s", key)
+            continue
+
+        totals['notebooks'] += 1
+        totals['versions'] += versions
+        totals['blobs'] += blobs
+        totals['actions'] += actions
+        if pause:
+            time.sleep(pause)
+    return totals
+
+class RetentionJob(object):
+    """
+    Run the retention policy now and then on a background thread, one run
+    at a time, pausing between notebooks to stay out of the way of saves
+    """
+
+    def __init__(self, is_busy=None, pause=0.5):
+        self.is_busy = is_busy
+        self.pause = pause
+        self.running = threading.Lock()
+
+    def start(self, data_dir, policy):
+        """
+        start a run in the background, unless one is still going
+        returns False if a run is still going
+
+        data_dir: (str) NBComet data directory
+        policy: (RetentionPolicy) what to keep
+        """
+        if not self.running.acquire(False):
+            return False
+        thread = threading.Thread(target=self.run, args=(data_dir, policy),
+                                    name='nbcomet-retention')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def run(self, data_dir, policy):
+        try:
+            totals = apply_retention(data_dir, policy, is_busy=self.is_busy,
+                                    pause=self.pause)
+            log.info("NBComet retention removed %d versions and %d blobs, "
+                    "archived %d actions", totals['versions'],
+                    totals['blobs'], totals['actions'])
+        except Exception:
+            log.exception("NBComet retention failed")
+        finally:
+            self.running.release()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Thin out old NBComet versions and archive old actions")
+    parser.add_argument('data_dir', nargs='?', default=None,
+        help="NBComet data directory (default: the configured directory)")
+    parser.add_argument('--keep-all-days', type=float, default=0,
+        help="keep every version saved in this many days, 0 keeps all")
+    parser.add_argument('--keep-hourly-days', type=float, default=30,
+        help="then keep one version per hour up to this many days old, and "
+            "one per day after that")
+    parser.add_argument('--archive-actions-days', type=float, default=0,
+        help="archive actions older than this many days, 0 keeps all")
+    parser.add_argument('--dry-run', action='store_true',
+        help="only report what would be removed")
+    args = parser.parse_args(argv)
+
+    policy = RetentionPolicy(args.keep_all_days, args.keep_hourly_days,
+                            args.archive_actions_days)
+    data_dir = args.data_dir or find_storage_dir()
+    totals = apply_retention(data_dir, policy, dry_run=args.dry_run)
+    verb = "would be" if args.dry_run else "were"
+    print("%d notebooks: %d versions and %d blobs %s removed, %d actions %s "
+        "archived" % (totals['notebooks'], totals['versions'],
+        totals['blobs'], verb, totals['actions'], verb))
+
+if __name__ == '__main__':
+    sys.exit(main())
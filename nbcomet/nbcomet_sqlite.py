@@ -3,121 +3,580 @@ NBComet: Jupyter Notebook extension to track full notebook history
 """
 
 import os
-import pickle
+import json
+import time
+import atexit
+import logging
 import sqlite3
-import nbformat
-from threading import Timer
+import threading
 
-from nbcomet.nbcomet_diff import get_nb_diff
+from nbcomet.nbcomet_encoding import encode_diff, decode_list, DiffDecoder
+from nbcomet.nbcomet_metrics import metrics
+
+log = logging.getLogger(__name__)
 
 # TODO enable saving of only metadata, not the actual diff
 
+# columns of the actions table, shared with the archive databases
+ACTION_COLUMNS = '''(time integer, name text, cell_index integer,
+    selected_cells text, cell_order text, diff blob)'''
+
+# columns of the actions table of a shard, which holds the actions of many
+# notebooks, told apart by their hashed directory and name
+SHARD_ACTION_COLUMNS = '''(notebook text, time integer, name text,
+    cell_index integer, selected_cells text, cell_order text, diff blob)'''
+
+# days the marks of journal segments loaded into a database are kept, in
+# case a server stopped before removing the segment it loaded
+JOURNAL_MARK_DAYS = 30
+
 class DbManager(object):
-    def __init__(self, db_key, db_path):
+    """
+    Queue actions for one notebook's database and write them in batches
+    through a single long-lived connection, flushed by the shared DbWriter
+    """
+
+    # how to open the database, and create and fill its actions table
+    timeout = 5.0
+    table_statements = [
+        'CREATE TABLE IF NOT EXISTS actions ' + ACTION_COLUMNS,
+        '''CREATE INDEX IF NOT EXISTS actions_time ON actions (time)''',
+        '''CREATE INDEX IF NOT EXISTS actions_name ON actions (name)''']
+    insert_statement = 'INSERT INTO actions VALUES (?,?,?,?,?,?)'
+
+    def __init__(self, db_key, db_path, writer=None):
         self.db_key = db_key
         self.db_path = db_path
-        self.commitTimer = None
+        self.writer = writer if writer is not None else db_writer
         self.queue = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.conn = None
+        self.closed = False
+        self.has_journal_loads = False
 
         self.create_action_table()
+        self.writer.register(self)
+
+    def connect(self):
+        # open the connection shared by all writes to this database
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=self.timeout,
+                                        check_same_thread=False)
+            # new databases free pages without VACUUM, see archive_actions
+            self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        return self.conn
 
     def create_action_table(self):
         # create the main db table for storing action data
-        self.conn = sqlite3.connect(self.db_path)
-        self.c = self.conn.cursor()
-        self.c.execute('''CREATE TABLE IF NOT EXISTS actions (time integer,
-            name text, cell_index integer, selected_cells text, cell_order text,
-            diff text)''')
-        self.conn.commit()
-        self.conn.close()
-
-    def add_to_commit_queue(self, action_data, diff, cell_order):
-        # add data to the queue
-        ad = action_data
-        action_data_tuple = (str(ad['time']), ad['name'], str(ad['index']),
-                            str(ad['indices']), str(cell_order),
-                            pickle.dumps(diff))
-        self.queue.append(action_data_tuple)
-
-        if self.commitTimer:
-            if self.commitTimer.is_alive():
-                self.commitTimer.cancel()
-                self.commitTimer = None
-
-        # commit data before notebook closes, otherwise  let data queue for a
-        # while to prevent rapid serial writing to the db
-        if ad['name'] == 'notebook-closed':
-            self.commit_queue()
-        else:
-            self.commitTimer = Timer(2.0, self.commit_queue)
-            self.commitTimer.start()
+        with self.write_lock:
+            conn = self.connect()
+            for statement in self.table_statements:
+                conn.execute(statement)
+            conn.commit()
 
     def commit_queue(self):
         # commit the queued data
-        self.conn = sqlite3.connect(self.db_path)
-        self.c = self.conn.cursor()
+        with self.write_lock:
+            with self.lock:
+                rows = self.queue
+                self.queue = []
+            if not rows:
+                return
 
-        try:
-            self.c.executemany('INSERT INTO actions VALUES (?,?,?,?,?,?)', self.queue)
-            self.conn.commit()
-            self.queue = []
-        except:
-            self.conn.rollback()
-            raise
-
-    def record_action_to_db(self, action_data, dest_fname):
+            conn = self.connect()
+            try:
+                with metrics.timer('db_commit'):
+                    conn.executemany(self.insert_statement, rows)
+                    conn.commit()
+            except:
+                conn.rollback()
+                # put the rows back so they are retried on the next flush
+                with self.lock:
+                    self.queue = rows + self.queue
+                metrics.inc('db_commit_errors')
+                raise
+
+            metrics.inc('actions_committed', len(rows))
+            metrics.inc('bytes_written', sum(len(r[-3]) + len(r[-2])
+                                            + len(r[-1]) for r in rows), 'db')
+
+    def key_rows(self, key, rows):
+        # rows of the actions table of one notebook, as stored in this
+        # database
+        return rows
+
+    def load_rows(self, rows_by_key, segment):
         """
-        save action to sqlite database
+        write rows of the actions table loaded from a journal segment, in one
+        transaction that also marks the segment as loaded for each notebook,
+        so loading the segment again after a crash doesn't duplicate them
+        returns the number of rows written, leaving out those of notebooks
+        the segment was already loaded for
+
+        rows_by_key: (dict) rows of the actions table (see action_row) of
+            each notebook, by notebook key
+        segment: (tuple) name of the journal run and sequence number of the
+            segment in it, which together are unique across servers and runs
+        """
+        run, number = segment
+        written = []
+        with self.write_lock:
+            conn = self.connect()
+            if not self.has_journal_loads:
+                conn.execute('''CREATE TABLE IF NOT EXISTS journal_loads
+                    (run text, segment integer, notebook text, load_time real,
+                    PRIMARY KEY (run, segment, notebook))''')
+                conn.commit()
+                self.has_journal_loads = True
+            with conn:
+                now = time.time()
+                for key, rows in sorted(rows_by_key.items()):
+                    if conn.execute('''SELECT 1 FROM journal_loads WHERE
+                            run = ? AND segment = ? AND notebook = ?''',
+                            (run, number, key)).fetchone():
+                        continue
+                    rows = self.key_rows(key, rows)
+                    with metrics.timer('db_commit'):
+                        conn.executemany(self.insert_statement, rows)
+                    conn.execute('INSERT INTO journal_loads VALUES (?,?,?,?)',
+                                (run, number, key, now))
+                    written.extend(rows)
+                # a run's segments are loaded in order and removed once
+                # loaded, so only the marks of its last loaded segment are
+                # ever needed again, and only until it is removed
+                conn.execute('''DELETE FROM journal_loads WHERE (run = ? AND
+                    segment < ?) OR load_time < ?''',
+                    (run, number, now - JOURNAL_MARK_DAYS * 24 * 3600))
+        metrics.inc('actions_committed', len(written))
+        metrics.inc('bytes_written', sum(len(r[-3]) + len(r[-2])
+                                        + len(r[-1]) for r in written), 'db')
+        return len(written)
+
+    def close(self):
+        # write any queued actions and release the connection
+        self.closed = True
+        self.writer.unregister(self)
+        try:
+            self.commit_queue()
+        finally:
+            with self.write_lock:
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
 
-        action_data: (dict) data about action, see above for more details
-        dest_fname: (str) full path to where file is saved on volume
-        db_manager: (DbManager) object managing DB read / write
+    def record_actions_to_db(self, records, encoder=None):
         """
+        queue a batch of actions for the writer to save to sqlite database,
+        committing right away only when the notebook is being closed
+        returns the number of actions queued
 
-        # handle edge cases of copy-cell and undo-cell-deletion events
-        diff, cell_order = get_nb_diff(action_data, dest_fname, True)
+        records: (list) (action_data, diff, cell_order) of each action, in
+            the order the actions were performed
+        encoder: (DiffEncoder) encoder of the notebook's diffs, which stores
+            edited sources as deltas, or None to store full diffs
+        """
+        rows = action_rows(records, encoder)
+        self.queue_rows(rows, closing_records(records))
+        return len(rows)
 
-        # don't track extraneous events
-        if action_data['name'] in ['unselect-cell'] and diff == {}:
+    def queue_rows(self, rows, commit=False):
+        # queue rows of the actions table, letting them queue for a while so
+        # the writer can commit many actions in one transaction
+        if not rows:
             return
+        with self.lock:
+            self.queue.extend(rows)
+            queue_length = len(self.queue)
+        if commit:
+            self.commit_queue()
+        elif queue_length >= self.writer.batch_size:
+            self.writer.wake()
+
+class ShardManager(DbManager):
+    """
+    Queue actions for one shard database, which holds the actions of many
+    notebooks, and write them in batches through the shard's single
+    connection, so each shard has one writer no matter how many notebooks
+    are open
+    """
+
+    # wait longer for other servers sharing the shard to finish writing
+    timeout = 30.0
+    table_statements = [
+        'CREATE TABLE IF NOT EXISTS actions ' + SHARD_ACTION_COLUMNS,
+        '''CREATE INDEX IF NOT EXISTS actions_notebook_time
+            ON actions (notebook, time)''']
+    insert_statement = 'INSERT INTO actions VALUES (?,?,?,?,?,?,?)'
+
+    def notebook(self, key):
+        # get a handle that records the actions of one notebook in the shard
+        return ShardNotebook(self, key)
+
+    def key_rows(self, key, rows):
+        return [(key,) + r for r in rows]
+
+class ShardNotebook(object):
+    """
+    The actions of one notebook in a shard, with the methods of DbManager
+    used to record them
+    """
+
+    def __init__(self, shard, key):
+        self.shard = shard
+        self.key = key
+        self.db_path = shard.db_path
+
+    def record_actions_to_db(self, records, encoder=None):
+        # see DbManager.record_actions_to_db
+        rows = [(self.key,) + r for r in action_rows(records, encoder)]
+        self.shard.queue_rows(rows, closing_records(records))
+        return len(rows)
 
-        # save the data to the database queue
-        self.add_to_commit_queue(action_data, diff, cell_order)
+    def commit_queue(self):
+        self.shard.commit_queue()
+
+    def close(self):
+        # the shard stays open for the other notebooks in it
+        self.shard.commit_queue()
+
+def closing_records(records):
+    # commit data before notebook closes
+    return any(a['name'] == 'notebook-closed' for a, d, o in records)
+
+def action_rows(records, encoder=None):
+    # convert (action_data, diff, cell_order) records to rows of the actions
+    # table, leaving out extraneous events
+    return [action_row(a, d, o, encoder) for a, d, o in records
+            if not (a['name'] in ['unselect-cell'] and d == {})]
+
+def action_row(action_data, diff, cell_order, encoder=None):
+    # convert an action to a row of the actions table, encoding its diff
+    # with the notebook's DiffEncoder if given
+    ad = action_data
+    t = int(ad['time'])
+    return (t, ad['name'], ad['index'],
+            json.dumps(ad['indices']), json.dumps(cell_order),
+            encoder.encode(diff, t) if encoder is not None
+            else encode_diff(diff))
+
+class DbWriter(object):
+    """
+    Background thread that periodically commits the queued actions of every
+    open DbManager, and the catalog's queued activity, or sooner when a
+    queue reaches the batch size
+    """
+
+    def __init__(self, flush_interval=2.0, batch_size=200):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.managers = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def configure(self, flush_interval=None, batch_size=None):
+        """
+        change how often queued actions are committed
 
-def get_viewer_data(db, start_time, end_time):
-    # get data for the comet visualization
+        flush_interval: (float) seconds between flushes
+        batch_size: (int) queue length that triggers an early flush
+        """
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+    def register(self, manager):
+        with self.lock:
+            if manager not in self.managers:
+                self.managers.append(manager)
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run,
+                                                name='nbcomet-db-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unregister(self, manager):
+        with self.lock:
+            if manager in self.managers:
+                self.managers.remove(manager)
+
+    def queued(self):
+        # number of rows waiting to be committed, over all databases, that is
+        # actions and the catalog entries of notebooks with new activity
+        with self.lock:
+            managers = list(self.managers)
+        return sum(len(m.queue) for m in managers)
+
+    def wake(self):
+        # flush without waiting for the rest of the flush interval
+        self.event.set()
+
+    def run(self):
+        while self.running:
+            self.event.wait(self.flush_interval)
+            self.event.clear()
+            self.flush()
+
+    def flush(self):
+        # commit the queued actions of all open databases
+        with self.lock:
+            managers = list(self.managers)
+        for m in managers:
+            try:
+                m.commit_queue()
+            except Exception:
+                log.exception("NBComet could not write actions to %s",
+                            m.db_path)
+
+    def stop(self):
+        # stop the thread and write anything still queued
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+            self.running = False
+        self.event.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+# single writer thread shared by all databases, flushed on shutdown
+db_writer = DbWriter()
+atexit.register(db_writer.stop)
+
+def get_viewer_data(db, start_time, end_time, key=None):
+    """
+    get data for the comet visualization
+    returns (num deletions, num runs, editing time in seconds)
+
+    db: (str) path to the action database
+    start_time: (int) start of the time range, in ms since epoch
+    end_time: (int) end of the time range, in ms since epoch
+    key: (str) hashed directory and name of the notebook, if the database
+        is a shard holding the actions of many notebooks
+    """
+    where, args = time_range_filter(start_time, end_time, key)
     conn = sqlite3.connect(db)
-    c = conn.cursor()
-
-    search = "SELECT name FROM actions WHERE name = 'delete-cell' AND time BETWEEN " + str(start_time) + " and " + str(end_time)
-    c.execute(search)
-    rows = c.fetchall()
-    num_deletions = len(rows)
-
-    # TODO how to count when multiple cells are selected and run, or run-all?
-    search = "SELECT name FROM actions WHERE name LIKE 'run-cell%' AND time BETWEEN " + str(start_time) + " and " + str(end_time)
-    c.execute(search)
-    rows = c.fetchall()
-    num_runs = len(rows)
-
-    search = "SELECT time FROM actions WHERE time BETWEEN " + str(start_time) + " and " + str(end_time)
-    c.execute(search)
-    rows = c.fetchall()
-    total_time = 0;
-    if len(rows) > 0:
-        start_time = rows[0][0]
-        last_time = rows[0][0]
-        for i in range(1,len(rows)):
-            # use 5 minutes of inactivity as threshold for each editing session
-            if (rows[i][0] - last_time) >= (5 * 60 * 1000) or i == len(rows) - 1:
-                total_time = total_time + last_time - start_time
-                start_time = rows[i][0]
-                last_time = rows[i][0]
+    try:
+        c = conn.cursor()
+
+        # count deletions and runs, and add up the time between consecutive
+        # actions, using 5 minutes of inactivity as threshold for each
+        # editing session, all in one pass over the time index
+        # TODO how to count when multiple cells are selected and run, or run-all?
+        if sqlite3.sqlite_version_info >= (3, 25, 0):
+            c.execute(VIEWER_SUMMARY_QUERY % where, (SESSION_GAP,) + args)
+            num_deletions, num_runs, total_time = c.fetchone()
+        else:
+            num_deletions, num_runs, total_time = summarize_actions(
+                c.execute(VIEWER_SUMMARY_ROWS_QUERY % where, args))
+    finally:
+        conn.close()
+
+    return (num_deletions, num_runs, total_time/1000)
+
+def iter_actions(db, start_time=None, end_time=None, batch_size=1000,
+                allow_pickle=False, key=None, after_rowid=None, max_rowid=None):
+    """
+    stream the actions in a database with their diffs decoded, fetching
+    rows in batches so large databases are never loaded at once
+
+    db: (str) path to the action database
+    start_time: (int) only actions at or after this time, in ms since epoch
+    end_time: (int) only actions at or before this time, in ms since epoch
+    batch_size: (int) number of rows to fetch at a time
+    allow_pickle: (bool) decode diffs pickled by older versions of NBComet
+    key: (str) hashed directory and name of the notebook, if the database
+        is a shard holding the actions of many notebooks
+    after_rowid: (int) only actions stored after the row with this rowid,
+        which tells actions apart by when they were stored, not performed
+    max_rowid: (int) only actions stored up to the row with this rowid
+    """
+    where, args = time_range_filter(
+        start_time if start_time is not None else -2**63,
+        end_time if end_time is not None else 2**63 - 1, key)
+    if after_rowid is not None:
+        where += ' AND rowid > ?'
+        args += (after_rowid,)
+    if max_rowid is not None:
+        where += ' AND rowid <= ?'
+        args += (max_rowid,)
+    conn = sqlite3.connect(db)
+    lookup = DiffLookup(conn, db, key)
+    decoder = DiffDecoder(lookup, allow_pickle)
+    try:
+        c = conn.cursor()
+        # rows stored at the same time in the order they were stored, which
+        # source deltas rely on
+        c.execute('''SELECT time, name, cell_index, selected_cells, cell_order,
+            diff FROM actions WHERE %s ORDER BY time, rowid''' % where, args)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for t, name, index, selected, order, diff in rows:
+                yield {'time': t,
+                        'name': name,
+                        'index': index,
+                        'indices': decode_list(selected),
+                        'cell_order': decode_list(order),
+                        'diff': decoder.decode(diff, t)}
+    finally:
+        lookup.close()
+        conn.close()
+
+class DiffLookup(object):
+    """
+    Look up the diffs a notebook stored at a given time, for a DiffDecoder
+    resolving source deltas against revisions it has not read, in the
+    action database and then in its archive (see nbcomet_retention)
+    """
+
+    def __init__(self, conn, db, key=None):
+        self.conn = conn
+        self.archive_db = archive_path(db)
+        self.archive = None
+        self.key = key
+
+    def __call__(self, t):
+        where, args = time_range_filter(t, t, self.key)
+        query = 'SELECT diff FROM actions WHERE %s ORDER BY rowid' % where
+        rows = self.conn.execute(query, args).fetchall()
+        if not rows and os.path.isfile(self.archive_db):
+            if self.archive is None:
+                self.archive = sqlite3.connect(self.archive_db)
+            rows = self.archive.execute(query, args).fetchall()
+        return [r[0] for r in rows]
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+def archive_actions(db, before_time, dry_run=False, key=None):
+    """
+    move the actions recorded before a given time to an archive database
+    next to the action database (see archive_path), then give the freed
+    space back
+    returns the number of actions archived
+
+    db: (str) path to the action database
+    before_time: (int) time before which actions are archived, in ms since
+        epoch, or None to only compact the database
+    dry_run: (bool) only count what would be archived
+    key: (str) hashed directory and name of the notebook, if the database
+        is a shard holding the actions of many notebooks
+    """
+    where, args = time_range_filter(-2**63, (before_time or 0) - 1, key)
+    conn = sqlite3.connect(db, timeout=30)
+    try:
+        num_archived = 0
+        if before_time is not None:
+            num_archived = conn.execute('''SELECT COUNT(*) FROM actions
+                WHERE %s''' % where, args).fetchone()[0]
+        if dry_run:
+            return num_archived
+
+        if num_archived:
+            conn.execute('ATTACH DATABASE ? AS archive', (archive_path(db),))
+            if key is None:
+                conn.execute('CREATE TABLE IF NOT EXISTS archive.actions '
+                            + ACTION_COLUMNS)
+            else:
+                conn.execute('CREATE TABLE IF NOT EXISTS archive.actions '
+                            + SHARD_ACTION_COLUMNS)
+                conn.execute('''CREATE INDEX IF NOT EXISTS
+                    archive.actions_notebook_time ON actions (notebook, time)''')
+            with conn:
+                conn.execute('''INSERT INTO archive.actions SELECT * FROM
+                    actions WHERE %s''' % where, args)
+                conn.execute('DELETE FROM actions WHERE %s' % where, args)
+            conn.execute('DETACH DATABASE archive')
+
+            # give the freed pages back to the file system. VACUUM renumbers
+            # the rows of tables without an INTEGER PRIMARY KEY, which
+            # incremental exports rely on (see nbcomet_export), so databases
+            # are switched to incremental vacuums, and the one VACUUM this
+            # takes is counted in their user_version
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                # run to completion, which execute() doesn't do
+                conn.executescript('PRAGMA incremental_vacuum;')
             else:
-                last_time = rows[i][0]
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                conn.execute('PRAGMA user_version = %d' % (version + 1))
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        else:
+            conn.execute('PRAGMA optimize')
+        return num_archived
+    finally:
+        conn.close()
+
+def action_counts(db, key=None):
+    """
+    count the actions in a database
+    returns (number of actions, time of the first, time of the last), with
+    times in ms since epoch, which are None if there are no actions
+
+    db: (str) path to the action database
+    key: (str) hashed directory and name of the notebook, if the database
+        is a shard holding the actions of many notebooks
+    """
+    where, args = time_range_filter(-2**63, 2**63 - 1, key)
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute('''SELECT COUNT(*), MIN(time), MAX(time)
+            FROM actions WHERE %s''' % where, args).fetchone()
+    finally:
+        conn.close()
+
+def archive_path(db):
+    # path to the database that retention moves a database's old actions to
+    return os.path.splitext(db)[0] + '-archive.db'
+
+def time_range_filter(start_time, end_time, key=None):
+    # WHERE clause and arguments selecting the actions in a time range, of
+    # one notebook if the database is a shard
+    if key is None:
+        return 'time BETWEEN ? AND ?', (start_time, end_time)
+    return 'notebook = ? AND time BETWEEN ? AND ?', (key, start_time, end_time)
+
+# editing sessions end after 5 minutes (in ms) without any action
+SESSION_GAP = 5 * 60 * 1000
+
+VIEWER_SUMMARY_QUERY = '''SELECT
+        COALESCE(SUM(name = 'delete-cell'), 0),
+        COALESCE(SUM(name LIKE 'run-cell%%'), 0),
+        COALESCE(SUM(CASE WHEN gap < ? THEN gap ELSE 0 END), 0)
+    FROM (SELECT name, time - LAG(time) OVER (ORDER BY time) AS gap
+        FROM actions WHERE %s)'''
+
+VIEWER_SUMMARY_ROWS_QUERY = '''SELECT name, time FROM actions
+    WHERE %s ORDER BY time'''
 
-    search = "SELECT * FROM actions WHERE time BETWEEN " + str(start_time) + " and " + str(end_time)
-    c.execute(search)
-    all_rows = c.fetchall()
+def summarize_actions(rows):
+    """
+    compute the viewer summary in Python, for SQLite versions without
+    window functions
 
-    return (num_deletions, num_runs, total_time/1000, all_rows)
+    rows: (iterable) (name, time) of each action, sorted by time
+    """
+    num_deletions = 0
+    num_runs = 0
+    total_time = 0
+    last_time = None
+    for name, t in rows:
+        if name == 'delete-cell':
+            num_deletions += 1
+        elif name.startswith('run-cell'):
+            num_runs += 1
+        if last_time is not None and t - last_time < SESSION_GAP:
+            total_time += t - last_time
+        last_time = t
+    return num_deletions, num_runs, total_time
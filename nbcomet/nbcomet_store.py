@@ -0,0 +1,245 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+"""
+
+import os
+import gzip
+import json
+import uuid
+from hashlib import sha1
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import nbformat
+
+from nbcomet.nbcomet_dir import create_dir, get_version_index
+
+# Versions can be stored as full copies of the notebook (.ipynb), or as a
+# small manifest (.manifest) listing the hashes of each cell's body and
+# outputs. In the latter case, each distinct body or list of outputs is
+# stored only once, as a compressed blob shared by all versions. Manifests
+# are written holding a shared lock on the blob directory, and unused blobs
+# are removed holding an exclusive one (see blob_lock).
+
+BLOB_LOCK = 'lock'
+
+def save_version(nb, version_dir, version_fname, storage='files', data=None,
+                    action_time=None):
+    """
+    save a version of the notebook
+    returns the path of the saved version
+
+    nb: (dict) notebook to save
+    version_dir: (str) directory holding the versions of this notebook
+    version_fname: (str) name of the version, without file extension
+    storage: (str) 'files' to save a full copy, 'dedup' to save a manifest
+    data: (bytes) the notebook as serialized by serialize_notebook, if
+        already done for the snapshot, so full copies reuse it
+    action_time: (int) time of the last action the version reflects, in ms
+        since epoch, so the version can be used to replay later actions from
+    """
+    if storage == 'dedup':
+        path = os.path.join(version_dir, version_fname + '.manifest')
+        write_manifest(nb, path)
+    else:
+        path = os.path.join(version_dir, version_fname + '.ipynb')
+        if data is None:
+            data = serialize_notebook(nb)
+        atomic_write(path, data, fsync=True)
+
+    get_version_index(version_dir).add(os.path.basename(path),
+                                        os.path.getsize(path), len(nb['cells']),
+                                        action_time)
+    return path
+
+def serialize_notebook(nb):
+    """
+    serialize a notebook in the same JSON layout as nbformat.write, but
+    without validating or deep copying it first, so the result can be
+    written to the snapshot and a version without serializing twice
+
+    nb: (dict) notebook JSON, in the current notebook format
+    """
+    data = json.dumps(strip_transient(nb), indent=1, sort_keys=True,
+                        separators=(',', ': '), ensure_ascii=False)
+    return (data + '\n').encode('utf-8')
+
+def strip_transient(nb):
+    # leave out metadata nbformat.write strips, copying only what changes
+    transient = ['orig_nbformat', 'orig_nbformat_minor', 'orig_nbformat_file']
+    if any(k in nb.get('metadata', {}) for k in transient):
+        metadata = dict((k, v) for k, v in nb['metadata'].items()
+                        if k not in transient)
+        nb = dict(nb, metadata=metadata)
+
+    if any('trusted' in c.get('metadata', {}) for c in nb['cells']):
+        cells = []
+        for c in nb['cells']:
+            if 'trusted' in c.get('metadata', {}):
+                metadata = dict((k, v) for k, v in c['metadata'].items()
+                                if k != 'trusted')
+                c = dict(c, metadata=metadata)
+            cells.append(c)
+        nb = dict(nb, cells=cells)
+    return nb
+
+def validate_notebook(nb):
+    """
+    check a notebook against the notebook format schema, which is slow and
+    only done when the validate_snapshots setting is on
+    returns True if the notebook is valid
+
+    nb: (dict) notebook JSON
+    """
+    try:
+        nbformat.validate(nb)
+        return True
+    except nbformat.ValidationError as e:
+        print("NBComet snapshot is not a valid notebook: %s" % e)
+        return False
+
+def read_version(path):
+    """
+    read a saved version, rebuilding it from its blobs if it is a manifest
+
+    path: (str) path to a full notebook or a version manifest
+    """
+    if os.path.splitext(path)[1] == '.manifest':
+        return nbformat.from_dict(read_manifest(path))
+    return nbformat.read(path, nbformat.NO_CONVERT)
+
+def write_manifest(nb, path):
+    """
+    save a notebook as a manifest of cell hashes, storing any new cell bodies
+    or outputs as blobs
+
+    nb: (dict) notebook to save
+    path: (str) where to save the manifest
+    """
+    blob_dir = os.path.join(os.path.dirname(path), 'blobs')
+
+    with blob_lock(blob_dir):
+        cells = []
+        for c in nb['cells']:
+            body = dict((k, v) for k, v in c.items() if k != 'outputs')
+            body_hash = put_blob(blob_dir, body)
+            outputs_hash = None
+            if 'outputs' in c:
+                outputs_hash = put_blob(blob_dir, c['outputs'])
+            cells.append([body_hash, outputs_hash])
+
+        manifest = {'nbformat': nb['nbformat'],
+                    'nbformat_minor': nb['nbformat_minor'],
+                    'metadata': nb['metadata'],
+                    'cells': cells}
+        atomic_write(path, json.dumps(manifest, sort_keys=True)
+                            .encode('utf-8'), fsync=True)
+
+@contextmanager
+def blob_lock(blob_dir, exclusive=False):
+    """
+    hold the lock on a blob directory, shared by the servers writing
+    manifests, and exclusive for removing unused blobs, so a blob is never
+    removed while a manifest referring to it is being written
+
+    blob_dir: (str) directory holding the blobs
+    exclusive: (bool) take the lock for removing blobs
+    """
+    create_dir(blob_dir)
+    with open(os.path.join(blob_dir, BLOB_LOCK), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive
+                                    else fcntl.LOCK_SH)
+        yield
+
+def read_manifest(path):
+    """
+    rebuild the notebook JSON saved in a manifest
+
+    path: (str) path to the manifest
+    """
+    blob_dir = os.path.join(os.path.dirname(path), 'blobs')
+    with open(path) as f:
+        manifest = json.load(f)
+
+    cells = []
+    for body_hash, outputs_hash in manifest['cells']:
+        cell = get_blob(blob_dir, body_hash)
+        if outputs_hash is not None:
+            cell['outputs'] = get_blob(blob_dir, outputs_hash)
+        cells.append(cell)
+
+    return {'nbformat': manifest['nbformat'],
+            'nbformat_minor': manifest['nbformat_minor'],
+            'metadata': manifest['metadata'],
+            'cells': cells}
+
+def put_blob(blob_dir, obj):
+    """
+    store a JSON serializable object as a compressed blob, if not yet stored
+    returns the hash identifying the blob
+
+    blob_dir: (str) directory holding the blobs
+    obj: (object) JSON serializable data to store
+    """
+    data = json.dumps(obj, sort_keys=True).encode('utf-8')
+    blob_hash = sha1(data).hexdigest()
+    path = blob_path(blob_dir, blob_hash)
+    if not os.path.isfile(path):
+        create_dir(os.path.dirname(path))
+        atomic_write(path, gzip.compress(data), fsync=True)
+    else:
+        # mark the blob as in use, so retention doesn't remove it while the
+        # manifest referring to it is being written
+        os.utime(path, None)
+    return blob_hash
+
+def get_blob(blob_dir, blob_hash):
+    """
+    load a blob stored with put_blob
+
+    blob_dir: (str) directory holding the blobs
+    blob_hash: (str) hash identifying the blob
+    """
+    with open(blob_path(blob_dir, blob_hash), 'rb') as f:
+        return json.loads(gzip.decompress(f.read()).decode('utf-8'))
+
+def blob_path(blob_dir, blob_hash):
+    # spread blobs over subdirectories to keep directory listings short
+    return os.path.join(blob_dir, blob_hash[0:2], blob_hash + '.json.gz')
+
+def atomic_write(path, data, fsync=False):
+    """
+    write data to a file so readers never see a partially written file,
+    keeping the mode of the file it replaces, or the mode open() gives new
+    files
+
+    path: (str) path of the file to write
+    data: (bytes) contents of the file
+    fsync: (bool) wait for the file to reach the disk before replacing the
+        old one, so a crash never leaves an empty file, which versions and
+        the blobs they refer to need, but snapshots can do without
+    """
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = None
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex[0:8])
+    # let the umask apply to the new file, as open() does
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if mode is not None and hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), mode)
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -5,12 +5,28 @@ NBComet: Jupyter Notebook extension to track full notebook history
 import os
 import time
 import json
+import logging
+import sqlite3
 import datetime
-import nbformat
-import pickle
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-from nbcomet.nbcomet_sqlite import get_viewer_data
 from nbcomet.nbcomet_diff import valid_ids
+from nbcomet.nbcomet_dir import version_time, version_name, to_timestamp
+from nbcomet.nbcomet_store import atomic_write
+from nbcomet.nbcomet_metrics import metrics
+from nbcomet.nbcomet_catalog import get_catalog, name_key
+from nbcomet.nbcomet_backend import get_backend
+
+log = logging.getLogger(__name__)
+
+# one line per summarized version, in the notebook's storage directory
+SUMMARY_FILE = 'summary.jsonl'
+
+# most notebook summaries to keep in memory
+MAX_SUMMARIES = 64
 
 # TODO package current view as "timeline" view that only needs metadata
 # TODO build separate history view that linearly renders every version cell that
@@ -18,14 +34,40 @@ from nbcomet.nbcomet_diff import valid_ids
 # TODO build smart collapsing of history view for redundant cell executions
 # TODO build minimap that shows where edited or run cell is in notebook
 
+def get_notebook_names(data_dir, hashed_path, fname):
+    """
+    get the history of names this file has had from the catalog, or from the
+    latest snapshot of notebooks saved before there was a catalog
+    returns [[name key, start_time, end_time], ...], see get_prior_filenames
+
+    data_dir: (str) NBComet data directory
+    hashed_path: (str) hashed directory of the notebook
+    fname: (str) name of the notebook, without extension
+    """
+    try:
+        prior_names = get_catalog(data_dir).prior_names(
+                                            hashed_path + '/' + fname)
+    except sqlite3.Error as e:
+        log.warning("NBComet could not read the catalog: %s", e)
+        prior_names = None
+
+    if prior_names is None:
+        key = hashed_path + '/' + fname
+        snapshot = get_backend(data_dir).read_snapshot(key, lambda cells: None)
+        if snapshot is None:
+            raise IOError("No NBComet snapshot of %s" % key)
+        prior_names = get_prior_filenames(snapshot[0], hashed_path, fname)
+    return prior_names
+
 def get_prior_filenames(nb, hashed_path, fname):
     # get the history of names this file has had
-    # returns [[name, start_time, end_time], ...]
+    # returns [[name key, start_time, end_time], ...], see name_key
 
     if "comet_paths" in nb["metadata"]:
-        prior_names = nb['metadata']['comet_paths']
+        prior_names = [[name_key(n[0]), n[1]]
+                        for n in nb['metadata']['comet_paths']]
     else:
-        prior_names = [[os.path.join(hashed_path, fname), 0]]
+        prior_names = [[hashed_path + '/' + fname, 0]]
 
     # get time range when file had each name
     for i, v in enumerate(prior_names):
@@ -41,96 +83,109 @@ def get_action_data(data_dir, prior_names):
     total_dels = 0
     total_runs = 0
     total_time = 0
-    all_actions = []
 
     # get the high-level overview about nb use
+    backend = get_backend(data_dir)
     for n in prior_names:
-        hp = n[0].split('/')[0]
-        fn = n[0].split('/')[1].split('.')[0]
         start_time = n[1]
         end_time = n[2]
 
         try:
-            db = os.path.join(data_dir, hp, fn, fn + ".db")
-            d, r, t, actions = get_viewer_data(db, start_time, end_time)
-
-            total_dels += d
-            total_runs += r
-            total_time += t
-            for a in actions:
-                all_actions.append(list(a))
-        except:
-            print("Had trouble accesing db")
+            data = backend.action_data(n[0], start_time, end_time)
+        except sqlite3.Error as e:
+            log.warning("NBComet could not read the actions of %s: %s",
+                        n[0], e)
+            continue
+        if data is None:
+            log.warning("NBComet has no actions for %s", n[0])
+            continue
+
+        d, r, t = data
+
+        total_dels += d
+        total_runs += r
+        total_time += t
 
-    return total_dels, total_runs, total_time, all_actions
+    return total_dels, total_runs, total_time
 
 def get_saved_versions(prior_names, data_dir, all_actions):
     # get the notebook versions that fall in our specified ranges for each file
+    return [path for path, t in get_saved_version_entries(prior_names, data_dir)]
+
+def get_saved_version_entries(prior_names, data_dir):
+    """
+    get the versions saved under each of the notebook's names, in the time
+    range the notebook had that name, using each name's version index
+    returns a list of [version path, time saved], sorted by time, see
+    version_path
+
+    prior_names: (list) names of the notebook, see get_prior_filenames
+    data_dir: (str) NBComet data directory
+    """
+    backend = get_backend(data_dir)
     versions = []
     for n in prior_names:
-        hp = n[0].split('/')[0]
-        fn = n[0].split('/')[1].split('.')[0]
-
-        # get all the versions of the notebook sharing this name
-        version_dir = os.path.join(data_dir, hp, fn, 'versions')
-        if os.path.isdir(version_dir):
-            versions_with_this_name = [ f for f in os.listdir(version_dir)
-                if os.path.isfile(os.path.join(version_dir, f))
-                and f[-6:] == '.ipynb']
-
-            # filter this list to only those in the correct time frame
-            for v in versions_with_this_name:
-                try:
-                    nb_time = datetime.datetime.strptime(v[-32:-6],
-                        "%Y-%m-%d-%H-%M-%S-%f")
-                    start_time = datetime.datetime.fromtimestamp(n[1]/1000) - datetime.timedelta(seconds=1)
-                    end_time = datetime.datetime.fromtimestamp(n[2]/1000)
-                    if nb_time <= end_time and nb_time >= start_time:
-                        versions.append(os.path.join(hp, fn, 'versions', v))
-                except:
-                    print("Trouble checking time of file versions")
+        # get all the versions of the notebook sharing this name, in the
+        # correct time frame
+        for e in backend.version_entries(n[0], n[1] / 1000 - 1, n[2] / 1000):
+            versions.append([version_path(n[0], e['file']), e['time']])
     return versions
 
-def get_activity_gaps(versions):
-    #TODO return the seconds of the gap
-    gaps = []
-    for i, v in enumerate(versions):
-        # look for gaps of over 15 min in activity
-
-        if i > 0:
+def version_path(key, filename):
+    """
+    get the path that identifies a version in the viewer and its summary,
+    relative to the data directory of the file backend
+
+    key: (str) hashed directory and name of the notebook
+    filename: (str) file name of the version, from its index entry
+    """
+    return os.path.join(key, 'versions', filename)
+
+def version_key(path):
+    # get the notebook key and file name of a version from its path
+    version_dir, filename = os.path.split(path)
+    return os.path.dirname(version_dir), filename
+
+def get_activity_gaps(versions, times=None):
+    """
+    find gaps of over 15 min in activity between consecutive versions
+    returns a list of [index of version after the gap, gap in seconds]
+
+    versions: (list) paths of the versions, in order
+    times: (list) time each version was saved in seconds since epoch, parsed
+        from the version file names if not given
+    """
+    if times is None:
+        times = []
+        for v in versions:
             try:
-                current_nb_time = datetime.datetime.strptime(v[-32:-6],
-                    "%Y-%m-%d-%H-%M-%S-%f")
-                past_nb_time = datetime.datetime.strptime(versions[i-1][-32:-6],
-                    "%Y-%m-%d-%H-%M-%S-%f")
-                time_diff = current_nb_time - past_nb_time
-                if time_diff.total_seconds() >= 15 * 60:
-                    gaps.append([i, time_diff.total_seconds()])
-            except:
+                times.append(to_timestamp(version_time(v)))
+            except ValueError:
                 print("Trouble checking version time to determine gaps in activity")
-    return gaps
-
-def get_cell_data(data_dir, versions, vi, all_actions, last_change):
-    cell_data = []
-
-    nb_b_path = os.path.join(data_dir, versions[vi])
-    nb_b = nbformat.read(nb_b_path, nbformat.NO_CONVERT)['cells']
+                times.append(None)
 
-    # get ids of next nb
-    next_cell_ids = []
-    if vi < len(versions) - 1:
-        nb_c_path = nb_b_path = os.path.join(data_dir, versions[vi + 1])
-        nb_c = nbformat.read(nb_c_path, nbformat.NO_CONVERT)['cells']
-
-        for i, c in enumerate(nb_c):
-            # get the cell id
-            try:
-                cell_id = c.metadata.comet_cell_id
-            except:
-                cell_id = i
-            next_cell_ids.append(cell_id)
+    gaps = []
+    for i in range(1, len(times)):
+        if times[i] is None or times[i-1] is None:
+            continue
+        time_diff = times[i] - times[i-1]
+        if time_diff >= 15 * 60:
+            gaps.append([i, time_diff])
+    return gaps
 
-    for i, c in enumerate(nb_b):
+def read_version_cells(data_dir, path):
+    """
+    read a version and reduce each cell to what the viewer needs
+    returns a list of [cell id, cell type, source], where the cell type of
+    code cells is the "highest" type of their outputs
+
+    data_dir: (str) NBComet data directory
+    path: (str) path of the version, see version_path
+    """
+    cells = []
+    key, filename = version_key(path)
+    nb = get_backend(data_dir).read_version(key, filename)
+    for i, c in enumerate(nb['cells']):
         # get the cell id
         try:
             cell_id = c.metadata.comet_cell_id
@@ -153,77 +208,413 @@ def get_cell_data(data_dir, versions, vi, all_actions, last_change):
             elif "stream" in output_types:
                 cell_type = "stream"
 
+        cells.append([cell_id, cell_type, c.source])
+    return cells
+
+def load_versions(data_dir, paths, processes=0, chunksize=8):
+    """
+    stream the cells of each version, in order, reading every version once,
+    and spreading the reads over a pool of processes if there are many
+
+    data_dir: (str) NBComet data directory
+    paths: (list) paths of the versions, see version_path
+    processes: (int) number of processes to use, 0 to read in this process
+    chunksize: (int) number of versions each process reads at a time
+    """
+    if processes and len(paths) >= processes * chunksize:
+        with ProcessPoolExecutor(processes) as pool:
+            for cells in pool.map(read_version_cells,
+                                [data_dir] * len(paths), paths,
+                                chunksize=chunksize):
+                yield cells
+    else:
+        for path in paths:
+            yield read_version_cells(data_dir, path)
+
+def get_cell_data(version_cells, vi, last_change):
+    """
+    get the viewer record of each cell in one version of the notebook
+    returns (cell data, cell ids), cells are marked as not deleted until we
+    see the next version, see mark_deleted_cells
+
+    version_cells: (list) cells of the version, from read_version_cells
+    vi: (int) index of the version in the list of versions
+    last_change: (dict) for each cell id, the index of the version where its
+        source last changed and that source, updated in place
+    """
+    cell_data = []
+    cell_ids = []
+
+    for cell_id, cell_type, source in version_cells:
+        cell_ids.append(cell_id)
+
         # if a new notebook, or we have not seen the cell before
         if vi == 0 or cell_id not in last_change:
-            new_source = c.source
-            last_change[cell_id] = [vi, c.source]
+            new_source = source
+            last_change[cell_id] = [vi, source]
             last_source = 'false'
         # but if we have seen this cell before
         else:
-            if last_change[cell_id][1] == c.source:
+            if last_change[cell_id][1] == source:
                 new_source = 'false'
                 last_source = last_change[cell_id][0]
             else:
-                new_source = c.source
+                new_source = source
                 last_source = last_change[cell_id][0]
-                last_change[cell_id] = [vi, c.source]
-        # get deleted metric
-        if vi == len(versions) - 1:
-            deleted = 'false'
-        elif cell_id in next_cell_ids:
-            deleted = 'false'
+                last_change[cell_id] = [vi, source]
+
+        cell_data.append( [cell_id, cell_type, new_source, last_source, 'false'] )
+
+    return cell_data, cell_ids
+
+def mark_deleted_cells(cell_data, next_cell_ids):
+    """
+    mark the cells of a version that are gone in the next version as deleted
+
+    cell_data: (list) cell records of the version, updated in place
+    next_cell_ids: (set) ids of the cells in the next version
+    """
+    for c in cell_data:
+        c[4] = 'false' if c[0] in next_cell_ids else 'true'
+
+def get_version_data(data_dir, versions, all_actions, summary=None,
+                    processes=0, records=None):
+    """
+    get the viewer record of each version, only reading the versions that
+    are not yet part of the summary
+    returns the updated summary, see new_summary
+
+    data_dir: (str) NBComet data directory
+    versions: (list) paths of the versions, in order, see version_path
+    all_actions: (list) actions performed on the notebook
+    summary: (dict) summary of earlier versions, or None to start over
+    processes: (int) number of processes used to read versions
+    records: (list) collects the JSON record of each version read, to be
+        saved, see VersionSummary
+    """
+    # versions removed by retention are dropped from the summary, and it
+    # starts over if the versions we summarized are otherwise no longer the
+    # first ones, a summary of more versions than asked for is fine as it is
+    if (summary is not None
+        and summary['versions'] != versions[0:len(summary['versions'])]
+        and versions != summary['versions'][0:len(versions)]):
+        summary = drop_versions(summary, versions, records)
+    if summary is None:
+        summary = new_summary()
+
+    first = len(summary['versions'])
+    loaded = load_versions(data_dir, versions[first:], processes)
+    for v, version_cells in zip(versions[first:], loaded):
+        add_version(summary, v, version_cells, records)
+
+    return summary
+
+def add_version(summary, v, version_cells, records=None):
+    """
+    add the next version to a summary
+
+    summary: (dict) summary of the versions before it, updated in place
+    v: (str) path of the version, see version_path
+    version_cells: (list) cells of the version, from read_version_cells
+    records: (list) collects the JSON record of the version, see
+        get_version_data
+    """
+    i = len(summary['versions'])
+    last_change = summary['last_change']
+
+    # get name and time of nb version
+    nb_name = version_name(v)
+    current_nb_time = version_time(v)
+    current_nb_time_str = datetime.datetime.strftime(current_nb_time,
+        "%a %b %d, %Y - %-I:%M %p")
+    cell_data, cell_ids = get_cell_data(version_cells, i, last_change)
+
+    # set up our version document
+    v_data = {'num': i,
+            'name': nb_name,
+            'time': current_nb_time_str,
+            'cells': cell_data};
+
+    # note the cells whose source changed, so the summary can be picked
+    # up again from its saved records
+    record = {'version': v,
+            'data': v_data,
+            'changed': [c for c in cell_ids if last_change[c][0] == i]}
+    if records is not None:
+        # save the cells before the next version marks deleted ones
+        records.append(json.dumps(record))
+    add_record(summary, record)
+
+def drop_versions(summary, versions, records=None):
+    """
+    summarize the versions of a summary that are still saved again, from
+    the cells the summary holds, without reading any version
+    returns the new summary, or None if versions were not only removed
+
+    summary: (dict) summary of the versions before some were removed
+    versions: (list) paths of the versions now saved, in order
+    records: (list) collects the JSON record of each version kept, see
+        get_version_data
+    """
+    saved = set(versions)
+    kept = [v for v in summary['versions'] if v in saved]
+    if not kept or kept != versions[0:len(kept)]:
+        return None
+
+    new = new_summary()
+    sources = {}
+    for v, v_data in zip(summary['versions'], summary['version_data']):
+        # cells whose source did not change only point back to it
+        version_cells = []
+        for cell_id, cell_type, source, last_source, deleted in v_data['cells']:
+            if source == 'false' and last_source != 'false':
+                source = sources[cell_id]
+            sources[cell_id] = source
+            version_cells.append([cell_id, cell_type, source])
+        if v in saved:
+            add_version(new, v, version_cells, records)
+    return new
+
+def new_summary():
+    # summary of the versions of a notebook, as kept by get_version_data
+    return {'versions': [], 'version_data': [], 'last_change': {}}
+
+def add_record(summary, record):
+    """
+    add the record of the next version to a summary
+
+    summary: (dict) summary of the versions before it, updated in place
+    record: (dict) record of the version, see get_version_data
+    """
+    i = len(summary['versions'])
+    cells = record['data']['cells']
+
+    # cells of the prior version that are not in this one were deleted
+    if i > 0:
+        mark_deleted_cells(summary['version_data'][i-1]['cells'],
+                            set(c[0] for c in cells))
+
+    sources = dict((c[0], c[2]) for c in cells)
+    for cell_id in record['changed']:
+        summary['last_change'][cell_id] = [i, sources[cell_id]]
+
+    summary['version_data'].append(record['data'])
+    summary['versions'].append(record['version'])
+
+def summary_path(data_dir, hashed_path, fname):
+    return os.path.join(get_backend(data_dir).dest_dir(hashed_path + '/'
+                                                        + fname), SUMMARY_FILE)
+
+class VersionSummary(object):
+    """
+    Viewer records of a notebook's versions, kept in memory and in an
+    append-only file with one line per version, so adding a version to the
+    summary writes only its record rather than the summary of every version
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.inode = None
+        self.size = 0
+        self.summary = new_summary()
+
+    def refresh(self):
+        # read the records appended since we last looked, e.g. by another
+        # server, starting over if the file was replaced
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            self.inode, self.size, self.summary = None, 0, new_summary()
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.size:
+                self.inode, self.size = st.st_ino, 0
+                self.summary = new_summary()
+            f.seek(self.size)
+            for line in f:
+                # leave a partially written line for next time
+                if not line.endswith(b'\n'):
+                    break
+                self.size += len(line)
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                add_record(self.summary, record)
+
+    def update(self, data_dir, versions, processes=0):
+        """
+        summarize the versions not yet in the summary, and save their records
+
+        data_dir: (str) NBComet data directory
+        versions: (list) paths of the versions, in order, see version_path
+        processes: (int) number of processes used to read versions
+        """
+        with self.lock:
+            self.refresh()
+            records = []
+            summary = get_version_data(data_dir, versions, [], self.summary,
+                                        processes, records)
+            if summary is not self.summary:
+                self.write(records)
+            elif records:
+                self.append(records)
+            self.summary = summary
+
+    def write(self, records):
+        # replace the file, when the summary started over
+        atomic_write(self.path, ''.join(r + '\n' for r in records)
+                                    .encode('utf-8'))
+        st = os.stat(self.path)
+        self.inode, self.size = st.st_ino, st.st_size
+
+    def append(self, records):
+        data = ''.join(r + '\n' for r in records).encode('utf-8')
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            st = os.fstat(f.fileno())
+        # if another process appended too, read the whole file next time
+        same_file = st.st_ino == self.inode or (self.inode is None
+                                                and self.size == 0)
+        if same_file and st.st_size == self.size + len(data):
+            self.inode, self.size = st.st_ino, st.st_size
         else:
-            deleted = 'true'
-
-        cell_data.append( [cell_id, cell_type, new_source, last_source, deleted] )
-
-    return cell_data, last_change
-
-def get_version_data(data_dir, versions, all_actions):
-    version_data = []
-    last_change = {}
-
-    for i, v in enumerate(versions):
-
-        # get name and time of nb version
-        nb_name = v[0:-33].split('/')[-1] + '.ipynb'
-        current_nb_time = datetime.datetime.strptime(v[-32:-6],
-            "%Y-%m-%d-%H-%M-%S-%f")
-        current_nb_time_str = datetime.datetime.strftime(current_nb_time,
-            "%a %b %d, %Y - %-I:%M %p")
-        cell_data, last_change = get_cell_data(data_dir, versions, i, all_actions, last_change)
-
-        # set up our version document
-        v_data = {'num': i,
-                'name': nb_name,
-                'time': current_nb_time_str,
-                'cells': cell_data};
-
-        version_data.append(v_data)
-
-    return version_data
-
-def get_viewer_html(data_dir, hashed_path, fname):
-    # get paths to files and databases
-    nb_path = os.path.join(data_dir, hashed_path, fname, fname + '.ipynb')
-    nb = nbformat.read(nb_path, nbformat.NO_CONVERT)
-
+            self.inode = None
+
+    def version_data(self, first=0, last=None):
+        """
+        get copies of the viewer records of a range of versions
+
+        first: (int) position of the first version
+        last: (int) position after the last version, or None for all
+        """
+        with self.lock:
+            return [dict(d, cells=[list(c) for c in d['cells']])
+                    for d in self.summary['version_data'][first:last]]
+
+def update_summary(data_dir, hashed_path, fname, versions=None, nb=None,
+                    processes=0):
+    """
+    bring the saved summary of a notebook's versions up to date, only reading
+    the versions saved since it was last updated
+    returns the notebook's VersionSummary
+
+    data_dir: (str) NBComet data directory
+    hashed_path: (str) hashed directory of the notebook
+    fname: (str) name of the notebook, without extension
+    versions: (list) versions to summarize, looked up if not given
+    nb: (NotebookNode) current snapshot of the notebook, used to look up
+        the versions, read from disk if not given
+    processes: (int) number of processes used to read versions
+    """
+    if versions is None:
+        if nb is None:
+            prior_names = get_notebook_names(data_dir, hashed_path, fname)
+        else:
+            prior_names = get_prior_filenames(nb, hashed_path, fname)
+        versions = get_saved_versions(prior_names, data_dir, [])
+
+    summary = get_version_summary(summary_path(data_dir, hashed_path, fname))
+    summary.update(data_dir, versions, processes)
+    return summary
+
+def get_version_summary(path):
+    """
+    get the shared, cached summary of a notebook, so each notebook's summary
+    is updated by one thread at a time
+
+    path: (str) path to the summary file
+    """
+    with version_summaries_lock:
+        summary = version_summaries.get(path)
+        if summary is None:
+            summary = VersionSummary(path)
+            version_summaries[path] = summary
+        version_summaries.move_to_end(path)
+        # keep the summaries of recently viewed or saved notebooks
+        while len(version_summaries) > MAX_SUMMARIES:
+            version_summaries.popitem(last=False)
+        return summary
+
+version_summaries = OrderedDict()
+version_summaries_lock = threading.Lock()
+
+def get_viewer_summary(data_dir, hashed_path, fname):
+    """
+    get the overview of a notebook's history, without reading any version,
+    so the viewer can show it right away and then load versions in pages
+    returns the overview and the [path, time saved] of each version
+
+    data_dir: (str) NBComet data directory
+    hashed_path: (str) hashed directory of the notebook
+    fname: (str) name of the notebook, without extension
+    """
     # get names, actions, and versions for this
-    prior_names = get_prior_filenames(nb, hashed_path, fname)
-    total_dels, total_runs, total_time, all_actions = get_action_data(data_dir, prior_names)
-    versions = get_saved_versions(prior_names, data_dir, all_actions)
+    prior_names = get_notebook_names(data_dir, hashed_path, fname)
+    with metrics.timer('viewer_actions'):
+        total_dels, total_runs, total_time = get_action_data(data_dir,
+                                                            prior_names)
+    with metrics.timer('viewer_versions'):
+        entries = get_saved_version_entries(prior_names, data_dir)
 
     # set up json datastructure
     data = {'name': fname,
             'editTime': total_time,
             'numRuns': total_runs,
             'numDeletions': total_dels,
-            'gaps': [],
-            'versions':[]};
-
-    # get data for each version
-    if len(versions) > 0:
-        data['gaps'] = get_activity_gaps(versions)
-        data['versions'] = get_version_data(data_dir, versions, all_actions)
-
-    return data
+            'numVersions': len(entries),
+            'gaps': []};
+
+    if entries:
+        data['gaps'] = get_activity_gaps([v for v, t in entries],
+                                        [t for v, t in entries])
+    return data, entries
+
+def get_version_page(data_dir, hashed_path, fname, offset=0, limit=50,
+                    start_time=None, end_time=None, processes=0):
+    """
+    get the viewer data of a page of versions, by position or by the time
+    the versions were saved
+    returns a dict with the total number of versions, the position of the
+    first version of the page, and the data of the versions in the page
+
+    data_dir: (str) NBComet data directory
+    hashed_path: (str) hashed directory of the notebook
+    fname: (str) name of the notebook, without extension
+    offset: (int) position of the first version of the page
+    limit: (int) maximum number of versions in the page
+    start_time: (float) only versions saved at or after this time, in
+        seconds since epoch
+    end_time: (float) only versions saved at or before this time, in
+        seconds since epoch
+    processes: (int) number of processes used to read versions
+    """
+    with metrics.timer('viewer_page'):
+        prior_names = get_notebook_names(data_dir, hashed_path, fname)
+        entries = get_saved_version_entries(prior_names, data_dir)
+
+        # narrow the page down to the time window, if one is given
+        first = 0
+        last = len(entries)
+        if start_time is not None:
+            first = bisect_left([t for v, t in entries], start_time)
+        if end_time is not None:
+            last = bisect_right([t for v, t in entries], end_time)
+        first = max(first + offset, 0)
+        last = min(last, first + limit)
+
+        # versions depend on the ones before them, and cells are only
+        # marked as deleted once the next version is read, so the summary
+        # covers everything up to one version past the end of the page
+        version_data = []
+        if first < last:
+            summary = update_summary(data_dir, hashed_path, fname,
+                                    [v for v, t in entries[0:last+1]],
+                                    processes=processes)
+            version_data = summary.version_data(first, last)
+
+        return {'total': len(entries),
+                'offset': first,
+                'versions': version_data}
@@ -191,6 +191,26 @@ define([
 
 
 // SEND ACTION DATA TO SERVER
+    // Revision of the notebook the server last acknowledged, and the JSON of
+    // each cell at that revision, so we can send only the cells that changed
+    var lastRevision = null;
+    var lastSentCells = {};
+
+    // Batches waiting to be sent, one request at a time so each delta is
+    // computed against an acknowledged model
+    var queuedBatches = [];
+    var sending = false;
+
+    // Actions are buffered and sent together, after a short quiet period or
+    // once enough have piled up, and held back while the kernel is busy so
+    // tracking requests don't compete with kernel messages
+    var flushDelay = 500;
+    var maxBufferedActions = 50;
+    var actionBuffer = [];
+    var bufferUrl = null;
+    var flushTimer = null;
+    var kernelBusy = false;
+
     function trackAction(notebook, t, actionName, selectedIndex,
                         selectedIndices){
         /* Send information about data to Comet Server to process */
@@ -200,36 +220,235 @@ define([
             var notebookUrl =  notebook.notebook_path;
             var url = utils.url_path_join(baseUrl, 'api/nbcomet', notebookUrl);
 
-            var mod = notebook.toJSON();
-            var d = JSON.stringify({
-                time: t,
-                name: actionName,
-                index: selectedIndex,
-                indices: selectedIndices,
-                model: mod
+            // actions for a renamed notebook go in a batch of their own
+            if(bufferUrl !== null && bufferUrl != url){
+                flushActions(true);
+            }
+
+            // capture the notebook as it is now, the request may wait a while
+            bufferUrl = url;
+            actionBuffer.push({
+                action: {
+                    time: t,
+                    name: actionName,
+                    index: selectedIndex,
+                    indices: selectedIndices
+                },
+                mod: notebook.toJSON()
             });
 
-            var settings = {
-                processData : false,
-                type : 'POST',
-                dataType: 'json',
-                data: d,
-                contentType: 'application/json',
-            };
-
-            utils.promising_ajax(url, settings).then(function(value){
-                var hashed_nb_path = value['hashed_nb_path']
-                var paths = Notebook.metadata.comet_paths
-
-                if(paths.length == 0){
-                    var t = Date.now();
-                    paths.push([hashed_nb_path, t])
-                }
-                else if(paths[paths.length-1][0] != hashed_nb_path){
-                    var t = Date.now();
-                    paths.push([hashed_nb_path, t])
+            // the page is unloading, so send everything not sent yet now,
+            // as the page won't wait for requests in flight to finish
+            if(actionName == 'notebook-closed'){
+                flushActions(true);
+                sendQueuedOnClose();
+                return;
+            }
+
+            if(actionBuffer.length >= maxBufferedActions){
+                flushActions(true);
+            }
+            else{
+                scheduleFlush();
+            }
+        }
+    }
+
+    function scheduleFlush(){
+        /* Flush the buffered actions once no new action came for a while */
+        if(flushTimer !== null){
+            clearTimeout(flushTimer);
+        }
+        flushTimer = setTimeout(function(){
+            flushTimer = null;
+            flushActions(false);
+        }, flushDelay);
+    }
+
+    function flushActions(force){
+        /* Queue the buffered actions to be sent as one batch, waiting for the
+        kernel to go idle unless forced */
+        if(actionBuffer.length == 0 || (kernelBusy && !force)){
+            return;
+        }
+        var url = bufferUrl;
+        var items = takeBufferedActions();
+        queuedBatches.push({url: url, items: items});
+        sendQueued();
+    }
+
+    function sendQueued(){
+        /* Send the next queued batch once the one before it is answered */
+        if(sending || queuedBatches.length == 0){
+            return;
+        }
+        sending = true;
+        var next = queuedBatches.shift();
+        sendActions(next.url, next.items, true).then(function(){
+            sending = false;
+            sendQueued();
+        });
+    }
+
+    function sendQueuedOnClose(){
+        /* Send the queued batches with requests that outlive the page, each
+        starting from a full notebook. They may reach the server before a
+        request still in flight, which the server sorts out by action time */
+        while(queuedBatches.length > 0){
+            // batches to the same notebook go as one, so they stay in order
+            var next = queuedBatches.shift();
+            while(queuedBatches.length > 0 &&
+                    queuedBatches[0].url == next.url){
+                next.items = next.items.concat(queuedBatches.shift().items);
+            }
+            var batch = buildBatch(next.items, null).batch;
+            var url = next.url + '?closing=1&_xsrf=' +
+                encodeURIComponent(getCookie('_xsrf'));
+            var body = JSON.stringify({actions: batch});
+            if(navigator.sendBeacon){
+                navigator.sendBeacon(url, new Blob([body],
+                    {type: 'application/json'}));
+            }
+            else{
+                fetch(url, {method: 'POST', body: body, keepalive: true,
+                    credentials: 'same-origin',
+                    headers: {'Content-Type': 'application/json'}});
+            }
+        }
+    }
+
+    function getCookie(name){
+        /* Get a cookie's value, or an empty string if it is not set */
+        var match = document.cookie.match('(^|;)\\s*' + name + '=([^;]*)');
+        return match ? decodeURIComponent(match[2]) : '';
+    }
+
+    function takeBufferedActions(){
+        /* Empty the action buffer, returning the actions it held */
+        var items = actionBuffer;
+        actionBuffer = [];
+        bufferUrl = null;
+        if(flushTimer !== null){
+            clearTimeout(flushTimer);
+            flushTimer = null;
+        }
+        return items;
+    }
+
+    function trackKernelState(){
+        /* Hold back buffered actions while the kernel is busy */
+        events.on('kernel_busy.Kernel', function(){
+            kernelBusy = true;
+        });
+        events.on('kernel_idle.Kernel', function(){
+            kernelBusy = false;
+            scheduleFlush();
+        });
+    }
+
+    function indexCells(mod){
+        /* Get the JSON of each cell by id, or null if ids are missing or
+        duplicated and cells can't be matched by id */
+        var cellJSON = {};
+        var cellOrder = [];
+        for(var i = 0; i < mod.cells.length; i++){
+            var cellId = mod.cells[i].metadata.comet_cell_id;
+            if(cellId === undefined || cellJSON[cellId] !== undefined){
+                return null;
+            }
+            cellJSON[cellId] = JSON.stringify(mod.cells[i]);
+            cellOrder.push(cellId);
+        }
+        return {cellJSON: cellJSON, cellOrder: cellOrder};
+    }
+
+    function buildBatch(items, baseCells){
+        /* Get the batch of actions to send, with only the cells that changed
+        since the action before, or since baseCells for the first action,
+        and the full notebook when baseCells is null */
+        var firstIsDelta = false;
+        var batch = [];
+        var index = null;
+        for(var i = 0; i < items.length; i++){
+            var mod = items[i].mod;
+            var data = $.extend({}, items[i].action);
+            index = indexCells(mod);
+            if(index !== null && baseCells !== null){
+                var changed = {};
+                for(var j = 0; j < index.cellOrder.length; j++){
+                    var cellId = index.cellOrder[j];
+                    if(baseCells[cellId] !== index.cellJSON[cellId]){
+                        changed[cellId] = mod.cells[j];
+                    }
                 }
-            });
+                data.delta = {
+                    cells: changed,
+                    cell_order: index.cellOrder,
+                    metadata: mod.metadata,
+                    nbformat: mod.nbformat,
+                    nbformat_minor: mod.nbformat_minor
+                };
+                firstIsDelta = firstIsDelta || i == 0;
+            }
+            else{
+                data.model = mod;
+            }
+            // the server rebuilds each action from the one before it
+            baseCells = index === null ? null : index.cellJSON;
+            batch.push(data);
+        }
+        return {batch: batch, index: index, firstIsDelta: firstIsDelta};
+    }
+
+    function sendActions(url, items, allowDelta){
+        /* POST a batch of actions, sending only the cells that changed since
+        the action before, or since our last acknowledged revision for the
+        first action, and falling back to the full notebook otherwise */
+        var built = buildBatch(items, allowDelta && lastRevision !== null ?
+            lastSentCells : null);
+        var batch = built.batch;
+        var index = built.index;
+        var firstIsDelta = built.firstIsDelta;
+
+        var postUrl = url;
+        if(firstIsDelta){
+            postUrl = url + '?base_revision=' + encodeURIComponent(lastRevision);
+        }
+
+        var settings = {
+            processData : false,
+            type : 'POST',
+            dataType: 'json',
+            data: JSON.stringify({actions: batch}),
+            contentType: 'application/json',
+        };
+
+        return utils.promising_ajax(postUrl, settings).then(function(value){
+            lastRevision = value['revision'] === undefined ?
+                null : value['revision'];
+            lastSentCells = index === null ? {} : index.cellJSON;
+            updateCometPaths(value['hashed_nb_path']);
+        }).catch(function(error){
+            // the server does not have our base revision, send everything
+            lastRevision = null;
+            lastSentCells = {};
+            if(firstIsDelta && error.xhr && error.xhr.status == 409){
+                return sendActions(url, items, false);
+            }
+        });
+    }
+
+    function updateCometPaths(hashed_nb_path){
+        /* Remember the (hashed) paths this notebook was saved under */
+        var paths = Notebook.metadata.comet_paths
+
+        if(paths.length == 0){
+            var t = Date.now();
+            paths.push([hashed_nb_path, t])
+        }
+        else if(paths[paths.length-1][0] != hashed_nb_path){
+            var t = Date.now();
+            paths.push([hashed_nb_path, t])
         }
     }
 
@@ -440,6 +659,7 @@ define([
     function load_extension(){
         /* Called as extension loads and notebook opens */
         console.log('[NBComet] tracking changes to notebook');
+        trackKernelState();
         trackNotebookOpenClose();
         initializeCometMenu();
         patchActionHandlerCall();
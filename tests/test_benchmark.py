@@ -0,0 +1,40 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the micro-benchmark suite, on tiny notebooks
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+import nbcomet_benchmark
+
+STAGES = ['diff', 'diff_no_ids', 'indices_to_check', 'db_commit',
+        'viewer_cold', 'viewer_warm']
+
+def test_every_stage_runs():
+    results = nbcomet_benchmark.run_benchmarks([3], num_actions=20,
+                                                output_bytes=20,
+                                                num_versions=3)
+    assert list(results) == ['3']
+    assert sorted(results['3']) == sorted(STAGES)
+    for stage in STAGES:
+        assert results['3'][stage]['p50_ms'] > 0
+
+    results = nbcomet_benchmark.run_benchmarks([3], num_actions=20,
+                                                stages=['diff'])
+    assert list(results['3']) == ['diff']
+
+def test_slower_stages_are_flagged():
+    old = {'results': {'3': {'diff': {'p50_ms': 1.0},
+                            'db_commit': {'p50_ms': 1.0}}}}
+    new = {'results': {'3': {'diff': {'p50_ms': 1.5},
+                            'db_commit': {'p50_ms': 0.5},
+                            'viewer_cold': {'p50_ms': 1.0}}}}
+    lines = nbcomet_benchmark.compare_results(old, new)
+    assert len(lines) == 2
+    assert lines[0].endswith(' faster') and 'db_commit' in lines[0]
+    assert lines[1].endswith(' SLOWER') and 'diff' in lines[1]
@@ -0,0 +1,80 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the cache of the last committed snapshot of each notebook
+"""
+
+import os
+import json
+
+from nbcomet import nbcomet_cache
+from nbcomet.nbcomet_cache import SnapshotCache
+
+def notebook(source):
+    cells = [{'cell_type': 'markdown', 'metadata': {}, 'source': source}]
+    return {'cells': cells, 'metadata': {}, 'nbformat': 4,
+            'nbformat_minor': 2}
+
+def write(path, nb):
+    with open(path, 'w') as f:
+        json.dump(nb, f)
+
+def count_reads(monkeypatch):
+    reads = []
+    read = nbcomet_cache.nbformat.read
+    def counting_read(fname, as_version):
+        reads.append(fname)
+        return read(fname, as_version)
+    monkeypatch.setattr(nbcomet_cache.nbformat, 'read', counting_read)
+    return reads
+
+def test_committed_snapshot_is_not_read_again(tmpdir, monkeypatch):
+    reads = count_reads(monkeypatch)
+    cache = SnapshotCache()
+    path = str(tmpdir.join('nb.ipynb'))
+
+    assert cache.get(path) is None
+
+    nb = notebook('x')
+    write(path, nb)
+    cache.put(path, nb)
+    assert cache.get(path) is nb
+    assert reads == []
+
+    # the snapshot was replaced behind our back
+    os.utime(path, ns=(0, 0))
+    assert cache.get(path)['cells'][0]['source'] == 'x'
+    assert reads == [path]
+    cache.get(path)
+    assert reads == [path]
+
+    os.remove(path)
+    assert cache.get(path) is None
+    assert path not in cache.entries
+
+def test_cell_index_is_built_once_per_snapshot(tmpdir):
+    cache = SnapshotCache()
+    path = str(tmpdir.join('nb.ipynb'))
+    nb = notebook('x')
+    write(path, nb)
+    cache.put(path, nb)
+
+    built = []
+    def build_index(cells):
+        built.append(cells)
+        return len(built)
+    assert cache.get_with_index(path, build_index) == (nb, 1)
+    assert cache.get_with_index(path, build_index) == (nb, 1)
+    assert len(built) == 1
+
+def test_least_recently_used_snapshots_are_evicted(tmpdir):
+    cache = SnapshotCache(max_size=2)
+    paths = [str(tmpdir.join('%d.ipynb' % i)) for i in range(3)]
+    for path in paths[0:2]:
+        write(path, notebook(path))
+        cache.put(path, notebook(path))
+
+    cache.get(paths[0])
+    write(paths[2], notebook(paths[2]))
+    cache.put(paths[2], notebook(paths[2]))
+    assert list(cache.entries) == [paths[0], paths[2]]
@@ -0,0 +1,93 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the catalog of tracked notebooks
+"""
+
+import json
+import sqlite3
+
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_catalog import (Catalog, get_catalog, rebuild_catalog,
+    names_from_metadata)
+from nbcomet.nbcomet_sqlite import DbWriter
+
+KEY = '1a2b3c4d/nb'
+
+def stored_entries(catalog):
+    conn = sqlite3.connect(catalog.path)
+    try:
+        return conn.execute('''SELECT key, first_time, last_time, num_actions,
+            num_versions FROM notebooks ORDER BY key''').fetchall()
+    finally:
+        conn.close()
+
+def test_activity_is_written_in_batches(tmpdir):
+    writer = DbWriter(flush_interval=3600)
+    catalog = Catalog(str(tmpdir), writer)
+    try:
+        catalog.record_activity(KEY, 10, 20, num_actions=2)
+        catalog.record_activity(KEY, 5, 15, num_actions=1, num_versions=1)
+        catalog.record_activity('5e6f7a8b/other', 1, 1, num_actions=1)
+        catalog.connect()
+        assert stored_entries(catalog) == []
+        assert writer.queued() == 2
+
+        writer.flush()
+        assert stored_entries(catalog) == [(KEY, 5, 20, 3, 1),
+                                            ('5e6f7a8b/other', 1, 1, 1, 0)]
+
+        # later activity adds to the entry, and reads see what is queued
+        catalog.record_activity(KEY, 30, 40, num_actions=4, num_versions=1)
+        entry = catalog.get(KEY)
+        assert (entry['first_time'], entry['last_time'], entry['num_actions'],
+                entry['num_versions']) == (5, 40, 7, 2)
+
+        catalog.record_activity(KEY, 50, 50, num_versions=1)
+        catalog.remove_versions(KEY, 2)
+        assert catalog.get(KEY)['num_versions'] == 1
+    finally:
+        catalog.close()
+        writer.stop()
+
+def test_renamed_notebooks_keep_their_names_in_order(tmpdir):
+    catalog = Catalog(str(tmpdir), DbWriter(flush_interval=3600))
+    try:
+        assert catalog.prior_names(KEY) is None
+        catalog.record_names(KEY, [['1a2b3c4d/old', 0],
+                                    ['1a2b3c4d/older', 5], [KEY, 10]])
+        catalog.record_names(KEY, [['1a2b3c4d/old', 0], [KEY, 10]])
+
+        # each name is used until the next one is
+        names = catalog.prior_names(KEY)
+        assert [n[0:3] for n in names[0:1]] == [['1a2b3c4d/old', 0, 10]]
+        assert names[1][0:2] == [KEY, 10]
+        assert names[1][2] > 10
+    finally:
+        catalog.close()
+        catalog.writer.stop()
+
+def test_catalog_is_rebuilt_from_saved_notebooks(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    actions = backend.open_actions(KEY)
+    actions.record_actions_to_db([({'time': t, 'name': 'run-cell',
+                                    'index': 0, 'indices': [0]}, {}, [])
+                                    for t in [10, 20, 30]])
+    actions.close()
+    nb = {'cells': [], 'metadata': {'comet_paths': [['1a2b3c4d/old.ipynb', 0],
+                                                    ['1a2b3c4d/nb.ipynb', 5]]},
+        'nbformat': 4, 'nbformat_minor': 2}
+    backend.write_snapshot(KEY, nb, json.dumps(nb).encode())
+    assert names_from_metadata(nb, KEY) == [['1a2b3c4d/old', 0], [KEY, 5]]
+    assert names_from_metadata({'metadata': {}}, KEY) == [[KEY, 0]]
+
+    assert rebuild_catalog(data_dir, backend) == 1
+    # rebuilding again does not count the same actions twice
+    assert rebuild_catalog(data_dir, backend) == 1
+    catalog = get_catalog(data_dir)
+    entry = catalog.get(KEY)
+    assert (entry['first_time'], entry['last_time'], entry['num_actions'],
+            entry['num_versions']) == (10, 30, 3, 0)
+    assert [n[0:2] for n in catalog.prior_names(KEY)] == [
+        ['1a2b3c4d/old', 0], [KEY, 5]]
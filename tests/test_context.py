@@ -0,0 +1,53 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the registry of the notebooks tracked by a server
+"""
+
+import os
+import sqlite3
+
+from nbcomet import nbcomet_context
+from nbcomet.nbcomet_context import ContextRegistry
+
+def record(t):
+    # (action_data, diff, cell_order) of an action at time t
+    action_data = {'time': t, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+    return (action_data, {'c1': {'cell_type': 'code', 'source': 'x'}}, ['c1'])
+
+def stored_times(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [r[0] for r in conn.execute(
+                'SELECT time FROM actions ORDER BY time')]
+    finally:
+        conn.close()
+
+def test_idle_notebooks_are_closed_and_flushed(tmpdir, monkeypatch):
+    data_dir = str(tmpdir.join('data'))
+    monkeypatch.setattr(nbcomet_context, 'find_storage_dir', lambda: data_dir)
+    busy = set()
+    registry = ContextRegistry(idle_timeout=60, is_busy=busy.__contains__)
+
+    nb_path = os.path.join(str(tmpdir), 'nb.ipynb')
+    context = registry.get(nb_path)
+    assert registry.get(nb_path) is context
+    assert registry.find(os.path.join(str(tmpdir), 'other.ipynb')) is None
+    other = registry.get(os.path.join(str(tmpdir), 'other.ipynb'))
+    assert len(registry) == 2
+    assert (context.fname, context.file_ext) == ('nb', '.ipynb')
+
+    context.db_manager.record_actions_to_db([record(1)])
+    context.last_used -= 120
+    other.last_used -= 120
+    busy.add(other.key)
+
+    # notebooks with queued work are kept open
+    assert registry.evict_idle() == 1
+    assert registry.find(nb_path) is None
+    assert stored_times(context.backend.db_path(context.key)) == [1]
+
+    # the next action opens the notebook again
+    assert registry.get(nb_path) is not context
+    registry.close_all()
+    assert len(registry) == 0
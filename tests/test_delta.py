@@ -0,0 +1,71 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of rebuilding notebooks from the cell-level deltas clients post
+"""
+
+import pytest
+
+from nbcomet.nbcomet_delta import DeltaState, apply_delta, rebuild_batch
+
+def cell(cell_id, source):
+    return {'cell_type': 'code', 'execution_count': None, 'outputs': [],
+            'metadata': {'comet_cell_id': cell_id}, 'source': source}
+
+def notebook(*cells):
+    return {'cells': list(cells), 'metadata': {}, 'nbformat': 4,
+            'nbformat_minor': 2}
+
+def test_delta_keeps_unchanged_cells_of_its_base():
+    base = notebook(cell('a', 'x'), cell('b', 'y'))
+    model = apply_delta(base, {'cells': {'c': cell('c', 'z')},
+                                'cell_order': ['b', 'c', 'a'],
+                                'metadata': {'kernelspec': {}}})
+    assert [c['source'] for c in model['cells']] == ['y', 'z', 'x']
+    assert model['metadata'] == {'kernelspec': {}}
+    assert model['nbformat_minor'] == 2
+
+    with pytest.raises(ValueError):
+        apply_delta(base, {'cell_order': ['a', 'd']})
+
+def test_deltas_from_a_stale_revision_are_refused():
+    state = DeltaState()
+    first = state.next_revision()
+    state.apply({'model': notebook(cell('a', 'x'))})
+
+    second = state.next_revision(first)
+    assert second is not None and second != first
+    action = state.apply({'delta': {'cells': {'a': cell('a', 'x2')},
+                                    'cell_order': ['a']}})
+    assert action['model']['cells'][0]['source'] == 'x2'
+
+    # a client still on the first revision has to send the full notebook
+    assert state.next_revision(first) is None
+    assert state.next_revision() is not None
+
+def test_bad_delta_asks_for_a_full_upload():
+    state = DeltaState()
+    revision = state.next_revision()
+    state.apply({'model': notebook(cell('a', 'x'))})
+
+    with pytest.raises(ValueError):
+        state.apply({'delta': {'cell_order': ['b']}})
+    assert state.next_revision(revision) is None
+    with pytest.raises(ValueError):
+        state.apply({'delta': {'cell_order': ['a']}})
+
+def test_batch_is_rebuilt_without_touching_the_state():
+    state = DeltaState()
+    state.next_revision()
+    state.apply({'model': notebook(cell('a', 'x'))})
+
+    actions = rebuild_batch([
+        {'time': 1, 'model': notebook(cell('a', 'y'))},
+        {'time': 2, 'delta': {'cells': {'b': cell('b', 'z')},
+                            'cell_order': ['a', 'b']}}])
+    assert [a['time'] for a in actions] == [1, 2]
+    assert [c['source'] for c in actions[1]['model']['cells']] == ['y', 'z']
+    assert state.model['cells'][0]['source'] == 'x'
+
+    with pytest.raises(ValueError):
+        rebuild_batch([{'delta': {'cell_order': []}}])
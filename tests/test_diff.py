@@ -0,0 +1,74 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of diffing a notebook against the one before it
+"""
+
+from nbcomet.nbcomet_diff import diff_against, CellIndex
+
+def cell(source, cell_id=None, outputs=None, execution_count=None):
+    c = {'cell_type': 'code', 'execution_count': execution_count,
+        'metadata': {}, 'outputs': outputs or [], 'source': source}
+    if cell_id is not None:
+        c['metadata']['comet_cell_id'] = cell_id
+    return c
+
+def stream(text):
+    return {'output_type': 'stream', 'name': 'stdout', 'text': text}
+
+def action(cells, name='run-cell', index=0, indices=None):
+    return {'name': name, 'index': index,
+            'indices': indices if indices is not None else [index],
+            'model': {'cells': cells}}
+
+def prior(cells):
+    return ({'cells': cells}, CellIndex(cells))
+
+def test_cells_are_matched_by_id():
+    before = [cell('x', 'a'), cell('y', 'b'), cell('z', 'c')]
+    after = [cell('z', 'c'), cell('x', 'a'), cell('y2', 'b'), cell('w', 'd')]
+
+    diff, cell_order = diff_against(prior(before), action(after))
+    # moving a cell is only a change of the cell order
+    assert cell_order == ['c', 'a', 'b', 'd']
+    assert diff == {'b': after[2], 'd': after[3]}
+
+def test_first_version_has_no_diff():
+    diff, cell_order = diff_against(None, action([cell('x', 'a')]))
+    assert diff == {}
+    assert cell_order == ['a']
+
+    diff, cell_order = diff_against(None, action([cell('x'), cell('y')]))
+    assert cell_order == [0, 1]
+
+def test_outputs_are_only_compared_if_asked():
+    before = [cell('x', 'a', [stream('1')], execution_count=1)]
+    rerun = [cell(['x'], 'a', [stream(['1'])], execution_count=2)]
+    changed = [cell('x', 'a', [stream('2')], execution_count=3)]
+
+    # lines stored as lists and new execution counts are not changes
+    assert diff_against(prior(before), action(rerun), True)[0] == {}
+    assert diff_against(prior(before), action(changed))[0] == {}
+    assert diff_against(prior(before), action(changed), True)[0] == {
+        'a': changed[0]}
+
+def test_cells_without_ids_are_checked_by_action():
+    before = [cell('x'), cell('y'), cell('z')]
+    after = [cell('x2'), cell('y2'), cell('z')]
+
+    # only the cells the action could have changed are compared
+    diff, cell_order = diff_against(prior(before), action(after, index=1))
+    assert cell_order == [0, 1, 2]
+    assert diff == {1: after[1]}
+
+    diff, cell_order = diff_against(prior(before),
+                                    action(after, 'run-all-cells'))
+    assert diff == {0: after[0], 1: after[1]}
+
+def test_duplicate_ids_fall_back_to_positions():
+    before = [cell('x', 'a'), cell('y', 'b')]
+    after = [cell('x', 'a'), cell('y2', 'a')]
+
+    diff, cell_order = diff_against(prior(before), action(after, index=1))
+    assert cell_order == [0, 1]
+    assert diff == {1: after[1]}
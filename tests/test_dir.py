@@ -0,0 +1,43 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the index of a notebook's versions
+"""
+
+import os
+
+from nbcomet import nbcomet_dir
+from nbcomet.nbcomet_dir import VersionIndex
+
+def version(i):
+    return 'nb-2024-01-01-00-00-%02d-000000.ipynb' % i
+
+def test_empty_directory_is_scanned_once(tmpdir, monkeypatch):
+    scans = []
+    scan_versions = nbcomet_dir.scan_versions
+    monkeypatch.setattr(nbcomet_dir, 'scan_versions',
+                        lambda d: scans.append(d) or scan_versions(d))
+    index = VersionIndex(str(tmpdir))
+    for i in range(3):
+        assert index.all() == []
+        assert index.last() is None
+    assert len(scans) == 1
+
+    # a version saved by an older server, without adding it to the index
+    tmpdir.join(version(0)).write('{}')
+    assert [e['file'] for e in index.all()] == [version(0)]
+    assert len(scans) == 2
+
+def test_index_is_replaced_in_place(tmpdir):
+    index = VersionIndex(str(tmpdir))
+    for i in range(3):
+        tmpdir.join(version(i)).write('{}')
+        index.add(version(i), action_time=i)
+    assert [e['file'] for e in index.remove([version(1)])] == [version(1)]
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'index.jsonl', version(0), version(1), version(2)]
+
+    # another process reads the index as it was written
+    assert [e['file'] for e in VersionIndex(str(tmpdir)).all()] == [
+                                                    version(0), version(2)]
+    assert index.keyframe(1)['file'] == version(0)
@@ -0,0 +1,148 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of encoding the diffs of the actions table
+"""
+
+import pickle
+
+import pytest
+
+from nbcomet.nbcomet_encoding import (DiffEncoder, DiffDecoder, encode_diff,
+    decode_diff, decode_entries, decode_list, source_delta, apply_source_delta)
+
+def cell(source):
+    return {'cell_type': 'code', 'metadata': {}, 'source': source}
+
+def encode_all(encoder, diffs):
+    # store each diff at its time, as the actions table does
+    stored = {}
+    for t, diff in diffs:
+        stored.setdefault(t, []).append(encoder.encode(diff, t))
+    return stored
+
+def test_decode_diff_rebuilds_source_deltas():
+    lines = ['x%d = %d\n' % (i, i) for i in range(20)]
+    sources = [''.join(lines), ''.join(lines[:5] + ['y = 1\n'] + lines[5:]),
+                ''.join(lines[:5] + ['y = 2\n'] + lines[5:])]
+    stored = encode_all(DiffEncoder(),
+                        [(t, {'c1': cell(s)}) for t, s in enumerate(sources)])
+
+    # the later diffs only hold deltas, resolved through the lookup
+    with pytest.raises(ValueError):
+        decode_diff(stored[2][0])
+    for t, source in enumerate(sources):
+        diff = decode_diff(stored[t][0], lookup=lambda t: stored.get(t, []))
+        assert diff == {'c1': cell(source)}
+
+def decode_all(stored, decoder):
+    return dict((t, [decoder.decode(b, t) for b in blobs])
+                for t, blobs in sorted(stored.items()))
+
+def edits(n):
+    # sources of a cell edited one line at a time
+    lines = ['x%d = %d\n' % (i, i) for i in range(20)]
+    sources = []
+    for i in range(n):
+        lines[i % 20] = 'x%d = %d\n' % (i % 20, i * 100)
+        sources.append(''.join(lines))
+    return sources
+
+def test_source_delta_round_trip():
+    pairs = [('', 'a\n'), ('a\n', ''), ('a\nb\nc', 'a\nc'),
+            ('a\nb\n', 'a\nb\nc\nd\n'), ('x\ny\nz\n', 'z\ny\nx\n'),
+            ('no newline', 'no newline\n'), ('a\r\nb\r\n', 'a\r\nc\r\n')]
+    for a, b in pairs:
+        assert apply_source_delta(a, source_delta(a, b)) == b
+
+def test_delta_chain_across_keyframes():
+    sources = edits(12)
+    encoder = DiffEncoder(keyframe_interval=4)
+    stored = encode_all(encoder, [(t, {'c1': cell(s)})
+                                    for t, s in enumerate(sources)])
+    entries = [decode_entries(stored[t][0])[0] for t in range(12)]
+    # a full source, then deltas against the one before, every 5 revisions
+    assert [len(e) for e in entries] == [2, 3, 3, 3, 3] * 2 + [2, 3]
+    assert entries[3][2][0] == 2
+
+    # read in order, and each on its own from the middle of the history
+    decoded = decode_all(stored, DiffDecoder())
+    assert [decoded[t][0]['c1']['source'] for t in range(12)] == sources
+    lookup = lambda t: stored.get(t, [])
+    for t in range(12):
+        assert DiffDecoder(lookup).decode(stored[t][0], t) == {
+                                                        'c1': cell(sources[t])}
+
+def test_out_of_order_times_store_full_sources():
+    sources = edits(4)
+    stored = encode_all(DiffEncoder(), [(10, {'c1': cell(sources[0])}),
+                                        (5, {'c1': cell(sources[1])}),
+                                        (10, {'c1': cell(sources[2])}),
+                                        (20, {'c1': cell(sources[3])})])
+    # deltas are only stored against revisions stored at an earlier time,
+    # so the one at 5 holds a full source, and the second at 10 and the one
+    # at 20 are deltas against the last revision stored before them
+    assert len(decode_entries(stored[5][0])[0]) == 2
+    assert [e[0][2][0] if len(e[0]) > 2 else None
+            for e in map(decode_entries, stored[10])] == [None, 5]
+    assert decode_entries(stored[20][0])[0][2][0] == 10
+
+    # in order of time, as the actions table is read, where the base of the
+    # second delta is looked up, and each on its own
+    lookup = lambda t: stored.get(t, [])
+    decoded = decode_all(stored, DiffDecoder(lookup))
+    assert [d['c1']['source'] for t in [5, 10, 20] for d in decoded[t]] == [
+                            sources[1], sources[0], sources[2], sources[3]]
+    for t, i, source in [(5, 0, sources[1]), (10, 1, sources[2]),
+                        (20, 0, sources[3])]:
+        assert DiffDecoder(lookup).decode(stored[t][i], t) == {
+                                                        'c1': cell(source)}
+
+def test_missing_base_revision_is_an_error():
+    sources = edits(3)
+    stored = encode_all(DiffEncoder(), [(t, {'c1': cell(s)})
+                                        for t, s in enumerate(sources)])
+    # the row holding the full source is gone, e.g. deleted by hand
+    del stored[0]
+    lookup = lambda t: stored.get(t, [])
+    with pytest.raises(ValueError):
+        DiffDecoder(lookup).decode(stored[2][0], 2)
+    with pytest.raises(ValueError):
+        decode_diff(stored[1][0], lookup=lookup)
+
+def test_cells_without_ids_store_full_sources():
+    sources = edits(3)
+    encoder = DiffEncoder()
+    stored = encode_all(encoder, [(t, {0: cell(s), 'c1': cell(s)})
+                                    for t, s in enumerate(sources)])
+    for t in [1, 2]:
+        entries = dict((e[0], e) for e in decode_entries(stored[t][0]))
+        assert len(entries[0]) == 2
+        assert len(entries['c1']) == 3
+
+    decoded = decode_all(stored, DiffDecoder())
+    for t, source in enumerate(sources):
+        # integer keys survive the round trip
+        assert decoded[t] == [{0: cell(source), 'c1': cell(source)}]
+
+def test_diff_keys_keep_their_type():
+    diff = {0: cell('x'), 'c1': cell('y')}
+    blob = encode_diff(diff)
+    assert blob[0:1] == b'\x01'
+    assert decode_diff(blob) == diff
+    assert decode_diff(None) == {}
+    with pytest.raises(ValueError):
+        decode_diff(b'\x09' + blob[1:])
+
+def test_pickled_diffs_are_only_read_if_allowed():
+    diff = {0: cell('x')}
+    for protocol in [0, 2]:
+        blob = pickle.dumps(diff, protocol)
+        with pytest.raises(ValueError):
+            decode_diff(blob)
+        assert decode_diff(blob, allow_pickle=True) == diff
+
+def test_lists_stored_as_reprs_are_read():
+    assert decode_list('[1, "c1"]') == [1, 'c1']
+    assert decode_list("[1, 'c1']") == [1, 'c1']
+    assert decode_list(None) == []
@@ -0,0 +1,80 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of incremental exports
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_export import main, WATERMARK_FILE
+
+KEY = '1a2b3c4d/nb'
+
+def record(t):
+    # (action_data, diff, cell_order) of an action at time t
+    action_data = {'time': t, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+    diff = {'c1': {'cell_type': 'code', 'source': 'x = %d' % t}}
+    return (action_data, diff, ['c1'])
+
+def record_actions(backend, times):
+    actions = backend.open_actions(KEY)
+    actions.record_actions_to_db([record(t) for t in times])
+    actions.close()
+
+def export(data_dir, out_dir):
+    # wait a little, so each export writes new part files
+    time.sleep(0.01)
+    return main([out_dir, '--data-dir', data_dir, '--processes', '0',
+                '--incremental'])
+
+def exported_times(out_dir):
+    times = []
+    for root, dirs, files in os.walk(os.path.join(out_dir, 'actions')):
+        for f in files:
+            assert f.endswith('.jsonl')
+            with open(os.path.join(root, f)) as lines:
+                times.extend(json.loads(l)['time'] for l in lines)
+    return sorted(times)
+
+def test_actions_stored_late_are_exported(tmpdir):
+    data_dir = str(tmpdir.join('data'))
+    out_dir = str(tmpdir.join('out'))
+    backend = FileBackend(data_dir)
+
+    record_actions(backend, [100, 200])
+    assert export(data_dir, out_dir) == 0
+    assert exported_times(out_dir) == [100, 200]
+
+    # e.g. an action a client buffered while it was offline
+    record_actions(backend, [50, 300])
+    assert export(data_dir, out_dir) == 0
+    assert exported_times(out_dir) == [50, 100, 200, 300]
+
+    assert export(data_dir, out_dir) == 0
+    assert exported_times(out_dir) == [50, 100, 200, 300]
+
+def test_failed_export_is_not_published(tmpdir):
+    data_dir = str(tmpdir.join('data'))
+    out_dir = str(tmpdir.join('out'))
+    backend = FileBackend(data_dir)
+
+    record_actions(backend, [100])
+    assert export(data_dir, out_dir) == 0
+    with open(os.path.join(out_dir, WATERMARK_FILE)) as f:
+        watermark = f.read()
+
+    record_actions(backend, [200, 300])
+    conn = sqlite3.connect(backend.db_path(KEY))
+    conn.execute('UPDATE actions SET diff = ? WHERE time = 300',
+                (b'\xff',))
+    conn.commit()
+    conn.close()
+
+    assert export(data_dir, out_dir) == 1
+    assert exported_times(out_dir) == [100]
+    with open(os.path.join(out_dir, WATERMARK_FILE)) as f:
+        assert f.read() == watermark
@@ -0,0 +1,114 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of saving the batches of actions posted by the nbextension
+"""
+
+import json
+import sqlite3
+import threading
+
+from nbcomet import ingest_action
+from nbcomet.nbcomet_ingest import IngestPipeline
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_context import TrackingContext
+from nbcomet.nbcomet_replay import notebook_at
+
+def cell(cell_id, source):
+    return {'cell_type': 'code', 'execution_count': None, 'outputs': [],
+            'metadata': {'comet_cell_id': cell_id}, 'source': source}
+
+def notebook(*cells):
+    return {'cells': list(cells), 'metadata': {}, 'nbformat': 4,
+            'nbformat_minor': 2}
+
+def action(t, model=None, delta=None):
+    a = {'time': t, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+    if model is not None:
+        a['model'] = model
+    else:
+        a['delta'] = delta
+    return a
+
+def post(context, actions, closing=False):
+    # as NBComet.post does, before handing the body to the ingest pipeline
+    if not closing:
+        context.delta_state.next_revision()
+    ingest_action(context, json.dumps({'actions': actions}).encode(), closing)
+
+def stored_times(backend, key):
+    conn = sqlite3.connect(backend.db_path(key))
+    try:
+        return [r[0] for r in conn.execute(
+                'SELECT time FROM actions ORDER BY time')]
+    finally:
+        conn.close()
+
+def test_batch_overtaken_by_closing_batch(tmpdir):
+    data_dir = str(tmpdir.join('data'))
+    backend = FileBackend(data_dir)
+    context = TrackingContext(data_dir, str(tmpdir), 'nb', backend=backend)
+
+    post(context, [action(1, notebook(cell('a', 'x = 1')))])
+
+    # the page closes while a delta batch is in flight, and the batch it
+    # sent on closing gets there first
+    post(context, [action(4, notebook(cell('a', 'x = 3'), cell('b', 'y'))),
+                    action(5, delta={'cells': {'b': cell('b', 'y = 1')},
+                                    'cell_order': ['a', 'b']})],
+        closing=True)
+    post(context, [action(2, delta={'cells': {'a': cell('a', 'x = 2')},
+                                    'cell_order': ['a']})])
+    context.close()
+
+    assert stored_times(backend, context.key) == [1, 2, 4, 5]
+    nb, index = backend.read_snapshot(context.key, lambda cells: None)
+    assert [c['source'] for c in nb['cells']] == ['x = 3', 'y = 1']
+
+    for t, sources in [(2, ['x = 2']), (4, ['x = 3', 'y']),
+                        (5, ['x = 3', 'y = 1'])]:
+        nb, info = notebook_at(backend, context.key, t)
+        assert [c['source'] for c in nb['cells']] == sources
+
+def test_pipeline_keeps_each_notebooks_actions_in_order():
+    pipeline = IngestPipeline(max_workers=4, max_queue_size=2)
+    started = threading.Event()
+    release = threading.Event()
+    b_done = threading.Event()
+    done = []
+
+    def block():
+        started.set()
+        release.wait(10)
+    def work(key, i):
+        if i == 1:
+            raise ValueError(i)
+        done.append((key, i))
+        if key == 'b':
+            b_done.set()
+
+    assert pipeline.submit('a', block)
+    assert started.wait(10)
+    assert pipeline.submit('a', work, 'a', 0)
+    assert pipeline.submit('a', work, 'a', 1)
+    assert not pipeline.submit('a', work, 'a', 2)
+    assert pipeline.is_busy('a')
+    assert pipeline.depth('a') == 2
+
+    # other notebooks are not held up by a's queue
+    assert pipeline.submit('b', work, 'b', 0)
+    assert b_done.wait(10)
+    assert done == [('b', 0)]
+
+    # a failed action does not stop the ones queued after it
+    pipeline.configure(max_queue_size=3)
+    assert pipeline.submit('a', work, 'a', 3)
+    release.set()
+    pipeline.shutdown()
+    assert done == [('b', 0), ('a', 0), ('a', 3)]
+    stats = pipeline.stats()
+    assert stats['submitted'] == 5
+    assert stats['completed'] == 4
+    assert stats['failed'] == 1
+    assert stats['rejected'] == 1
+    assert not pipeline.is_busy('a')
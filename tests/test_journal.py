@@ -0,0 +1,153 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the action journal across server restarts
+"""
+
+import os
+import time
+import sqlite3
+
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_journal import ActionJournal
+
+KEY = '1a2b3c4d/nb'
+
+def record(t):
+    # (action_data, diff, cell_order) of an action at time t
+    action_data = {'time': t, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+    diff = {'c1': {'cell_type': 'code', 'source': 'x = %d' % t}}
+    return (action_data, diff, ['c1'])
+
+def stored_times(backend):
+    conn = sqlite3.connect(backend.db_path(KEY))
+    try:
+        return [r[0] for r in conn.execute(
+                'SELECT time FROM actions ORDER BY time')]
+    finally:
+        conn.close()
+
+def start_journal(tmpdir, backend):
+    journal = ActionJournal()
+    journal.start(str(tmpdir.join('journal')), backend, fsync=False,
+                    load_interval=60)
+    return journal
+
+def test_actions_after_restart_are_loaded(tmpdir):
+    backend = FileBackend(str(tmpdir))
+
+    journal = start_journal(tmpdir, backend)
+    journal.append(KEY, [record(1)])
+    journal.stop()
+    assert stored_times(backend) == [1]
+
+    # a restarted server numbers its segments from the start again
+    journal = start_journal(tmpdir, backend)
+    journal.append(KEY, [record(2)])
+    journal.load()
+    journal.append(KEY, [record(3)])
+    journal.stop()
+    assert stored_times(backend) == [1, 2, 3]
+    assert os.listdir(str(tmpdir.join('journal'))) == []
+
+def test_journal_of_crashed_server_is_loaded_on_start(tmpdir):
+    backend = FileBackend(str(tmpdir))
+
+    crashed = start_journal(tmpdir, backend)
+    crashed.append(KEY, [record(1), record(2)])
+    # the server dies without loading, releasing its lock
+    crashed.running = False
+    crashed.file.close()
+    crashed.run_lock.close()
+
+    running = start_journal(tmpdir, backend)
+    assert stored_times(backend) == [1, 2]
+    running.append(KEY, [record(3)])
+    running.stop()
+    assert stored_times(backend) == [1, 2, 3]
+
+def test_journal_of_running_server_is_left_alone(tmpdir):
+    backend = FileBackend(str(tmpdir))
+
+    first = start_journal(tmpdir, backend)
+    first.append(KEY, [record(1)])
+    second = start_journal(tmpdir, backend)
+    second.stop()
+    assert not os.path.isfile(backend.db_path(KEY))
+
+    first.stop()
+    assert stored_times(backend) == [1]
+
+def test_run_being_created_is_left_alone(tmpdir):
+    backend = FileBackend(str(tmpdir))
+    journal_dir = tmpdir.join('journal')
+    # another server has just created its directory, and not yet locked it
+    journal_dir.join('.0000000000000-host-1-abcd').ensure(dir=True)
+
+    journal = start_journal(tmpdir, backend)
+    journal.stop()
+    assert os.listdir(str(journal_dir)) == ['.0000000000000-host-1-abcd']
+
+def test_loader_keeps_running_after_a_failure(tmpdir):
+    backend = FileBackend(str(tmpdir))
+    journal = ActionJournal()
+    loads = []
+    load = journal.load
+
+    def failing_load():
+        loads.append(len(loads))
+        if len(loads) == 1:
+            raise IOError("disk full")
+        return load()
+
+    journal.load = failing_load
+    journal.start(str(tmpdir.join('journal')), backend, fsync=False,
+                    load_interval=0.01)
+    journal.append(KEY, [record(1)])
+    deadline = time.time() + 5
+    while len(loads) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert journal.thread.is_alive()
+    journal.stop()
+    assert stored_times(backend) == [1]
+
+def test_open_notebooks_are_loaded_through_their_writer(tmpdir, monkeypatch):
+    backend = FileBackend(str(tmpdir))
+    manager = backend.open_actions(KEY)
+    journal = start_journal(tmpdir, backend)
+
+    connections = []
+    connect = sqlite3.connect
+    monkeypatch.setattr(sqlite3, 'connect',
+                        lambda *args, **kwargs: connections.append(args)
+                        or connect(*args, **kwargs))
+    for t in [1, 2, 3]:
+        journal.append(KEY, [record(t)])
+        journal.load()
+    assert connections == []
+    monkeypatch.undo()
+
+    backend.close_notebook(KEY)
+    manager.close()
+    journal.stop()
+    assert stored_times(backend) == [1, 2, 3]
+
+def test_one_notebook_is_loaded_ahead_of_the_others(tmpdir):
+    backend = FileBackend(str(tmpdir))
+    other = '5e6f7a8b/other'
+    journal = start_journal(tmpdir, backend)
+    journal.append(KEY, [record(1)])
+    journal.append(other, [record(2)])
+
+    assert journal.load(KEY) == 1
+    assert stored_times(backend) == [1]
+    assert not os.path.isfile(backend.db_path(other))
+
+    # the segment is loaded for the other notebook, and only for it
+    journal.append(KEY, [record(3)])
+    journal.load()
+    journal.stop()
+    assert stored_times(backend) == [1, 3]
+    conn = sqlite3.connect(backend.db_path(other))
+    assert [r[0] for r in conn.execute('SELECT time FROM actions')] == [2]
+    conn.close()
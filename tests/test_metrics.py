@@ -0,0 +1,52 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the per-stage timing metrics
+"""
+
+from nbcomet.nbcomet_metrics import Metrics
+
+def test_stages_are_rendered_as_histograms():
+    metrics = Metrics(buckets=[0.01, 0.1])
+    metrics.observe('diff', 0.005)
+    metrics.observe('diff', 0.05)
+    metrics.observe('diff', 1.0)
+    with metrics.timer('db_commit'):
+        pass
+    metrics.inc('bytes_written', 10)
+    metrics.inc('bytes_written', 5)
+    metrics.inc('actions', kind='run-cell')
+    metrics.gauge('queue_depth', lambda: 3, 'Actions waiting')
+    metrics.gauge('broken', lambda: 1 / 0)
+
+    lines = metrics.render().splitlines()
+    for line in ['nbcomet_stage_duration_seconds_bucket'
+                    '{stage="diff",le="0.01"} 1',
+                'nbcomet_stage_duration_seconds_bucket'
+                    '{stage="diff",le="0.1"} 2',
+                'nbcomet_stage_duration_seconds_bucket'
+                    '{stage="diff",le="+Inf"} 3',
+                'nbcomet_stage_duration_seconds_count{stage="diff"} 3',
+                'nbcomet_stage_duration_seconds_count{stage="db_commit"} 1',
+                'nbcomet_bytes_written_total 15',
+                'nbcomet_actions_total{kind="run-cell"} 1',
+                '# HELP nbcomet_queue_depth Actions waiting',
+                'nbcomet_queue_depth 3']:
+        assert line in lines
+    # gauges that fail are left out
+    assert not [l for l in lines if 'broken' in l]
+
+def test_summary_covers_the_runs_since_the_last_one():
+    metrics = Metrics()
+    assert metrics.summary_line() == ''
+
+    metrics.observe('diff', 0.002)
+    metrics.observe('diff', 0.004)
+    metrics.gauge('queue_depth', lambda: 0)
+    assert metrics.summary_line() == ('diff: 2 runs, avg 3.0 ms, max 4.0 ms; '
+                                    'queue_depth: 0')
+    assert metrics.summary_line() == ''
+
+    metrics.observe('diff', 0.001)
+    assert metrics.summary_line().startswith(
+        'diff: 1 runs, avg 1.0 ms, max 1.0 ms')
@@ -0,0 +1,46 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of rewriting action databases saved by older versions of NBComet
+"""
+
+import pickle
+import sqlite3
+
+from nbcomet.nbcomet_encoding import decode_diff
+from nbcomet.nbcomet_migrate import migrate_db
+from nbcomet.nbcomet_sqlite import DbManager
+
+def test_legacy_rows_are_rewritten(tmpdir):
+    db_path = str(tmpdir.join('nb.db'))
+    manager = DbManager('nb', db_path)
+    try:
+        manager.record_actions_to_db([({'time': 1, 'name': 'run-cell',
+                                        'index': 0, 'indices': [0]},
+                                        {'c1': {'source': 'x'}}, ['c1'])])
+        manager.commit_queue()
+    finally:
+        manager.close()
+
+    # rows as older versions of NBComet saved them
+    conn = sqlite3.connect(db_path)
+    with conn:
+        for t in [2, 3, 4]:
+            conn.execute('INSERT INTO actions VALUES (?,?,?,?,?,?)',
+                        (t, 'run-cell', 0, '[0]', "['c1']",
+                        pickle.dumps({'c1': {'source': 'x = %d' % t}}, 2)))
+    conn.close()
+
+    assert migrate_db(db_path, batch_size=2) == 3
+    assert migrate_db(db_path) == 0
+
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute('''SELECT time, selected_cells, cell_order, diff
+                            FROM actions ORDER BY time''').fetchall()
+    finally:
+        conn.close()
+    assert [(t, s, o) for t, s, o, d in rows] == [
+        (t, '[0]', '["c1"]') for t in [1, 2, 3, 4]]
+    assert [decode_diff(d)['c1']['source'] for t, s, o, d in rows] == [
+        'x', 'x = 2', 'x = 3', 'x = 4']
@@ -0,0 +1,58 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the policy deciding how much of each cell output is tracked
+"""
+
+import nbformat
+from nbformat import v4
+
+from nbcomet.nbcomet_outputs import apply_output_policy
+
+def model():
+    cell = v4.new_code_cell('plot()', outputs=[
+        v4.new_output('stream', name='stdout', text='x' * 100),
+        v4.new_output('display_data', data={'image/png': 'a' * 1000}),
+        v4.new_output('error', ename='E', evalue='bad', traceback=['tb'])])
+    return v4.new_notebook(cells=[cell, v4.new_markdown_cell('# title')])
+
+def outputs(nb):
+    return nb['cells'][0]['outputs']
+
+def test_full_policy_keeps_the_model():
+    nb = model()
+    assert apply_output_policy(nb) is nb
+    assert apply_output_policy(nb, 'unknown') is nb
+
+def test_large_outputs_are_capped():
+    nb = model()
+    capped = apply_output_policy(nb, 'full', max_bytes=200)
+    assert outputs(capped)[0] == outputs(nb)[0]
+    assert outputs(capped)[2] == outputs(nb)[2]
+    data = outputs(capped)[1]['data']
+    assert list(data) == ['text/plain']
+    assert 'bytes]' in data['text/plain']
+    assert outputs(capped)[1]['metadata']['comet_size'] > 1000
+
+    # the model itself is left untouched
+    assert outputs(nb)[1]['data'] == {'image/png': 'a' * 1000}
+
+def test_digests_tell_outputs_apart_and_stay_valid():
+    nb = model()
+    digested = apply_output_policy(nb, 'digest')
+    nbformat.validate(digested)
+    assert 'x' * 100 not in outputs(digested)[0]['text']
+    assert outputs(digested)[2]['traceback'] != ['tb']
+    assert apply_output_policy(digested, 'digest') == digested
+
+    outputs(nb)[1]['data']['image/png'] = 'b' * 1000
+    other = apply_output_policy(nb, 'digest')
+    assert outputs(other)[0] == outputs(digested)[0]
+    assert outputs(other)[1] != outputs(digested)[1]
+
+def test_strip_policy_drops_outputs():
+    nb = model()
+    stripped = apply_output_policy(nb, 'strip')
+    assert outputs(stripped) == []
+    assert stripped['cells'][1] == nb['cells'][1]
+    assert len(outputs(nb)) == 3
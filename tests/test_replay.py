@@ -0,0 +1,68 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of rebuilding notebooks at a point in time
+"""
+
+import os
+
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_dir import get_version_index
+from nbcomet.nbcomet_encoding import DiffEncoder
+from nbcomet.nbcomet_replay import notebook_at
+from nbcomet.nbcomet_store import save_version
+
+KEY = '1a2b3c4d/nb'
+
+def notebook(source):
+    cell = {'cell_type': 'code', 'execution_count': None, 'outputs': [],
+            'metadata': {'comet_cell_id': 'c1'}, 'source': source}
+    return {'cells': [cell], 'metadata': {}, 'nbformat': 4,
+            'nbformat_minor': 2}
+
+def record(t):
+    # (action_data, diff, cell_order) of an action at time t
+    action_data = {'time': t, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+    return (action_data, {'c1': notebook('x = %d' % t)['cells'][0]}, ['c1'])
+
+def test_replay_reads_archived_actions(tmpdir):
+    backend = FileBackend(str(tmpdir))
+    actions = backend.open_actions(KEY)
+    save_version(notebook('x = 0'), backend.version_dir(KEY),
+                'nb-2024-01-01-00-00-00-000000', action_time=0)
+    actions.record_actions_to_db([record(t) for t in [1, 2, 3]],
+                                DiffEncoder())
+    actions.close()
+
+    assert backend.archive_actions(KEY, 3) == 2
+
+    for t in [1, 2, 3]:
+        nb, info = notebook_at(backend, KEY, t)
+        assert nb['cells'][0]['source'] == 'x = %d' % t
+        assert info['replayed'] == t
+        assert info['missing_cells'] == 0
+
+def test_replay_falls_back_to_versions_kept_by_retention(tmpdir):
+    backend = FileBackend(str(tmpdir))
+    actions = backend.open_actions(KEY)
+    for i, t in enumerate([0, 2, 4]):
+        save_version(notebook('x = %d' % t), backend.version_dir(KEY),
+                    'nb-2024-01-01-00-00-%02d-000000' % i, action_time=t)
+    actions.record_actions_to_db([record(t) for t in range(1, 6)],
+                                DiffEncoder())
+    actions.close()
+
+    nb, info = notebook_at(backend, KEY, 3)
+    assert info['keyframe_time'] == 2
+    assert info['replayed'] == 1
+
+    # retention removed the keyframe, so the version before it is used
+    removed = 'nb-2024-01-01-00-00-01-000000.ipynb'
+    get_version_index(backend.version_dir(KEY)).remove([removed])
+    os.remove(os.path.join(backend.version_dir(KEY), removed))
+    for t in range(1, 6):
+        nb, info = notebook_at(backend, KEY, t)
+        assert nb['cells'][0]['source'] == 'x = %d' % t
+        assert info['keyframe_time'] == (4 if t >= 4 else 0)
+
+    assert notebook_at(backend, '5e6f7a8b/other', 3) == (None, None)
@@ -0,0 +1,122 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of thinning out old versions
+"""
+
+import os
+import time
+import threading
+
+from nbcomet.nbcomet_dir import get_version_index
+from nbcomet.nbcomet_store import (save_version, write_manifest, read_version,
+    blob_lock, blob_path)
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_catalog import get_catalog
+from nbcomet.nbcomet_retention import (remove_unused_blobs,
+    RetentionPolicy, apply_retention, DAY, HOUR)
+
+def notebook(source):
+    cell = {'cell_type': 'markdown', 'metadata': {}, 'source': source}
+    return {'cells': [cell], 'metadata': {}, 'nbformat': 4,
+            'nbformat_minor': 2}
+
+def blobs(blob_dir):
+    return sorted(f for d in os.listdir(blob_dir)
+                    if os.path.isdir(os.path.join(blob_dir, d))
+                    for f in os.listdir(os.path.join(blob_dir, d)))
+
+def test_blobs_of_a_manifest_being_written_are_kept(tmpdir):
+    version_dir = str(tmpdir)
+    blob_dir = os.path.join(version_dir, 'blobs')
+    save_version(notebook('x'), version_dir, 'nb-2024-01-01-00-00-00-000000',
+                'dedup')
+    save_version(notebook('y'), version_dir, 'nb-2024-01-01-00-00-01-000000',
+                'dedup')
+    # retention removed the first version, whose blob is old
+    removed = 'nb-2024-01-01-00-00-00-000000.manifest'
+    get_version_index(version_dir).remove([removed])
+    os.remove(os.path.join(version_dir, removed))
+    for f in blobs(blob_dir):
+        path = blob_path(blob_dir, f.split('.')[0])
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+
+    # another server is writing a manifest that uses the blob again
+    results = []
+    with blob_lock(blob_dir):
+        sweep = threading.Thread(target=lambda: results.append(
+                                        remove_unused_blobs(version_dir)))
+        sweep.start()
+        time.sleep(0.2)
+        assert sweep.is_alive()
+        path = os.path.join(version_dir,
+                            'nb-2024-01-01-00-00-02-000000.manifest')
+        write_manifest(notebook('x'), path)
+    sweep.join()
+
+    assert results == [0]
+    assert read_version(path)['cells'][0]['source'] == 'x'
+
+    # once no manifest uses it, it goes
+    os.remove(path)
+    assert remove_unused_blobs(version_dir) == 1
+    assert len(blobs(blob_dir)) == 1
+
+def test_old_versions_are_thinned_to_one_per_hour_then_day():
+    now = 100 * DAY
+    policy = RetentionPolicy(keep_all_days=1, keep_hourly_days=10)
+    times = [now - 20 * DAY + 10, now - 20 * DAY + 20,  # same day
+            now - 5 * DAY + 10, now - 5 * DAY + 20,  # same hour
+            now - 5 * DAY + HOUR,
+            now - HOUR, now - HOUR + 1]  # kept, less than a day old
+    entries = [{'file': str(i), 'time': t} for i, t in enumerate(times)]
+
+    # the newest version of each hour or day is kept
+    assert [e['file'] for e in policy.versions_to_remove(entries, now)] == [
+        '0', '2']
+    assert RetentionPolicy().versions_to_remove(entries, now) == []
+
+    assert not RetentionPolicy().enabled()
+    assert RetentionPolicy(archive_actions_days=2).archive_before(now) == (
+        98 * DAY * 1000)
+    policy = RetentionPolicy.from_config({'retention_keep_all_days': '3'})
+    assert (policy.keep_all_days, policy.keep_hourly_days) == (3, 30)
+
+def test_retention_removes_versions_and_their_blobs(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    key = '1a2b3c4d/nb'
+    backend.open_actions(key).close()
+    version_dir = backend.version_dir(key)
+    for i, source in enumerate(['x', 'y', 'z']):
+        save_version(notebook(source), version_dir,
+                    'nb-2024-01-01-00-00-%02d-000000' % i, 'dedup')
+    catalog = get_catalog(data_dir)
+    catalog.record_activity(key, 1, 2, num_versions=3)
+
+    now = time.time() + 60 * DAY
+    policy = RetentionPolicy(keep_all_days=1)
+    totals = apply_retention(data_dir, policy, now, dry_run=True,
+                            backend=backend)
+    assert (totals['versions'], totals['blobs']) == (2, 0)
+    assert len(get_version_index(version_dir).all()) == 3
+
+    # every blob is older than the sweep, as if saved long ago
+    blob_dir = os.path.join(version_dir, 'blobs')
+    for f in blobs(blob_dir):
+        path = blob_path(blob_dir, f.split('.')[0])
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+    totals = apply_retention(data_dir, policy, now, backend=backend)
+    assert (totals['notebooks'], totals['versions'], totals['blobs']) == (
+        1, 2, 2)
+    entries = get_version_index(version_dir).all()
+    assert [e['file'] for e in entries] == [
+        'nb-2024-01-01-00-00-02-000000.manifest']
+    assert read_version(os.path.join(version_dir, entries[0]['file'])
+                        )['cells'][0]['source'] == 'z'
+    assert catalog.get(key)['num_versions'] == 1
+
+    # notebooks being saved are left alone
+    totals = apply_retention(data_dir, policy, now, is_busy=lambda k: True,
+                            backend=backend)
+    assert totals['notebooks'] == 0
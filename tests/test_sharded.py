@@ -0,0 +1,59 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the commands that go over every notebook, with the sharded backend
+"""
+
+import os
+import json
+
+from nbcomet.nbcomet_backend import ShardedBackend
+from nbcomet.nbcomet_catalog import rebuild_catalog, get_catalog
+from nbcomet.nbcomet_export import export_all
+from nbcomet.nbcomet_retention import apply_retention, RetentionPolicy
+
+KEYS = ['1a2b3c4d/nb', '5e6f7a8b/other']
+
+def record(t):
+    # (action_data, diff, cell_order) of an action at time t
+    action_data = {'time': t, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+    diff = {'c1': {'cell_type': 'code', 'source': 'x = %d' % t}}
+    return (action_data, diff, ['c1'])
+
+def sharded_backend(tmpdir):
+    backend = ShardedBackend(str(tmpdir), num_shards=2)
+    for key in KEYS:
+        actions = backend.open_actions(key)
+        actions.record_actions_to_db([record(t) for t in [1000, 2000]])
+        actions.close()
+    backend.close()
+    return backend
+
+def test_notebooks_are_found_in_shards(tmpdir):
+    backend = sharded_backend(tmpdir)
+    assert sorted(backend.notebooks()) == KEYS
+
+    assert rebuild_catalog(str(tmpdir), backend) == 2
+    entries = get_catalog(str(tmpdir)).notebooks()
+    assert sorted(e['key'] for e in entries) == KEYS
+    assert [e['num_actions'] for e in entries] == [2, 2]
+
+def test_retention_and_export_go_over_every_shard(tmpdir):
+    backend = sharded_backend(tmpdir)
+    policy = RetentionPolicy(archive_actions_days=1)
+    totals = apply_retention(str(tmpdir), policy, now=24 * 60 * 60 + 1.5,
+                            backend=backend)
+    assert totals['notebooks'] == 2
+    assert totals['actions'] == 2
+    assert sorted(backend.notebooks()) == KEYS
+
+    out_dir = str(tmpdir.join('out'))
+    totals = export_all(str(tmpdir), out_dir, since=0, backend=backend)
+    assert totals['failed'] == 0
+    assert totals['notebooks'] == 2
+    # the rows left in each notebook's shard
+    assert totals['actions'] == 2
+    for root, dirs, files in os.walk(os.path.join(out_dir, 'actions')):
+        for f in files:
+            with open(os.path.join(root, f)) as lines:
+                assert [json.loads(l)['time'] for l in lines] == [2000]
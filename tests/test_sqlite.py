@@ -0,0 +1,72 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of writing actions to the action databases
+"""
+
+import sqlite3
+
+import pytest
+
+from nbcomet import nbcomet_sqlite
+from nbcomet.nbcomet_sqlite import (DbManager, DbWriter, get_viewer_data,
+    SESSION_GAP)
+
+def record(t, name='run-cell'):
+    # (action_data, diff, cell_order) of an action at time t
+    action_data = {'time': t, 'name': name, 'index': 0, 'indices': [0]}
+    diff = {'c1': {'cell_type': 'code', 'source': 'x = %d' % t}}
+    return (action_data, diff, ['c1'])
+
+def stored_times(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [r[0] for r in conn.execute(
+                'SELECT time FROM actions ORDER BY time')]
+    finally:
+        conn.close()
+
+def test_actions_are_committed_in_batches_by_the_writer(tmpdir):
+    db_path = str(tmpdir.join('nb.db'))
+    writer = DbWriter(flush_interval=3600, batch_size=3)
+    manager = DbManager('nb', db_path, writer)
+    try:
+        assert manager.record_actions_to_db([record(1)]) == 1
+        manager.record_actions_to_db([record(2)])
+        assert stored_times(db_path) == []
+        assert writer.queued() == 2
+
+        writer.flush()
+        assert stored_times(db_path) == [1, 2]
+
+        # closing the notebook commits right away
+        manager.record_actions_to_db([record(3), record(4, 'notebook-closed')])
+        assert stored_times(db_path) == [1, 2, 3, 4]
+        assert writer.queued() == 0
+    finally:
+        manager.close()
+        writer.stop()
+
+@pytest.mark.parametrize('window_functions', [True, False])
+def test_viewer_data_is_summarized_in_one_pass(tmpdir, monkeypatch,
+                                                window_functions):
+    if not window_functions:
+        monkeypatch.setattr(nbcomet_sqlite.sqlite3, 'sqlite_version_info',
+                            (3, 24, 0))
+    db_path = str(tmpdir.join('nb.db'))
+    manager = DbManager('nb', db_path)
+    try:
+        # stored out of order, with a break longer than a session between
+        # the last two
+        manager.record_actions_to_db([record(3000, 'delete-cell'),
+                                    record(1000),
+                                    record(2000, 'run-cell-and-select-next'),
+                                    record(4000, 'insert-cell-below'),
+                                    record(4000 + SESSION_GAP, 'run-cell')])
+        manager.commit_queue()
+    finally:
+        manager.close()
+
+    assert get_viewer_data(db_path, 0, 10**9) == (1, 3, 3)
+    assert get_viewer_data(db_path, 2000, 3000) == (1, 1, 1)
+    assert get_viewer_data(db_path, 10**9, 10**9 + 1) == (0, 0, 0)
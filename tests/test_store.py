@@ -0,0 +1,75 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of writing files in place
+"""
+
+import os
+import stat
+
+from nbformat import v4
+
+from nbcomet.nbcomet_dir import get_version_index
+from nbcomet.nbcomet_store import atomic_write, save_version, read_version
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def test_atomic_write_uses_the_default_mode(tmpdir):
+    path = str(tmpdir.join('new.json'))
+    atomic_write(path, b'{}')
+    with open(path, 'rb') as f:
+        assert f.read() == b'{}'
+
+    # as if the file was created with open()
+    created = str(tmpdir.join('created.json'))
+    open(created, 'w').close()
+    assert mode(path) == mode(created)
+
+    umask = os.umask(0o027)
+    try:
+        atomic_write(str(tmpdir.join('private.json')), b'{}', fsync=True)
+    finally:
+        os.umask(umask)
+    assert mode(str(tmpdir.join('private.json'))) == 0o640
+
+def test_atomic_write_keeps_the_mode_of_the_file_it_replaces(tmpdir):
+    path = str(tmpdir.join('shared.json'))
+    atomic_write(path, b'1')
+    os.chmod(path, 0o664)
+    atomic_write(path, b'2')
+    assert mode(path) == 0o664
+    assert os.listdir(str(tmpdir)) == ['shared.json']
+
+def version(i):
+    return 'nb-2024-01-01-00-00-%02d-000000' % i
+
+def blobs(version_dir):
+    return sorted(f for root, dirs, files in
+                    os.walk(os.path.join(version_dir, 'blobs'))
+                    for f in files if f.endswith('.json.gz'))
+
+def test_dedup_versions_share_unchanged_cells(tmpdir):
+    version_dir = str(tmpdir)
+    cells = [v4.new_code_cell('x = 1', outputs=[
+                v4.new_output('stream', name='stdout', text='1\n')]),
+            v4.new_markdown_cell('# title')]
+    nb = v4.new_notebook(cells=cells)
+    path = save_version(nb, version_dir, version(0), 'dedup', action_time=5)
+    assert path.endswith('.manifest')
+    assert read_version(path) == nb
+    assert len(blobs(version_dir)) == 3
+
+    # only the body of the edited cell is stored again
+    nb.cells[0].source = 'x = 2'
+    path = save_version(nb, version_dir, version(1), 'dedup')
+    assert read_version(path) == nb
+    assert len(blobs(version_dir)) == 4
+
+    full = save_version(nb, version_dir, version(2))
+    assert read_version(full) == nb
+    entries = get_version_index(version_dir).all()
+    assert [e['file'] for e in entries] == [version(0) + '.manifest',
+                                            version(1) + '.manifest',
+                                            version(2) + '.ipynb']
+    assert [e['cells'] for e in entries] == [2, 2, 2]
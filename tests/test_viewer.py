@@ -0,0 +1,195 @@
+"""
+NBComet: Jupyter Notebook extension to track full notebook history
+
+Tests of the viewer's summary of a notebook's versions
+"""
+
+import os
+import json
+
+import pytest
+
+from nbcomet.nbcomet_backend import FileBackend
+from nbcomet.nbcomet_dir import get_version_index
+from nbcomet.nbcomet_store import save_version
+from nbcomet import nbcomet_viewer
+from nbcomet.nbcomet_viewer import (update_summary, summary_path,
+    VersionSummary, version_summaries, get_notebook_names, load_versions,
+    version_path, get_viewer_summary, get_version_page)
+
+KEY = '1a2b3c4d/nb'
+
+def notebook(*sources):
+    cells = [{'cell_type': 'markdown', 'metadata': {'comet_cell_id': c},
+                'source': s} for c, s in sources]
+    return {'cells': cells, 'metadata': {}, 'nbformat': 4,
+            'nbformat_minor': 2}
+
+def save(backend, i, *sources):
+    fname = 'nb-2024-01-01-00-00-%02d-000000' % i
+    save_version(notebook(*sources), backend.version_dir(KEY), fname)
+
+def summarize(data_dir):
+    versions = ['1a2b3c4d/nb/versions/' + e['file']
+                for e in FileBackend(data_dir).version_entries(KEY)]
+    return update_summary(data_dir, '1a2b3c4d', 'nb',
+                            versions).version_data()
+
+def test_versions_are_appended_to_the_summary(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    backend.open_actions(KEY).close()
+    path = summary_path(data_dir, '1a2b3c4d', 'nb')
+
+    save(backend, 0, ('a', 'x'), ('b', 'y'))
+    save(backend, 1, ('a', 'x2'))
+    first = summarize(data_dir)
+    with open(path) as f:
+        first_lines = f.readlines()
+    assert len(first_lines) == 2
+
+    save(backend, 2, ('a', 'x2'), ('c', 'z'))
+    data = summarize(data_dir)
+    with open(path) as f:
+        lines = f.readlines()
+    assert lines[0:2] == first_lines
+    assert len(lines) == 3
+
+    # cell b was deleted by version 1, a changed, then stayed the same
+    assert data[0:2] == first
+    assert data[0]['cells'] == [['a', 'markdown', 'x', 'false', 'false'],
+                                ['b', 'markdown', 'y', 'false', 'true']]
+    assert data[1]['cells'] == [['a', 'markdown', 'x2', 0, 'false']]
+    assert data[2]['cells'] == [['a', 'markdown', 'false', 1, 'false'],
+                                ['c', 'markdown', 'z', 'false', 'false']]
+
+    # another server picks the summary up from the saved records
+    version_summaries.clear()
+    save(backend, 3, ('c', 'z'))
+    data = summarize(data_dir)
+    assert data[0:2] == first
+    assert data[2]['cells'] == [['a', 'markdown', 'false', 1, 'true'],
+                                ['c', 'markdown', 'z', 'false', 'false']]
+    assert data[3]['cells'] == [['c', 'markdown', 'false', 2, 'false']]
+    with open(path) as f:
+        assert len(f.readlines()) == 4
+
+def test_summary_drops_a_removed_first_version(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    backend.open_actions(KEY).close()
+
+    save(backend, 0, ('a', 'x'))
+    save(backend, 1, ('a', 'y'))
+    summarize(data_dir)
+
+    removed = backend.version_entries(KEY)[0]['file']
+    os.remove(os.path.join(backend.version_dir(KEY), removed))
+    get_version_index(backend.version_dir(KEY)).remove([removed])
+
+    data = summarize(data_dir)
+    assert [d['num'] for d in data] == [0]
+    assert data[0]['cells'] == [['a', 'markdown', 'y', 'false', 'false']]
+    summary = VersionSummary(summary_path(data_dir, '1a2b3c4d', 'nb'))
+    summary.refresh()
+    assert summary.version_data() == data
+
+def test_removed_versions_are_dropped_without_reading_versions(tmpdir,
+                                                                monkeypatch):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    backend.open_actions(KEY).close()
+    path = summary_path(data_dir, '1a2b3c4d', 'nb')
+
+    save(backend, 0, ('a', 'x'), ('b', 'y'))
+    save(backend, 1, ('a', 'x2'), ('b', 'y'))
+    save(backend, 2, ('a', 'x2'), ('c', 'z'))
+    save(backend, 3, ('a', 'x3'), ('c', 'z'))
+    summarize(data_dir)
+
+    # thin out the second version
+    removed = backend.version_entries(KEY)[1]['file']
+    os.remove(os.path.join(backend.version_dir(KEY), removed))
+    get_version_index(backend.version_dir(KEY)).remove([removed])
+
+    def read_version_cells(data_dir, path):
+        raise AssertionError('read ' + path)
+    with monkeypatch.context() as m:
+        m.setattr(nbcomet_viewer, 'read_version_cells', read_version_cells)
+        data = summarize(data_dir)
+    assert [d['num'] for d in data] == [0, 1, 2]
+    with open(path) as f:
+        assert len(f.readlines()) == 3
+
+    # the same as summarizing the versions left from scratch
+    version_summaries.clear()
+    os.remove(path)
+    assert summarize(data_dir) == data
+
+def test_versions_are_read_in_order_by_worker_processes(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    backend.open_actions(KEY).close()
+    for i in range(5):
+        save(backend, i, ('a', 'x%d' % i))
+    nb = notebook(('a', 'y'))
+    nb['cells'].append({'cell_type': 'code', 'execution_count': 1,
+                        'metadata': {}, 'source': 'z',
+                        'outputs': [{'output_type': 'stream', 'name': 'stdout',
+                                    'text': '1'},
+                                    {'output_type': 'error', 'ename': 'E',
+                                    'evalue': '', 'traceback': []}]})
+    save_version(nb, backend.version_dir(KEY), 'nb-2024-01-01-00-00-05-000000')
+
+    paths = [version_path(KEY, e['file'])
+            for e in backend.version_entries(KEY)]
+    cells = list(load_versions(data_dir, paths))
+    assert [c[0][2] for c in cells] == ['x0', 'x1', 'x2', 'x3', 'x4', 'y']
+    # code cells are shown as the highest type of their outputs
+    assert cells[5][1] == [1, 'error', 'z']
+    assert list(load_versions(data_dir, paths, processes=2,
+                            chunksize=2)) == cells
+
+def test_names_are_read_from_the_snapshot_without_a_catalog(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    backend.open_actions(KEY).close()
+    nb = notebook(('a', 'x'))
+    nb['metadata']['comet_paths'] = [['1a2b3c4d/old.ipynb', 0],
+                                    ['1a2b3c4d/nb.ipynb', 5]]
+    backend.write_snapshot(KEY, nb, json.dumps(nb).encode())
+
+    names = get_notebook_names(data_dir, '1a2b3c4d', 'nb')
+    assert [n[0:3] for n in names[0:1]] == [['1a2b3c4d/old', 0, 5]]
+    assert names[1][0:2] == ['1a2b3c4d/nb', 5]
+
+    with pytest.raises(IOError):
+        get_notebook_names(data_dir, '5e6f7a8b', 'other')
+
+def test_versions_are_paged_by_position_and_time(tmpdir):
+    data_dir = str(tmpdir)
+    backend = FileBackend(data_dir)
+    backend.open_actions(KEY).close()
+    nb = notebook(('a', 'x'))
+    backend.write_snapshot(KEY, nb, json.dumps(nb).encode())
+    for i in range(5):
+        save(backend, i, ('a', 'x%d' % i))
+    times = [e['time'] for e in backend.version_entries(KEY)]
+
+    data, entries = get_viewer_summary(data_dir, '1a2b3c4d', 'nb')
+    assert data['numVersions'] == 5
+    assert [t for v, t in entries] == times
+    assert 'versions' not in data
+
+    page = get_version_page(data_dir, '1a2b3c4d', 'nb', offset=1, limit=2)
+    assert (page['total'], page['offset']) == (5, 1)
+    assert [v['num'] for v in page['versions']] == [1, 2]
+    assert page['versions'][0]['cells'] == [['a', 'markdown', 'x1', 0,
+                                            'false']]
+
+    page = get_version_page(data_dir, '1a2b3c4d', 'nb', offset=1,
+                            start_time=times[2], end_time=times[3])
+    assert (page['offset'], [v['num'] for v in page['versions']]) == (3, [3])
+
+    page = get_version_page(data_dir, '1a2b3c4d', 'nb', offset=5)
+    assert page['versions'] == []